@@ -0,0 +1,39 @@
+"""Схема и администратор по умолчанию auth_service; запускается при выкладке, а не при старте воркера.
+
+    ADMIN_EMAIL=... ADMIN_PASS=... python -m auth_service.bootstrap
+"""
+import os
+from typing import List, Optional
+
+from common.changefeed import ChangeBase
+from common.migrations import upgrade_schema
+from auth_service.hashing import pwd_context
+from auth_service.model import Base, SessionLocal, User
+
+
+def create_schema() -> None:
+    upgrade_schema(SessionLocal.engine, (Base.metadata, ChangeBase.metadata))
+
+
+def create_admin(email: Optional[str], password: Optional[str]) -> None:
+    """Хэш bcrypt считается только если администратора ещё нет."""
+    if not email or not password:
+        return
+    with SessionLocal() as db:
+        if db.query(User.id).filter(User.email == email).first() is None:
+            db.add(User(email=email, name="Главный админ", role="admin", password_hash=pwd_context.hash(password)))
+            db.commit()
+
+
+def bootstrap() -> None:
+    create_schema()
+    create_admin(os.getenv("ADMIN_EMAIL"), os.getenv("ADMIN_PASS"))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    bootstrap()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,14 +1,19 @@
 import os
-from typing import Generator
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_login import LoginManager
 from fastapi_login.exceptions import InvalidCredentialsException
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
-
-from auth_service.model import User, SessionLocal
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Query as OrmQuery, Session, load_only
+
+from common.cache import TTLCache
+from common.changefeed import ChangeBroker, publish, watch_changes
+from common.pagination import keyset_page
+from auth_service.hashing import hasher
+from auth_service.model import AsyncSessionLocal, User, get_async_db
 from auth_service.schemas import (
     RegisterUserRequestSchema,
     UserOut,
@@ -17,44 +22,65 @@ from auth_service.schemas import (
     PasswordChangeRequest,
     RoleUpdate,
     UserList,
+    HashPoolStats,
 )
 
 SECRET_KEY = os.getenv("KEY")
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
 
 app = APIRouter()
 
+principals = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
 manager = LoginManager(
     SECRET_KEY,
     token_url="/auth/login",
     algorithm="HS256",
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+async def find_user(db: AsyncSession, email: str) -> User | None:
+    return await db.scalar(select(User).where(User.email == email))
 
-def create_session() -> Session:
-    db = SessionLocal()
-    return db
 
+@manager.user_loader()
+async def query_user(email: str) -> User | None:
+    """Пользователь по subject токена; обращение к БД только при промахе кэша."""
+    user = principals.get(email)
+    if user is None:
+        # сброс кэша во время загрузки (смена роли, удаление) - и прочитанное в кэш не кладётся
+        generation = principals.generation
+        async with AsyncSessionLocal() as db:
+            user = await find_user(db, email)
+        if user is not None:
+            principals.set(email, user, generation)
+    return user
 
-def get_session() -> Generator[Session, None, None]:
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+def forget_user(user_id: int) -> None:
+    principals.discard_values(lambda user: user.id == user_id)
 
-@manager.user_loader()
-def query_user(email: str) -> User | None:
-    db = create_session()
-    try:
-        return db.query(User).filter(User.email == email).first()
-    finally:
-        db.close()
+
+async def user_changed(db: AsyncSession, user_id: int, action: str) -> None:
+    """Сброс кэша в этом воркере сразу, в остальных - через ленту изменений после commit."""
+    await db.run_sync(publish, "user", user_id, action)
+    await db.commit()
+    forget_user(user_id)
+
+
+def on_user_change(event: Dict) -> None:
+    if event["type"] == "reset":
+        principals.clear()
+    else:
+        forget_user(event["entity_id"])
 
 
-def require_admin(current_user: User = Depends(manager)) -> User:
+async def watch_user_changes(broker: ChangeBroker) -> None:
+    await watch_changes(broker, on_user_change)
+
+
+async def require_admin(current_user: User = Depends(manager)) -> User:
     if current_user.role != "admin":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -64,43 +90,39 @@ def require_admin(current_user: User = Depends(manager)) -> User:
 
 
 @app.post("/auth/register", response_model=int, status_code=201)
-async def register(user: RegisterUserRequestSchema):
-    db = create_session()
-    try:
-        existing_user = db.query(User).filter(User.email == user.username).first()
-        if existing_user:
-            raise HTTPException(
-                status_code=400,
-                detail="User is already registered.",
-            )
-
-        password_hash = pwd_context.hash(user.password)
-
-        new_user = User(
-            email=user.username,
-            name=user.name,
-            role=user.role,
-            password_hash=password_hash,
+async def register(user: RegisterUserRequestSchema, db: AsyncSession = Depends(get_async_db)):
+    existing_user = await find_user(db, user.username)
+    if existing_user:
+        raise HTTPException(
+            status_code=400,
+            detail="User is already registered.",
         )
 
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        return new_user.id
-    finally:
-        db.close()
+    password_hash = await hasher.hash(user.password)
+
+    new_user = User(
+        email=user.username,
+        name=user.name,
+        role=user.role,
+        password_hash=password_hash,
+    )
+
+    db.add(new_user)
+    await db.commit()
+    return new_user.id
 
 
 @app.post("/auth/login", response_model=Token)
-def login(data: OAuth2PasswordRequestForm = Depends()):
+async def login(data: OAuth2PasswordRequestForm = Depends()):
     username = data.username  # здесь это будет email
     password = data.password
 
-    user = query_user(username)
+    async with AsyncSessionLocal() as db:
+        user = await find_user(db, username)
     if not user:
         raise InvalidCredentialsException
 
-    if not pwd_context.verify(password, user.password_hash):
+    if not await hasher.verify(password, user.password_hash):
         raise InvalidCredentialsException
 
     access_token = manager.create_access_token(data={"sub": username})
@@ -112,85 +134,117 @@ def login(data: OAuth2PasswordRequestForm = Depends()):
 
 
 @app.get("/me", response_model=UserOut)
-def get_me(current_user: User = Depends(manager)):
+async def get_me(current_user: User = Depends(manager)):
     return UserOut.model_validate(current_user)
 
 
 @app.put("/me", response_model=UserOut)
-def update_me(
+async def update_me(
     payload: ProfileUpdateRequest,
     current_user: User = Depends(manager),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    db_user = db.query(User).filter(User.email == current_user.email).first()
+    values = payload.model_dump(exclude_none=True)
+    if not values:
+        return UserOut.model_validate(current_user)
+    db_user = await db.scalar(update(User).where(User.id == current_user.id).values(**values).returning(User))
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    if payload.name is not None:
-        db_user.name = payload.name
-    if payload.role is not None:
-        db_user.role = payload.role
-
-    db.commit()
-    db.refresh(db_user)
+    await user_changed(db, db_user.id, "update")
     return UserOut.model_validate(db_user)
 
 
 @app.put("/me/password")
-def change_password(
+async def change_password(
     payload: PasswordChangeRequest,
     current_user: User = Depends(manager),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    db_user = db.query(User).filter(User.email == current_user.email).first()
-    if not db_user:
+    # current_user может быть из кэша principals: хэш сверяется только со свежим из БД
+    stored_hash = await db.scalar(select(User.password_hash).where(User.id == current_user.id))
+    if stored_hash is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-    if not pwd_context.verify(payload.old_password, db_user.password_hash):
+    # соединение не держим, пока считается bcrypt
+    await db.rollback()
+    if not await hasher.verify(payload.old_password, stored_hash):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Старый пароль неверен")
 
-    db_user.password_hash = pwd_context.hash(payload.new_password)
-    db.commit()
+    password_hash = await hasher.hash(payload.new_password)
+    result = await db.execute(
+        update(User)
+        .where(User.id == current_user.id, User.password_hash == stored_hash)
+        .values(password_hash=password_hash)
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Пароль был изменён другим запросом")
+    await user_changed(db, current_user.id, "password")
 
     return {"detail": "Password updated"}
 
 
 @app.delete("/me", status_code=status.HTTP_204_NO_CONTENT)
-def delete_me(
+async def delete_me(
     current_user: User = Depends(manager),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    db_user = db.query(User).filter(User.email == current_user.email).first()
-    if not db_user:
+    result = await db.execute(delete(User).where(User.id == current_user.id))
+    if result.rowcount == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-    db.delete(db_user)
-    db.commit()
+    await user_changed(db, current_user.id, "delete")
     return
 
 
+def filter_users(query: OrmQuery, q: Optional[str], roles: Optional[List[str]]) -> OrmQuery:
+    """Префикс email или имени без учёта регистра (индексы по lower()) и фильтр по ролям."""
+    if q:
+        prefix = q.strip().lower()
+        query = query.filter(or_(
+            func.lower(User.email).startswith(prefix, autoescape=True),
+            func.lower(User.name).startswith(prefix, autoescape=True),
+        ))
+    if roles:
+        query = query.filter(User.role.in_(roles))
+    return query
+
+
 @app.get("/users", response_model=UserList)
-def list_users(
+async def list_users(
+    q: Optional[str] = Query(None, min_length=1, max_length=255),
+    role: Optional[List[str]] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    include_total: bool = False,
     _: User = Depends(require_admin),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    users = db.query(User).order_by(User.id).all()
-    items = [UserOut.model_validate(u) for u in users]
-    return UserList(users=items)
+    def load(session: Session) -> UserList:
+        query = filter_users(session.query(User), q, role)
+        users, next_cursor = keyset_page(
+            query.options(load_only(User.id, User.email, User.name, User.role)), User.id, cursor, limit
+        )
+        total = query.count() if include_total else None
+        return UserList(users=[UserOut.model_validate(u) for u in users], next_cursor=next_cursor, total=total)
+
+    return await db.run_sync(load)
 
 
 @app.put("/users/{user_id}/role", response_model=UserOut)
-def update_user_role(
+async def update_user_role(
     user_id: int,
     payload: RoleUpdate,
     _: User = Depends(require_admin),
-    db: Session = Depends(get_session),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
     user.role = payload.role
-    db.commit()
-    db.refresh(user)
+    await user_changed(db, user.id, "role")
     return UserOut.model_validate(user)
+
+
+@app.get("/auth/hash-pool", response_model=HashPoolStats)
+async def hash_pool_stats(_: User = Depends(require_admin)):
+    return HashPoolStats(**hasher.stats())
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "32"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class PasswordHasher:
+    """bcrypt в отдельном ограниченном пуле потоков.
+
+    bcrypt отпускает GIL, поэтому потоков достаточно. Одновременно принимается не больше
+    workers + queue_limit задач, остальные сразу получают 503, чтобы волна логинов не отнимала
+    воркер у /me и проверки токенов.
+    """
+
+    def __init__(self, context: CryptContext, workers: int = HASH_WORKERS, queue_limit: int = HASH_QUEUE_LIMIT):
+        self.context = context
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._run(self.context.verify, password, password_hash)
+
+    async def _run(self, fn: Callable, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Сервис перегружен, повторите попытку позже",
+                    headers={"Retry-After": "1"},
+                )
+            self._pending += 1
+        submitted = time.perf_counter()
+
+        def job():
+            started = time.perf_counter()
+            return fn(*args), started - submitted, time.perf_counter() - started
+
+        try:
+            result, queue_wait, hash_time = await asyncio.wrap_future(self._executor.submit(job))
+        finally:
+            with self._lock:
+                self._pending -= 1
+        self._record(queue_wait, hash_time)
+        return result
+
+    def _record(self, queue_wait: float, hash_time: float) -> None:
+        with self._lock:
+            self.completed += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+            self.hash_time_total += hash_time
+            self.hash_time_max = max(self.hash_time_max, hash_time)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            done = self.completed or 1
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self._pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "queue_wait_avg_ms": self.queue_wait_total / done * 1000,
+                "queue_wait_max_ms": self.queue_wait_max * 1000,
+                "hash_time_avg_ms": self.hash_time_total / done * 1000,
+                "hash_time_max_ms": self.hash_time_max * 1000,
+            }
+
+
+hasher = PasswordHasher(pwd_context)
@@ -1,11 +1,14 @@
-import os
+import asyncio
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from auth_service.model import Base, engine, SessionLocal, User
-from auth_service.endpoints import app as router
-from passlib.context import CryptContext
+from common.changefeed import PRUNE_INTERVAL, ChangeBroker, run_event_pruner
+from common.db import pool_report
+from common.internal import require_internal
+from common.metrics import MetricsMiddleware, metrics_endpoint
+from auth_service.model import SessionLocal
+from auth_service.endpoints import app as router, watch_user_changes
 
 app = FastAPI(title="Auth Service", version="1.0.0")
 
@@ -21,34 +24,32 @@ app.add_middleware(
     allow_headers=["*"],
     allow_credentials=True,
 )
+app.add_middleware(MetricsMiddleware, service="auth")
 
 app.include_router(router,  prefix="/auth_service", tags=("auth_service",))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 @app.on_event("startup")
-def create_initial_admin():
-    Base.metadata.create_all(bind=engine)
-
-    db = SessionLocal()
-    try:
-        admin_email = os.getenv("ADMIN_EMAIL")
-        admin_password = os.getenv("ADMIN_PASS")
-
-        admin = db.query(User).filter(User.email == admin_email).first()
-        if not admin:
-            admin_user = User(
-                email=admin_email,
-                name="Главный админ",
-                role="admin",
-                password_hash=pwd_context.hash(admin_password),
-            )
-            db.add(admin_user)
-            db.commit()
-    finally:
-        db.close()
+async def start_principal_invalidation():
+    """Изменения пользователей из других воркеров сбрасывают их из кэша этого воркера."""
+    app.state.user_changes = asyncio.create_task(watch_user_changes(ChangeBroker(SessionLocal, ["user"])))
+
+
+@app.on_event("startup")
+async def start_event_pruner():
+    """Журнал изменений чистится фоном по расписанию, а не в цикле брокера ленты."""
+    if PRUNE_INTERVAL:
+        app.state.event_pruner = asyncio.create_task(run_event_pruner(SessionLocal))
 
 
 @app.get("/")
 def health():
-    return {"status": "ok", "service": "auth"}
\ No newline at end of file
+    return {"status": "ok", "service": "auth"}
+
+
+@app.get("/db/pool", dependencies=[Depends(require_internal)])
+def db_pool():
+    return pool_report()
+
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
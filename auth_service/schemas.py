@@ -31,6 +31,8 @@ class RoleUpdate(BaseModel):
 
 class UserList(BaseModel):
     users: List[UserOut]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
 
 
 class ProfileUpdateRequest(BaseModel):
@@ -43,3 +45,13 @@ class PasswordChangeRequest(BaseModel):
     new_password: str
 
 
+class HashPoolStats(BaseModel):
+    workers: int
+    queue_limit: int
+    in_flight: int
+    completed: int
+    rejected: int
+    queue_wait_avg_ms: float
+    queue_wait_max_ms: float
+    hash_time_avg_ms: float
+    hash_time_max_ms: float
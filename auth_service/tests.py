@@ -0,0 +1,255 @@
+import asyncio
+import os
+import uuid
+
+os.environ.setdefault("KEY", "test-secret-key")
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from common.changefeed import ChangeBroker, publish
+from auth_service.endpoints import principals, watch_user_changes
+from auth_service.hashing import PasswordHasher, pwd_context
+from auth_service.main import app
+from auth_service.model import AsyncSessionLocal, SessionLocal, User
+from auth_service.bootstrap import bootstrap
+
+bootstrap()
+
+client = TestClient(app)
+
+
+def register_user(role: str = "engineer"):
+    email = f"user-{uuid.uuid4().hex[:8]}@example.com"
+    response = client.post(
+        "http://localhost:8080/auth_service/auth/register",
+        json={"username": email, "password": "secret", "name": "Tester", "role": role},
+    )
+    assert response.status_code == 201
+    return email, response.json()
+
+
+def login(email: str, password: str = "secret"):
+    return client.post(
+        "http://localhost:8080/auth_service/auth/login",
+        data={"username": email, "password": password},
+    )
+
+
+def auth_headers(email: str, password: str = "secret"):
+    return {"Authorization": f"Bearer {login(email, password).json()['access_token']}"}
+
+
+def test_register_and_login():
+    email, user_id = register_user()
+    response = client.post(
+        "http://localhost:8080/auth_service/auth/register",
+        json={"username": email, "password": "secret", "name": "Tester"},
+    )
+    assert response.status_code == 400
+
+    response = login(email)
+    assert response.status_code == 200
+    assert response.json()["user"]["id"] == user_id
+    assert login(email, "wrong").status_code == 401
+
+    response = client.get("http://localhost:8080/auth_service/me", headers=auth_headers(email))
+    assert response.json()["email"] == email
+
+
+def test_update_profile_and_password():
+    email, _ = register_user()
+    headers = auth_headers(email)
+
+    response = client.put("http://localhost:8080/auth_service/me", json={"name": "Renamed"}, headers=headers)
+    assert response.json()["name"] == "Renamed"
+
+    response = client.put(
+        "http://localhost:8080/auth_service/me/password",
+        json={"old_password": "wrong", "new_password": "new-secret"},
+        headers=headers,
+    )
+    assert response.status_code == 400
+    response = client.put(
+        "http://localhost:8080/auth_service/me/password",
+        json={"old_password": "secret", "new_password": "new-secret"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert login(email, "new-secret").status_code == 200
+
+    response = client.delete("http://localhost:8080/auth_service/me", headers=headers)
+    assert response.status_code == 204
+    assert login(email, "new-secret").status_code == 401
+
+
+def test_admin_endpoints():
+    email, _ = register_user()
+    assert client.get("http://localhost:8080/auth_service/users", headers=auth_headers(email)).status_code == 403
+
+    admin_email, _ = register_user(role="admin")
+    headers = auth_headers(admin_email)
+    users = client.get("http://localhost:8080/auth_service/users", headers=headers).json()["users"]
+    target = next(u for u in users if u["email"] == email)
+
+    response = client.put(
+        f"http://localhost:8080/auth_service/users/{target['id']}/role",
+        json={"role": "manager"},
+        headers=headers,
+    )
+    assert response.json()["role"] == "manager"
+    with SessionLocal() as db:
+        assert db.query(User).filter(User.email == email).one().role == "manager"
+
+
+def test_password_hash_pool_rejects_when_saturated():
+    hasher = PasswordHasher(pwd_context, workers=1, queue_limit=1)
+
+    async def scenario():
+        return await asyncio.gather(*(hasher.hash("secret") for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(rejected) == 1 and rejected[0].status_code == 503
+    assert all(pwd_context.verify("secret", r) for r in results if isinstance(r, str))
+    stats = hasher.stats()
+    assert stats["completed"] == 2 and stats["rejected"] == 1 and stats["in_flight"] == 0
+    assert stats["hash_time_max_ms"] > 0
+
+
+def test_principal_cache_skips_database():
+    email, _ = register_user()
+    headers = auth_headers(email)
+    principals.clear()
+    client.get("http://localhost:8080/auth_service/me", headers=headers)
+
+    statements = []
+    engine = AsyncSessionLocal.engine.sync_engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        for _ in range(3):
+            assert client.get("http://localhost:8080/auth_service/me", headers=headers).status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert statements == []
+
+    response = client.put("http://localhost:8080/auth_service/me", json={"name": "Cached"}, headers=headers)
+    assert response.json()["name"] == "Cached"
+    assert client.get("http://localhost:8080/auth_service/me", headers=headers).json()["name"] == "Cached"
+
+
+def test_principal_cache_invalidated_from_other_workers():
+    email, user_id = register_user()
+    client.get("http://localhost:8080/auth_service/me", headers=auth_headers(email))
+    assert principals.get(email) is not None
+
+    async def scenario():
+        task = asyncio.create_task(watch_user_changes(ChangeBroker(SessionLocal, ["user"], poll_interval=0.05)))
+        await asyncio.sleep(0.2)
+        with SessionLocal() as db:
+            db.query(User).filter(User.id == user_id).update({"role": "manager"})
+            publish(db, "user", user_id, "role")
+            db.commit()
+        for _ in range(50):
+            if principals.get(email) is None:
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert principals.get(email) is None
+    assert client.get("http://localhost:8080/auth_service/me", headers=auth_headers(email)).json()["role"] == "manager"
+
+
+def test_change_password_checks_current_hash_not_cached_user():
+    email, user_id = register_user()
+    headers = auth_headers(email)
+    client.get("http://localhost:8080/auth_service/me", headers=headers)
+    assert principals.get(email) is not None
+    # пароль сменили в другом воркере, событие ленты сюда ещё не дошло
+    with SessionLocal() as db:
+        db.query(User).filter(User.id == user_id).update({"password_hash": pwd_context.hash("changed")})
+        db.commit()
+
+    response = client.put(
+        "http://localhost:8080/auth_service/me/password",
+        json={"old_password": "secret", "new_password": "stolen"},
+        headers=headers,
+    )
+    assert response.status_code == 400
+    response = client.put(
+        "http://localhost:8080/auth_service/me/password",
+        json={"old_password": "changed", "new_password": "new-secret"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert login(email, "new-secret").status_code == 200
+
+def test_principal_cache_fill_racing_role_change(monkeypatch):
+    from auth_service import endpoints
+
+    email, user_id = register_user("admin")
+    principals.clear()
+    find_user = endpoints.find_user
+
+    async def scenario():
+        loaded, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_find_user(db, email):
+            user = await find_user(db, email)
+            loaded.set()
+            await release.wait()
+            return user
+
+        monkeypatch.setattr(endpoints, "find_user", slow_find_user)
+        fill = asyncio.create_task(endpoints.query_user(email))
+        await loaded.wait()
+        # роль сменили и кэш сбросили, пока загрузка ещё не вернулась
+        with SessionLocal() as db:
+            db.query(User).filter(User.id == user_id).update({"role": "engineer"})
+            db.commit()
+        endpoints.forget_user(user_id)
+        release.set()
+        return await fill
+
+    assert asyncio.run(scenario()).role == "admin"
+    assert principals.get(email) is None
+    monkeypatch.undo()
+    assert client.get("http://localhost:8080/auth_service/me", headers=auth_headers(email)).json()["role"] == "engineer"
+
+def test_list_users_paginated_and_filtered():
+    admin_email, _ = register_user(role="admin")
+    headers = auth_headers(admin_email)
+    tag = uuid.uuid4().hex[:8]
+    for i in range(5):
+        client.post(
+            "http://localhost:8080/auth_service/auth/register",
+            json={"username": f"Page_{tag}_{i}@example.com", "password": "x", "name": f"N{i}", "role": "qa" if i % 2 else "dev"},
+        )
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"q": f"page_{tag}", "limit": 2, "include_total": True}
+        if cursor:
+            params["cursor"] = cursor
+        data = client.get("http://localhost:8080/auth_service/users", params=params, headers=headers).json()
+        assert data["total"] == 5
+        seen += [u["email"] for u in data["users"]]
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+    assert seen == [f"Page_{tag}_{i}@example.com" for i in range(5)]
+
+    data = client.get(
+        "http://localhost:8080/auth_service/users",
+        params={"q": f"PAGE_{tag}", "role": "qa"},
+        headers=headers,
+    ).json()
+    assert [u["email"] for u in data["users"]] == [f"Page_{tag}_1@example.com", f"Page_{tag}_3@example.com"]
+    assert data["total"] is None
+
+    data = client.get("http://localhost:8080/auth_service/users", params={"q": "%"}, headers=headers).json()
+    assert data["users"] == []
@@ -0,0 +1,514 @@
+"""Нагрузочный прогон всех роутеров на заполненной БД: задержки, пропускная способность, память.
+
+    python -m benchmarks.load [--defects 10000] [--projects 200] [--users 500]
+                              [--requests 500] [--concurrency 16] [--output load.json]
+                              [--compare baseline.json --max-regression 20]
+
+По умолчанию данные засеваются во временный файл SQLite; с --database-url можно взять
+одноразовый Postgres (--reset удалит таблицы сервисов перед засевом). Генератор данных
+детерминирован по --seed, поэтому прогоны с одинаковыми параметрами сравнимы.
+
+Запросы идут в приложение gateway через ASGI в этом же процессе: те же роутеры, middleware и
+общий пул соединений, что и в продакшене, но без сети и uvicorn. На каждый эндпоинт - отдельная
+серия из --requests запросов от --concurrency одновременных клиентов; пиковый RSS процесса
+снимается во время серии. Результат - JSON, который можно передать в --compare следующего прогона.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+PASSWORD = "bench-password"
+ADMIN_EMAIL = "admin@bench.example.com"
+BATCH = 1000
+
+STATUSES = ["Новая", "В работе", "На проверке", "Закрыта"]
+PRIORITIES = ["Низкий", "Средний", "Высокий", "Критический"]
+ASSIGNEES = [f"Инженер {i}" for i in range(1, 21)]
+STAGES = ["Анализ", "Проектирование", "В разработке", "Приёмка", "Выполнено"]
+WORDS = (
+    "протечка кровля трещина фасад окно дверь перекрытие стяжка штукатурка плитка вентиляция "
+    "отопление электрика щиток розетка кабель лестница лифт подвал фундамент гидроизоляция "
+    "секция этаж квартира монтаж демонтаж замер акт предписание срок подрядчик"
+).split()
+MIME_TYPES = ["image/jpeg", "image/png", "application/pdf", "video/mp4"]
+
+
+@dataclass
+class Sizes:
+    defects: int
+    projects: int
+    users: int
+    comments: int
+    history: int
+    attachments: int
+
+
+@dataclass
+class Context:
+    """Что засеяно и что нужно сценариям: id сущностей, токен администратора."""
+
+    rng: random.Random
+    defect_ids: List[int] = field(default_factory=list)
+    project_ids: List[int] = field(default_factory=list)
+    user_emails: List[str] = field(default_factory=list)
+    headers: Dict[str, str] = field(default_factory=dict)
+    stages_etag: str = ""
+    counter: "itertools.count" = field(default_factory=itertools.count)
+
+
+Request = Tuple[str, str, Dict]
+
+
+@dataclass
+class Scenario:
+    name: str
+    build: Callable[[Context], Request]
+    # доля от --requests: дорогие эндпоинты (bcrypt, полный экспорт) гоняются реже
+    share: float = 1.0
+
+
+def words(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+# --- засев ---------------------------------------------------------------------------------
+
+def reset_database(url: str) -> None:
+    from sqlalchemy import create_engine
+
+    from common.blobs import BlobBase
+    from common.changefeed import ChangeBase
+    from common.search import SearchBase
+    from auth_service.model import Base as AuthBase
+    from defects_service.model import Base as DefectsBase
+    from projects_service.model import Base as ProjectsBase
+    from settings_service.model import Base as SettingsBase
+
+    engine = create_engine(url)
+    try:
+        for base in (DefectsBase, ProjectsBase, AuthBase, SettingsBase, SearchBase, ChangeBase, BlobBase):
+            base.metadata.drop_all(engine)
+    finally:
+        engine.dispose()
+
+
+def seed_users(ctx: Context, count: int) -> None:
+    from sqlalchemy import insert
+
+    from auth_service.hashing import pwd_context
+    from auth_service.model import SessionLocal, User
+
+    # один хэш на всех: засев не должен занимать минуты bcrypt
+    password_hash = pwd_context.hash(PASSWORD)
+    ctx.user_emails = [f"user{i}@bench.example.com" for i in range(count)]
+    rows = [{"email": ADMIN_EMAIL, "name": "Администратор", "role": "admin", "password_hash": password_hash}]
+    rows += [
+        {"email": email, "name": f"Пользователь {i}", "role": ctx.rng.choice(["engineer", "manager"]), "password_hash": password_hash}
+        for i, email in enumerate(ctx.user_emails)
+    ]
+    with SessionLocal() as db:
+        for start in range(0, len(rows), BATCH):
+            db.execute(insert(User), rows[start:start + BATCH])
+        db.commit()
+
+
+def seed_projects(ctx: Context, count: int) -> None:
+    from sqlalchemy import insert
+
+    from projects_service.model import Project, ProjectHistory, ProjectStage, SessionLocal
+
+    rng = ctx.rng
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        for start in range(0, count, BATCH):
+            rows = [
+                {
+                    "name": f"ЖК {words(rng, 1, 2)} {i}", "description": words(rng, 10, 60),
+                    "created_at": now, "updated_at": now, "version": 1,
+                }
+                for i in range(start, min(count, start + BATCH))
+            ]
+            ids = db.scalars(insert(Project).returning(Project.id, sort_by_parameter_order=True), rows).all()
+            db.execute(insert(ProjectStage), [
+                {"project_id": project_id, "title": title, "position": float(position)}
+                for project_id in ids
+                for position, title in enumerate(STAGES[:rng.randint(1, len(STAGES))], start=1)
+            ])
+            db.execute(insert(ProjectHistory), [
+                {"project_id": project_id, "ts": now, "action": "create", "payload": {"name": row["name"]}}
+                for project_id, row in zip(ids, rows)
+            ])
+            ctx.project_ids.extend(ids)
+        db.commit()
+
+
+def defect_children(rng: random.Random, defect_id: int, created: datetime, sizes: Sizes) -> Tuple[List, List, List]:
+    """Комментарии, история и вложения одного дефекта; в среднем столько, сколько задано в sizes."""
+    comments = [
+        {"defect_id": defect_id, "text": words(rng, 3, 80), "created_at": created + timedelta(hours=n)}
+        for n in range(rng.randint(0, 2 * sizes.comments))
+    ]
+    history = [{"defect_id": defect_id, "ts": created, "action": "create", "payload": {"status": STATUSES[0]}}]
+    for n in range(rng.randint(0, 2 * sizes.history)):
+        history.append({
+            "defect_id": defect_id, "ts": created + timedelta(hours=n), "action": "update",
+            "payload": {"before": {"status": rng.choice(STATUSES)}, "after": {"status": rng.choice(STATUSES), "assignee": rng.choice(ASSIGNEES)}},
+        })
+    attachments = []
+    for n in range(rng.randint(0, 2 * sizes.attachments)):
+        mime = rng.choice(MIME_TYPES)
+        attachments.append({
+            "defect_id": defect_id, "name": f"file-{defect_id}-{n}.{mime.split('/')[1]}",
+            # размеры файлов - логнормальные, медиана около 160 КБ
+            "size": int(rng.lognormvariate(12, 1.2)), "type": mime, "storage_key": f"bench/{defect_id}/{n}",
+            "created_at": created,
+        })
+    return comments, history, attachments
+
+
+def seed_defects(ctx: Context, sizes: Sizes) -> None:
+    from sqlalchemy import insert
+
+    from defects_service.model import Defect, DefectAttachment, DefectComment, DefectHistory, SessionLocal
+
+    rng = ctx.rng
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        for start in range(0, sizes.defects, BATCH):
+            rows = []
+            for i in range(start, min(sizes.defects, start + BATCH)):
+                created = now - timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+                rows.append({
+                    "title": f"{words(rng, 2, 8).capitalize()} №{i}", "desc": words(rng, 5, 150)[:2000],
+                    "status": rng.choice(STATUSES), "priority": rng.choice(PRIORITIES),
+                    "assignee": rng.choice(ASSIGNEES + [None]),
+                    "due": (date.today() + timedelta(days=rng.randint(-60, 120))).isoformat(),
+                    "project_id": ctx.project_ids[i % len(ctx.project_ids)] if ctx.project_ids else None,
+                    "created_at": created, "updated_at": created, "version": 1,
+                })
+            ids = db.scalars(insert(Defect).returning(Defect.id, sort_by_parameter_order=True), rows).all()
+            comments, history, attachments = [], [], []
+            for defect_id, row in zip(ids, rows):
+                c, h, a = defect_children(rng, defect_id, row["created_at"], sizes)
+                comments += c
+                history += h
+                attachments += a
+            for model, values in ((DefectComment, comments), (DefectHistory, history), (DefectAttachment, attachments)):
+                if values:
+                    db.execute(insert(model), values)
+            ctx.defect_ids.extend(ids)
+        db.commit()
+
+
+def seed(ctx: Context, sizes: Sizes) -> Dict[str, float]:
+    """Схема, данные, затем счётчики и поисковый индекс - теми же bootstrap, что и в migrate."""
+    from auth_service.bootstrap import bootstrap as bootstrap_auth
+    from defects_service.bootstrap import bootstrap as bootstrap_defects
+    from projects_service.bootstrap import bootstrap as bootstrap_projects
+    from settings_service.bootstrap import bootstrap as bootstrap_settings
+
+    timings = {}
+    started = time.perf_counter()
+    bootstrap_auth()
+    bootstrap_settings()
+    bootstrap_defects()
+    bootstrap_projects()
+    for name, step in (
+        ("users", lambda: seed_users(ctx, sizes.users)),
+        ("projects", lambda: seed_projects(ctx, sizes.projects)),
+        ("defects", lambda: seed_defects(ctx, sizes)),
+        ("counters_and_index", lambda: (
+            bootstrap_defects(force_counters=True, force_reindex=True),
+            bootstrap_projects(force_reindex=True),
+        )),
+    ):
+        step_started = time.perf_counter()
+        step()
+        timings[f"{name}_s"] = round(time.perf_counter() - step_started, 3)
+    timings["total_s"] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+# --- сценарии ------------------------------------------------------------------------------
+
+def any_defect(ctx: Context) -> int:
+    return ctx.rng.choice(ctx.defect_ids)
+
+
+def any_project(ctx: Context) -> int:
+    return ctx.rng.choice(ctx.project_ids)
+
+
+def get(url: str, **kwargs) -> Request:
+    return "GET", url, kwargs
+
+
+SCENARIOS = [
+    Scenario("GET /defects_service/defects", lambda ctx: get("/defects_service/defects")),
+    Scenario("GET /defects_service/defects?status&priority", lambda ctx: get(
+        "/defects_service/defects", params={"status": ctx.rng.choice(STATUSES), "priority": ctx.rng.choice(PRIORITIES)},
+    )),
+    Scenario("GET /defects_service/defects?project_id&sort=id", lambda ctx: get(
+        "/defects_service/defects", params={"project_id": any_project(ctx), "sort": "id"},
+    )),
+    Scenario("GET /defects_service/defects/{defect_id}", lambda ctx: get(f"/defects_service/defects/{any_defect(ctx)}")),
+    Scenario("GET /defects_service/defects/{defect_id}/comments", lambda ctx: get(f"/defects_service/defects/{any_defect(ctx)}/comments")),
+    Scenario("GET /defects_service/defects/{defect_id}/history", lambda ctx: get(f"/defects_service/defects/{any_defect(ctx)}/history")),
+    Scenario("GET /defects_service/defects/stats", lambda ctx: get("/defects_service/defects/stats")),
+    Scenario("GET /defects_service/defects/stats?assignee", lambda ctx: get(
+        "/defects_service/defects/stats", params={"assignee": ctx.rng.choice(ASSIGNEES)},
+    )),
+    Scenario("GET /defects_service/search", lambda ctx: get(
+        "/defects_service/search", params={"q": ctx.rng.choice(WORDS)},
+    )),
+    Scenario("GET /defects_service/defects/export", lambda ctx: get("/defects_service/defects/export"), share=0.05),
+    Scenario("POST /defects_service/defects", lambda ctx: ("POST", "/defects_service/defects", {"json": {
+        "title": words(ctx.rng, 2, 8), "desc": words(ctx.rng, 5, 100), "priority": ctx.rng.choice(PRIORITIES),
+        "assignee": ctx.rng.choice(ASSIGNEES), "project_id": any_project(ctx) if ctx.project_ids else None,
+    }})),
+    Scenario("PATCH /defects_service/defects/{defect_id}/status", lambda ctx: (
+        "PATCH", f"/defects_service/defects/{any_defect(ctx)}/status", {"json": {"status": ctx.rng.choice(STATUSES)}},
+    )),
+    Scenario("POST /defects_service/defects/{defect_id}/comments", lambda ctx: (
+        "POST", f"/defects_service/defects/{any_defect(ctx)}/comments", {"json": {"text": words(ctx.rng, 3, 80)}},
+    )),
+    Scenario("GET /projects_service/projects", lambda ctx: get("/projects_service/projects")),
+    Scenario("GET /projects_service/projects?include_counts", lambda ctx: get(
+        "/projects_service/projects", params={"include_counts": "true"},
+    )),
+    Scenario("GET /projects_service/projects/{project_id}", lambda ctx: get(f"/projects_service/projects/{any_project(ctx)}")),
+    Scenario("GET /projects_service/projects/{project_id}/defects", lambda ctx: get(
+        f"/projects_service/projects/{any_project(ctx)}/defects",
+    )),
+    Scenario("GET /projects_service/projects/by-stage", lambda ctx: get(
+        "/projects_service/projects/by-stage", params={"title": ctx.rng.choice(STAGES)},
+    )),
+    Scenario("POST /projects_service/projects", lambda ctx: ("POST", "/projects_service/projects", {"json": {
+        "name": f"ЖК {words(ctx.rng, 1, 2)}", "description": words(ctx.rng, 10, 60),
+    }})),
+    Scenario("POST /projects_service/projects/{project_id}/stages", lambda ctx: (
+        "POST", f"/projects_service/projects/{any_project(ctx)}/stages", {"json": {"title": f"Этап {next(ctx.counter)}"}},
+    )),
+    Scenario("GET /settings_service/settings/stages", lambda ctx: get("/settings_service/settings/stages")),
+    Scenario("GET /settings_service/settings/stages (If-None-Match)", lambda ctx: get(
+        "/settings_service/settings/stages", headers={"If-None-Match": ctx.stages_etag},
+    )),
+    Scenario("GET /auth_service/me", lambda ctx: get("/auth_service/me", headers=ctx.headers)),
+    Scenario("GET /auth_service/users", lambda ctx: get("/auth_service/users", headers=ctx.headers)),
+    Scenario("POST /auth_service/auth/login", lambda ctx: ("POST", "/auth_service/auth/login", {"data": {
+        "username": ctx.rng.choice(ctx.user_emails or [ADMIN_EMAIL]), "password": PASSWORD,
+    }}), share=0.2),
+]
+
+
+# --- прогон --------------------------------------------------------------------------------
+
+class RssSampler:
+    """Пиковый RSS процесса за время серии; без /proc - пик за всё время жизни процесса."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> Optional[int]:
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current() or 0)
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = self.current() or 0
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        if not self.peak:
+            # ru_maxrss в Linux - КБ, в macOS - байты
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """По ближайшему рангу: значение, не меньше которого q% выборки."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+async def run_scenario(client, scenario: Scenario, ctx: Context, requests: int, concurrency: int, warmup: int) -> Dict:
+    for _ in range(warmup):
+        method, url, kwargs = scenario.build(ctx)
+        await client.request(method, url, **kwargs)
+
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    remaining = iter(range(requests))
+
+    async def client_loop():
+        for _ in remaining:
+            method, url, kwargs = scenario.build(ctx)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                statuses[str(response.status_code)] += 1
+            except Exception as error:
+                statuses[type(error).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    errors = sum(n for code, n in statuses.items() if not code.isdigit() or int(code) >= 400)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": dict(sorted(statuses.items())),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+    }
+
+
+async def run(args, sizes: Sizes) -> Dict:
+    import httpx
+
+    from gateway.main import app
+
+    ctx = Context(rng=random.Random(args.seed))
+    selected = [s for s in SCENARIOS if not args.endpoint or any(part in s.name for part in args.endpoint)]
+    report: Dict = {"endpoints": {}}
+    # startup-хуки gateway (общий пул, подписка кэшей) - до первой сессии, как под uvicorn
+    async with app.router.lifespan_context(app):
+        report["seed"] = await asyncio.to_thread(seed, ctx, sizes)
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost:8080", timeout=None) as client:
+            login = await client.post("/auth_service/auth/login", data={"username": ADMIN_EMAIL, "password": PASSWORD})
+            login.raise_for_status()
+            ctx.headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+            ctx.stages_etag = (await client.get("/settings_service/settings/stages")).headers.get("etag", "")
+
+            for scenario in selected:
+                requests = max(args.concurrency, int(args.requests * scenario.share))
+                result = await run_scenario(client, scenario, ctx, requests, args.concurrency, args.warmup)
+                report["endpoints"][scenario.name] = result
+                print(
+                    f"{scenario.name:<62} p50 {result['p50_ms']:>8.1f}  p95 {result['p95_ms']:>8.1f}  "
+                    f"p99 {result['p99_ms']:>8.1f} ms  {result['throughput_rps']:>7.1f} rps  "
+                    f"{result['peak_rss_mb']:>6.1f} MB  errors {result['errors']}",
+                    file=sys.stderr,
+                )
+    return report
+
+
+def compare(report: Dict, baseline: Dict, max_regression: Optional[float]) -> int:
+    """Печатает изменение p95 и пропускной способности; 1, если p95 вырос больше допустимого."""
+    regressed = []
+    print(f"\n{'':<62} {'p95 ms':>18} {'rps':>18}", file=sys.stderr)
+    for name, current in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if before is None:
+            continue
+        p95_change = (current["p95_ms"] / before["p95_ms"] - 1) * 100 if before["p95_ms"] else 0.0
+        rps_change = (current["throughput_rps"] / before["throughput_rps"] - 1) * 100 if before["throughput_rps"] else 0.0
+        print(
+            f"{name:<62} {before['p95_ms']:>7.1f} -> {current['p95_ms']:>7.1f} "
+            f"{before['throughput_rps']:>7.1f} -> {current['throughput_rps']:>7.1f}  p95 {p95_change:+.0f}%  rps {rps_change:+.0f}%",
+            file=sys.stderr,
+        )
+        if max_regression is not None and p95_change > max_regression:
+            regressed.append(name)
+    if regressed:
+        print(f"p95 вырос больше чем на {max_regression}%: {', '.join(regressed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон всех сервисов")
+    parser.add_argument("--database-url", help="по умолчанию - новый файл SQLite во временном каталоге")
+    parser.add_argument("--reset", action="store_true", help="удалить таблицы сервисов перед засевом")
+    parser.add_argument("--defects", type=int, default=10000)
+    parser.add_argument("--projects", type=int, default=200)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--comments", type=int, default=5, help="в среднем на дефект")
+    parser.add_argument("--history", type=int, default=5, help="в среднем изменений на дефект")
+    parser.add_argument("--attachments", type=int, default=3, help="в среднем на дефект")
+    parser.add_argument("--requests", type=int, default=500, help="запросов на эндпоинт")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=5, help="неучитываемых запросов перед серией")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--endpoint", action="append", help="только сценарии, в названии которых есть подстрока")
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--max-regression", type=float, help="ошибка, если p95 вырос больше чем на N%%")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="load-bench-")
+    url = args.database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    # модели сервисов читают окружение при импорте, поэтому все импорты сервисов - ниже
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("KEY", "load-benchmark")
+    os.environ.setdefault("ATTACHMENTS_DIR", os.path.join(workdir, "attachments"))
+    os.environ.setdefault("SLOW_REQUEST_MS", "0")
+    if args.reset:
+        reset_database(url)
+
+    from sqlalchemy.engine import make_url
+
+    sizes = Sizes(args.defects, args.projects, args.users, args.comments, args.history, args.attachments)
+    report = asyncio.run(run(args, sizes))
+    report["meta"] = {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "database": make_url(url).get_backend_name(),
+        "sizes": vars(sizes),
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "python": sys.version.split()[0],
+    }
+    report = {"meta": report.pop("meta"), **report}
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump(report, out, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            return compare(report, json.load(baseline), args.max_regression)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,114 @@
+"""CPU на сериализацию одного ответа: обычный путь FastAPI против json_response.
+
+    python -m benchmarks.serialization [--attachments 200] [--items 200] [--repeat 200]
+
+Обычный путь - то же, что делает FastAPI для response_model: валидация ORM-объекта схемой с
+from_attributes, dump в JSON-совместимые типы и json.dumps в JSONResponse. Быстрый путь -
+RowSerializer и ORJSONResponse. БД не нужна: объекты моделей создаются в памяти.
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from common.fastjson import json_response
+from defects_service.model import Defect, DefectAttachment, DefectComment, DefectHistory
+from defects_service.schemas import CommentPage, DefectOut, HistoryPage, comment_row, defect_row, history_row
+
+
+def make_defect(attachments: int) -> Defect:
+    return Defect(
+        id=1, title="Протечка кровли в секции 3", desc="Описание " * 50, status="В работе", priority="Высокий",
+        assignee="Инженер", due="2030-01-01", project_id=7,
+        attachments=[
+            DefectAttachment(id=i, name=f"photo-{i}.jpg", size=100_000 + i, type="image/jpeg", storage_key=f"k{i}")
+            for i in range(attachments)
+        ],
+    )
+
+
+def make_comments(n: int) -> List[DefectComment]:
+    now = datetime.utcnow()
+    return [DefectComment(id=i, defect_id=1, text="Комментарий " * 10, created_at=now - timedelta(minutes=i)) for i in range(n)]
+
+
+def make_history(n: int) -> List[DefectHistory]:
+    now = datetime.utcnow()
+    return [
+        DefectHistory(id=i, defect_id=1, ts=now, action="update", payload={"before": {"status": "Новая"}, "after": {"status": "В работе"}})
+        for i in range(n)
+    ]
+
+
+def fastapi_path(schema) -> Callable:
+    field = create_model_field(name="Response", type_=schema, mode="serialization")
+
+    def render(content):
+        # с is_coroutine=True serialize_response ничего не ждёт, поэтому её можно довести до конца без цикла событий
+        coro = serialize_response(field=field, response_content=content)
+        try:
+            coro.send(None)
+        except StopIteration as done:
+            return JSONResponse(done.value).body
+        raise RuntimeError("serialize_response неожиданно ушла в ожидание")
+
+    return render
+
+
+def timed(render: Callable, content, repeat: int) -> Dict[str, float]:
+    render(content)
+    started = time.process_time()
+    for _ in range(repeat):
+        body = render(content)
+    return {"us_per_response": (time.process_time() - started) / repeat * 1e6, "bytes": len(body)}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Сериализация ответов")
+    parser.add_argument("--attachments", type=int, default=200)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    defect = make_defect(args.attachments)
+    comments = make_comments(args.items)
+    history = make_history(args.items)
+    cases = {
+        "defect": (
+            fastapi_path(DefectOut), defect,
+            lambda d: json_response(defect_row(d)).body, defect,
+        ),
+        "comments_page": (
+            fastapi_path(CommentPage), {"items": comments, "next_cursor": None},
+            lambda items: json_response({"items": comment_row.many(items), "next_cursor": None}).body, comments,
+        ),
+        "history_page": (
+            fastapi_path(HistoryPage), {"items": history, "next_cursor": None},
+            lambda items: json_response({"items": history_row.many(items), "next_cursor": None}).body, history,
+        ),
+    }
+
+    report = {}
+    for name, (slow, slow_content, fast, fast_content) in cases.items():
+        baseline = timed(slow, slow_content, args.repeat)
+        optimized = timed(fast, fast_content, args.repeat)
+        if json.loads(slow(slow_content)) != json.loads(fast(fast_content)):
+            raise SystemExit(f"{name}: ответы различаются")
+        report[name] = {
+            "fastapi_us": round(baseline["us_per_response"], 1),
+            "fast_path_us": round(optimized["us_per_response"], 1),
+            "saved_us": round(baseline["us_per_response"] - optimized["us_per_response"], 1),
+            "speedup": round(baseline["us_per_response"] / optimized["us_per_response"], 2),
+            "bytes": optimized["bytes"],
+        }
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
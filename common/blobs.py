@@ -0,0 +1,253 @@
+"""Содержимое вложений по хэшу: одинаковые файлы хранятся один раз на сервис.
+
+Вложение ссылается на blob по SHA-256, строка attachment_blobs считает ссылки. Повторная
+загрузка известного содержимого ничего не пишет в хранилище, а клиент, знающий хэш, может
+прикрепить файл вовсе без тела. Когда ссылок не осталось, blob удаляет не запрос, а сборщик
+мусора - не раньше чем через BLOB_GC_GRACE секунд, чтобы файл успели прикрепить заново.
+Файл пишется до commit, поэтому после отката транзакции он может остаться без строки; такие
+файлы старше BLOB_GC_GRACE сборщик тоже удаляет.
+
+    BLOB_GC_INTERVAL   период сборки мусора в воркере (с), 0 - выключено
+    BLOB_GC_GRACE      сколько хранить blob без ссылок (с)
+
+Вложения, сохранённые до появления blob'ов, остаются со своими ключами и content_hash = NULL;
+их файлы удаляются сразу вместе с вложением, как раньше.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import BigInteger, DateTime, Index, Integer, String, case, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, sessionmaker
+
+from common.storage import AttachmentStore, decode_legacy_content, get_store
+
+GC_INTERVAL = float(os.getenv("BLOB_GC_INTERVAL", "300"))
+GC_GRACE = timedelta(seconds=float(os.getenv("BLOB_GC_GRACE", "600")))
+GC_BATCH = 500
+
+log = logging.getLogger(__name__)
+
+
+class BlobBase(DeclarativeBase):
+    pass
+
+
+class AttachmentBlob(BlobBase):
+    __tablename__ = "attachment_blobs"
+    __table_args__ = (
+        Index("ix_attachment_blobs_namespace_released_at", "namespace", "released_at"),
+    )
+
+    namespace: Mapped[str] = mapped_column(String(20), primary_key=True)
+    hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    refcount: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # когда ушла последняя ссылка; по нему сборщик мусора отсчитывает BLOB_GC_GRACE
+    released_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_key(namespace: str, digest: str) -> str:
+    return f"{namespace}/blobs/{digest[:2]}/{digest}"
+
+
+def _blob(namespace: str, digest: str):
+    return (AttachmentBlob.namespace == namespace) & (AttachmentBlob.hash == digest)
+
+
+def acquire(db: Session, namespace: str, digest: str) -> Optional[int]:
+    """Ещё одна ссылка на известный blob; его размер или None, если такого содержимого нет."""
+    return db.execute(
+        update(AttachmentBlob)
+        .where(_blob(namespace, digest))
+        .values(refcount=AttachmentBlob.refcount + 1, released_at=None)
+        .returning(AttachmentBlob.size),
+        execution_options={"synchronize_session": False},
+    ).scalar()
+
+
+def _claim(db: Session, namespace: str, digest: str, size: int) -> bool:
+    """Ссылка на blob. True - строка только что вставлена и содержимое должен записать вызывающий.
+
+    Строка вставляется раньше, чем пишется файл: пока она не закоммичена, сборщик мусора
+    не может взять блокировку на этот хэш и не тронет файл (см. sweep_orphans).
+    """
+    while True:
+        if acquire(db, namespace, digest) is not None:
+            return False
+        try:
+            with db.begin_nested():
+                db.execute(insert(AttachmentBlob).values(
+                    namespace=namespace, hash=digest, size=size, refcount=1, created_at=datetime.utcnow(),
+                ))
+            return True
+        except IntegrityError:
+            # параллельный запрос вставил ту же строку; если он откатился, пробуем снова
+            continue
+
+
+def store_blob(db: Session, store: AttachmentStore, namespace: str, data: bytes) -> Tuple[str, int]:
+    """Содержимое из памяти: пишется, только если такого ещё нет. Возвращает (хэш, размер)."""
+    digest = content_hash(data)
+    if _claim(db, namespace, digest, len(data)):
+        store.save(blob_key(namespace, digest), [data])
+    return digest, len(data)
+
+
+def store_upload(db: Session, store: AttachmentStore, namespace: str, upload_id: str, digest: str) -> Tuple[str, int]:
+    """Готовая загрузка становится blob'ом; если такое содержимое уже есть, загрузка просто удаляется."""
+    size = store.upload_offset(upload_id)
+    if _claim(db, namespace, digest, size):
+        store.commit_upload(upload_id, blob_key(namespace, digest))
+    else:
+        store.abort_upload(upload_id)
+    return digest, size
+
+
+def store_stream(db: Session, store: AttachmentStore, namespace: str, chunks: Iterable[bytes]) -> Tuple[str, int]:
+    """Поток пишется во временную загрузку: хэш известен только после последнего байта."""
+    upload_id = store.create_upload()
+    digest = hashlib.sha256()
+    try:
+        with store.open_upload(upload_id) as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        store.abort_upload(upload_id)
+        raise
+    return store_upload(db, store, namespace, upload_id, digest.hexdigest())
+
+
+def store_json_file(db: Session, store: AttachmentStore, namespace: str, f) -> Tuple[str, int]:
+    """Файл из JSON-ручки: тело в content или ссылка на уже загруженное содержимое по content_hash."""
+    if f.content is not None:
+        return store_blob(db, store, namespace, decode_legacy_content(f.content))
+    size = acquire(db, namespace, f.content_hash)
+    if size is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Содержимое файла {f.name} не найдено, отправьте его целиком",
+        )
+    return f.content_hash, size
+
+
+def upload_hash(store: AttachmentStore, upload_id: str) -> str:
+    digest = hashlib.sha256()
+    for chunk in store.read_upload(upload_id):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def release(db: Session, namespace: str, attachments: Iterable) -> List[str]:
+    """Снимает ссылки удаляемых вложений на blob'ы.
+
+    Возвращает ключи старых вложений без content_hash: их файлы удаляются после commit.
+    """
+    refs = Counter()
+    legacy_keys = []
+    for attachment in attachments:
+        if attachment.content_hash:
+            refs[attachment.content_hash] += 1
+        else:
+            legacy_keys.append(attachment.storage_key)
+    now = datetime.utcnow()
+    for digest, count in refs.items():
+        db.execute(
+            update(AttachmentBlob)
+            .where(_blob(namespace, digest))
+            .values(
+                refcount=AttachmentBlob.refcount - count,
+                released_at=case((AttachmentBlob.refcount <= count, now), else_=AttachmentBlob.released_at),
+            ),
+            execution_options={"synchronize_session": False},
+        )
+    return legacy_keys
+
+
+def sweep_orphans(db: Session, store: AttachmentStore, namespace: str, cutoff: datetime, limit: int = GC_BATCH) -> int:
+    """Удаляет файлы blob'ов без строки в attachment_blobs, записанные раньше cutoff.
+
+    Перед удалением хэш блокируется вставкой временной строки (её снимает rollback), а время
+    записи файла проверяется заново. Запрос, который как раз пишет то же содержимое, уже вставил
+    свою строку - вставка сборщика ждёт его commit и получает IntegrityError; а следующий
+    запрос сам ждёт, пока сборщик не отпустит хэш, и пишет файл после удаления.
+    """
+    freed = 0
+    candidates = [
+        key for key, modified in store.list_keys(f"{namespace}/blobs")
+        if modified < cutoff and key == blob_key(namespace, key.rsplit("/", 1)[-1])
+    ]
+    for start in range(0, len(candidates), limit):
+        keys = {key.rsplit("/", 1)[-1]: key for key in candidates[start:start + limit]}
+        known = set(db.scalars(select(AttachmentBlob.hash).where(
+            AttachmentBlob.namespace == namespace, AttachmentBlob.hash.in_(list(keys)),
+        )))
+        db.rollback()
+        for digest, key in keys.items():
+            if digest in known:
+                continue
+            try:
+                db.execute(insert(AttachmentBlob).values(
+                    namespace=namespace, hash=digest, size=0, refcount=0, created_at=datetime.utcnow(),
+                ))
+            except (IntegrityError, OperationalError):
+                db.rollback()
+                continue
+            modified = store.modified(key)
+            if modified is not None and modified < cutoff:
+                store.delete(key)
+                freed += 1
+            db.rollback()
+    return freed
+
+
+def collect_garbage(
+    session_factory: sessionmaker,
+    store: AttachmentStore,
+    namespace: str,
+    grace: timedelta = GC_GRACE,
+    limit: int = GC_BATCH,
+) -> int:
+    """Удаляет до limit blob'ов, у которых дольше grace нет ссылок, и брошенные файлы; возвращает число удалённых файлов.
+
+    Файл удаляется только после commit удаления строки - если commit не прошёл, содержимое
+    остаётся. Сам файл удаляет sweep_orphans под блокировкой хэша.
+    """
+    cutoff = datetime.utcnow() - grace
+    unreferenced = (
+        (AttachmentBlob.namespace == namespace)
+        & (AttachmentBlob.refcount <= 0)
+        & (AttachmentBlob.released_at < cutoff)
+    )
+    with session_factory() as db:
+        digests = db.scalars(select(AttachmentBlob.hash).where(unreferenced).limit(limit)).all()
+        if digests:
+            db.execute(delete(AttachmentBlob).where(unreferenced & AttachmentBlob.hash.in_(digests)))
+            db.commit()
+        return sweep_orphans(db, store, namespace, cutoff, limit)
+
+
+async def run_garbage_collector(session_factory: sessionmaker, namespace: str, interval: float = GC_INTERVAL) -> None:
+    """Фоновая сборка мусора воркера; в нескольких воркерах каждый blob удалит только один."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            freed = await run_in_threadpool(collect_garbage, session_factory, get_store(), namespace)
+        except Exception:
+            log.exception("blob garbage collection failed for %s", namespace)
+            continue
+        if freed:
+            log.info("freed %d unreferenced %s blobs", freed, namespace)
@@ -0,0 +1,340 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import DateTime, Index, Integer, String, delete, func, insert, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column, sessionmaker
+
+from common.db import PGBOUNCER
+
+CHANNEL = "change_events"
+POLL_INTERVAL = float(os.getenv("CHANGEFEED_POLL_INTERVAL", "1.0"))
+HEARTBEAT_INTERVAL = 15.0
+QUEUE_SIZE = 1000
+REPLAY_LIMIT = 1000
+RETENTION = timedelta(hours=int(os.getenv("CHANGEFEED_RETENTION_HOURS", "24")))
+PRUNE_INTERVAL = float(os.getenv("CHANGEFEED_PRUNE_INTERVAL", "600"))
+COMMIT_WINDOW = timedelta(seconds=float(os.getenv("CHANGEFEED_COMMIT_WINDOW", "30")))
+RESCAN_INTERVAL = float(os.getenv("CHANGEFEED_RESCAN_INTERVAL", "5"))
+MAX_BACKOFF = 30.0
+
+log = logging.getLogger(__name__)
+
+
+class ChangeBase(DeclarativeBase):
+    pass
+
+
+class ChangeEvent(ChangeBase):
+    """Журнал изменений: из него догоняют отставших подписчиков и по нему опрашивают SQLite."""
+
+    __tablename__ = "change_events"
+    __table_args__ = (
+        Index("ix_change_events_type_id", "entity_type", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    ts: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    entity_type: Mapped[str] = mapped_column(String(20), nullable=False)
+    entity_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    action: Mapped[str] = mapped_column(String(20), nullable=False)
+
+
+def publish(db: Session, entity_type: str, entity_id: int, action: str) -> None:
+    publish_many(db, entity_type, [(entity_id, action)])
+
+
+def publish_many(db: Session, entity_type: str, changes: Sequence[Tuple[int, str]]) -> None:
+    """Пишет события в той же транзакции, что и само изменение; NOTIFY уйдёт только после commit."""
+    if not changes:
+        return
+    now = datetime.utcnow()
+    db.execute(insert(ChangeEvent), [
+        {"ts": now, "entity_type": entity_type, "entity_id": entity_id, "action": action}
+        for entity_id, action in changes
+    ])
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_notify(CHANNEL, entity_type)))
+
+
+def event_dict(event: ChangeEvent) -> Dict:
+    return {
+        "id": event.id,
+        "type": event.entity_type,
+        "entity_id": event.entity_id,
+        "action": event.action,
+        "ts": event.ts.isoformat(),
+    }
+
+
+def fetch_events(db: Session, entity_types: Sequence[str], after_id: int, limit: int = REPLAY_LIMIT) -> List[Dict]:
+    query = (
+        db.query(ChangeEvent)
+        .filter(ChangeEvent.entity_type.in_(entity_types), ChangeEvent.id > after_id)
+        .order_by(ChangeEvent.id)
+        .limit(limit)
+    )
+    return [event_dict(e) for e in query]
+
+
+RESET = {"type": "reset"}
+
+
+def format_sse(event: Dict) -> str:
+    if event.get("type") == "reset":
+        return "event: reset\ndata: {}\n\n"
+    return f"id: {event['id']}\nevent: change\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+class ChangeBroker:
+    """Один процесс - одно чтение журнала на пачку изменений, сколько бы ни было подписчиков.
+
+    В Postgres фоновая задача просыпается по LISTEN, в остальных СУБД опрашивает журнал раз в
+    POLL_INTERVAL. Подписчик, не успевающий разбирать очередь, получает событие reset и должен
+    перечитать данные целиком. Reset получают все подписчики и после сбоя чтения журнала.
+
+    Id события выдаётся при INSERT, а видно оно после COMMIT: в Postgres событие с меньшим id
+    может появиться позже большего. Каждое пробуждение читает только события новее последнего
+    отправленного, а раз в rescan_interval журнал перечитывается начиная с событий, отправленных
+    за последние COMMIT_WINDOW, - уже отправленные отбрасываются.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        entity_types: Iterable[str],
+        poll_interval: float = POLL_INTERVAL,
+        rescan_interval: float = RESCAN_INTERVAL,
+    ):
+        self.session_factory = session_factory
+        self.entity_types = tuple(entity_types)
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.subscribers: Set[asyncio.Queue] = set()
+        # все события с id <= last_id уже отправлены или считаются пропавшими (откат транзакции)
+        self.last_id = 0
+        # отправленные события с id > last_id и время отправки
+        self.sent: Dict[int, datetime] = {}
+        self._rescanned_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        if self._task is None or self._task.done():
+            last_id = await run_in_threadpool(self._max_id)
+            if self._task is None or self._task.done():
+                # задача упала при живых подписчиках: события с прошлого курсора им уже не дойдут
+                if self.subscribers:
+                    self.dispatch([RESET])
+                self.last_id, self.sent = last_id, {}
+                self._task = asyncio.create_task(self._run())
+        self.subscribers.add(queue)
+        return queue
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def dispatch(self, events: List[Dict]) -> None:
+        for queue in self.subscribers:
+            for event in events:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(RESET)
+                    break
+
+    def _max_id(self) -> int:
+        with self.session_factory() as db:
+            return db.scalar(select(func.max(ChangeEvent.id))) or 0
+
+    def _settle(self) -> None:
+        """Сдвигает last_id за события, отправленные раньше COMMIT_WINDOW; id идут по возрастанию."""
+        cutoff = datetime.utcnow() - COMMIT_WINDOW
+        for event_id in sorted(self.sent):
+            if self.sent[event_id] > cutoff:
+                break
+            del self.sent[event_id]
+            self.last_id = event_id
+
+    def _fetch(self) -> List[Dict]:
+        """Новые события, помеченные отправленными; окно опоздавших коммитов - раз в rescan_interval."""
+        self._settle()
+        after = max(self.sent, default=self.last_id)
+        if after > self.last_id and time.monotonic() - self._rescanned_at >= self.rescan_interval:
+            after, self._rescanned_at = self.last_id, time.monotonic()
+        fresh = []
+        with self.session_factory() as db:
+            while True:
+                events = fetch_events(db, self.entity_types, after)
+                fresh += [e for e in events if e["id"] not in self.sent]
+                if len(events) < REPLAY_LIMIT:
+                    break
+                after = events[-1]["id"]
+        now = datetime.utcnow()
+        self.sent.update((e["id"], now) for e in fresh)
+        return fresh
+
+    async def _run(self) -> None:
+        """Сбой БД или LISTEN-соединения не останавливает задачу: повтор с нарастающей паузой."""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        listener = None
+        connected = failed = False
+        backoff = 0.0
+
+        def disconnect():
+            nonlocal listener, connected
+            if listener is not None:
+                loop.remove_reader(listener.fileno())
+                listener.close()
+            listener, connected = None, False
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), backoff or self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                try:
+                    if not connected:
+                        listener = await run_in_threadpool(self._listen)
+                        connected = True
+                        if listener is not None:
+                            loop.add_reader(listener.fileno(), wakeup.set)
+                    if listener is not None:
+                        listener.poll()
+                        listener.notifies.clear()
+                    events = await run_in_threadpool(self._fetch)
+                except Exception:
+                    log.exception("change feed %s: reading the journal failed", ",".join(self.entity_types))
+                    disconnect()
+                    failed = True
+                    backoff = min(max(backoff * 2, self.poll_interval), MAX_BACKOFF)
+                    continue
+                if failed:
+                    # пока журнал не читался, события могли выйти за RETENTION или COMMIT_WINDOW
+                    self.dispatch([RESET])
+                    failed, backoff = False, 0.0
+                if events:
+                    self.dispatch(events)
+        finally:
+            disconnect()
+
+    def _listen(self):
+        """В Postgres - отдельное соединение вне пула с LISTEN; его сокет слушает цикл событий.
+
+        За PgBouncer в режиме transaction LISTEN не работает, там остаётся опрос журнала.
+        """
+        engine = self.session_factory.engine
+        if engine.dialect.name != "postgresql" or PGBOUNCER:
+            return None
+        proxied = engine.raw_connection()
+        proxied.detach()
+        connection = proxied.dbapi_connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        return connection
+
+
+def prune_events(session_factory: sessionmaker) -> int:
+    with session_factory() as db:
+        deleted = db.execute(delete(ChangeEvent).where(ChangeEvent.ts < datetime.utcnow() - RETENTION)).rowcount
+        db.commit()
+    return deleted
+
+
+async def run_event_pruner(session_factory: sessionmaker, interval: float = PRUNE_INTERVAL) -> None:
+    """Фоновая очистка журнала старше RETENTION; журнал общий, так что воркеры чистят его вперемешку."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(prune_events, session_factory)
+        except Exception:
+            log.exception("change feed pruning failed")
+
+
+async def watch_changes(broker: ChangeBroker, handle: Callable[[Dict], None], retry_interval: float = 5.0) -> None:
+    """Фоновая подписка воркера на ленту, например для сброса кэшей.
+
+    БД может быть недоступна при старте: подписка повторяется. Если задача брокера
+    завершилась, подписка оформляется заново. После каждой подписки handle получает reset -
+    события до неё могли быть пропущены.
+    """
+    while True:
+        try:
+            queue = await broker.subscribe()
+        except Exception:
+            handle(RESET)
+            await asyncio.sleep(retry_interval)
+            continue
+        try:
+            handle(RESET)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), retry_interval)
+                except asyncio.TimeoutError:
+                    if broker.running:
+                        continue
+                    log.warning("change feed %s: broker task stopped, resubscribing", ",".join(broker.entity_types))
+                    break
+                handle(event)
+        finally:
+            broker.unsubscribe(queue)
+
+
+async def event_stream(broker: ChangeBroker, request: Request, last_event_id: Optional[int]) -> AsyncIterator[str]:
+    """SSE-поток: сначала события после Last-Event-ID из журнала, затем живые из брокера."""
+    queue = await broker.subscribe()
+    try:
+        replayed: Set[int] = set()
+        if last_event_id is not None:
+            def replay():
+                with broker.session_factory() as db:
+                    return fetch_events(db, broker.entity_types, last_event_id, REPLAY_LIMIT + 1)
+
+            events = await run_in_threadpool(replay)
+            if len(events) > REPLAY_LIMIT:
+                yield format_sse(RESET)
+            else:
+                for event in events:
+                    yield format_sse(event)
+                    replayed.add(event["id"])
+        while not await request.is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            # id сравниваются поштучно: брокер может прислать опоздавшее событие с меньшим id
+            if event.get("id") in replayed:
+                continue
+            yield format_sse(event)
+    finally:
+        broker.unsubscribe(queue)
+
+
+def sse_response(broker: ChangeBroker, request: Request, last_event_id: Optional[str]) -> StreamingResponse:
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        event_stream(broker, request, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,237 @@
+"""Единая настройка подключений к БД для всех сервисов.
+
+Пул настраивается переменными окружения:
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT   размер пула, сверх пула, ожидание соединения (с)
+    DB_POOL_RECYCLE                                  пересоздавать соединения старше N секунд
+    DB_POOL_PRE_PING                                 проверять соединение перед выдачей (1/0)
+    DB_STATEMENT_TIMEOUT_MS                          statement_timeout в Postgres, 0 - без ограничения
+    DB_PGBOUNCER                                     1 - работа через PgBouncer в режиме transaction
+
+Под PgBouncer нельзя передавать параметры при подключении и держать состояние сессии, поэтому
+таймаут ставится через SET LOCAL в начале каждой транзакции, asyncpg не кэширует подготовленные
+выражения и даёт им уникальные имена, а лента изменений вместо LISTEN опрашивает журнал.
+"""
+import os
+import threading
+import time
+from uuid import uuid4
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import Engine, create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+SHARED_ENGINE_NAME = "shared"
+
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+_engines: List[Tuple[str, Engine]] = []
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+class _WaitStatsMixin:
+    """Сколько запросы ждут свободное соединение: время внутри _do_get пула."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.wait_stats.record(time.perf_counter() - started, timed_out)
+
+
+class InstrumentedQueuePool(_WaitStatsMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(_WaitStatsMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _is_postgres(url: str) -> bool:
+    return make_url(url).get_backend_name() == "postgresql"
+
+
+def _pool_options(url: str, poolclass) -> Dict:
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return {}
+    options = {
+        "poolclass": poolclass,
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+    }
+    if _is_postgres(url):
+        options.update(pool_recycle=POOL_RECYCLE, pool_pre_ping=POOL_PRE_PING)
+    return options
+
+
+def _set_local_timeout(engine: Engine) -> None:
+    @event.listens_for(engine, "begin")
+    def set_statement_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
+
+
+def create_db_engine(url: str, name: str = "default") -> Engine:
+    options = _pool_options(url, InstrumentedQueuePool)
+    if _is_postgres(url) and STATEMENT_TIMEOUT_MS and not PGBOUNCER:
+        options["connect_args"] = {"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"}
+    engine = create_engine(url, echo=False, **options)
+    if _is_postgres(url) and STATEMENT_TIMEOUT_MS and PGBOUNCER:
+        _set_local_timeout(engine)
+    _engines.append((name, engine))
+    return engine
+
+
+def async_url(url: str) -> str:
+    """postgresql+psycopg2://... -> postgresql+asyncpg://..., sqlite:///... -> sqlite+aiosqlite:///..."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver for {backend}")
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+
+def create_async_db_engine(url: str, name: str = "default") -> AsyncEngine:
+    if _is_postgres(url):
+        options = _pool_options(url, InstrumentedAsyncQueuePool)
+        if PGBOUNCER:
+            # asyncpg всё равно готовит безымянные выражения, а имена по счётчику у разных
+            # клиентов совпадают на одном серверном соединении PgBouncer
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+            }
+        elif STATEMENT_TIMEOUT_MS:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(STATEMENT_TIMEOUT_MS)}}
+    else:
+        # соединение aiosqlite привязано к циклу событий, в котором открыто, поэтому без пула
+        options = {"poolclass": NullPool}
+    engine = create_async_engine(async_url(url), **options)
+    if _is_postgres(url) and STATEMENT_TIMEOUT_MS and PGBOUNCER:
+        _set_local_timeout(engine.sync_engine)
+    _engines.append((f"{name}.async", engine.sync_engine))
+    return engine
+
+
+class _LazyBind:
+    """Движок создаётся при первой сессии, а не при импорте модели: импорт не трогает БД."""
+
+    def __init__(self, create_engine: Callable, url: str, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.name = name
+        self.shared_with: "_LazyBind | None" = None
+        self._create_engine = create_engine
+        self._bind_lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self.kw.get("bind") is None:
+            with self._bind_lock:
+                if self.kw.get("bind") is None:
+                    self.configure(bind=self._create_bind())
+        return self.kw["bind"]
+
+    def _create_bind(self):
+        if self.shared_with is not None:
+            return self.shared_with.engine
+        return self._create_engine(self.url, self.name)
+
+    def __call__(self, **local_kw):
+        self.engine
+        return super().__call__(**local_kw)
+
+
+class LazySessionMaker(_LazyBind, sessionmaker):
+    pass
+
+
+class LazyAsyncSessionMaker(_LazyBind, async_sessionmaker):
+    pass
+
+
+def create_session_factory(url: str, name: str = "default") -> LazySessionMaker:
+    return LazySessionMaker(create_db_engine, url, name, autoflush=False)
+
+
+def create_async_session_factory(url: str, name: str = "default") -> LazyAsyncSessionMaker:
+    return LazyAsyncSessionMaker(create_async_db_engine, url, name, autoflush=False, expire_on_commit=False)
+
+
+def share_engines(factories: Iterable[_LazyBind], name: str = SHARED_ENGINE_NAME) -> None:
+    """Фабрики одного типа с одинаковым URL получают общий движок и, значит, один пул.
+
+    Для нескольких сервисов в одном процессе; вызывать до первой сессии любой из фабрик.
+    """
+    owners: Dict[Tuple[type, str], _LazyBind] = {}
+    for factory in factories:
+        owner = owners.setdefault((type(factory), factory.url), factory)
+        if owner is factory:
+            factory.name = name
+        else:
+            factory.shared_with = owner
+
+
+def pool_stats(engine: Engine) -> Dict:
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        })
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats is not None:
+        checkouts = wait_stats.checkouts or 1
+        stats.update({
+            "checkouts": wait_stats.checkouts,
+            "timeouts": wait_stats.timeouts,
+            "wait_avg_ms": wait_stats.wait_total / checkouts * 1000,
+            "wait_max_ms": wait_stats.wait_max * 1000,
+        })
+    return stats
+
+
+def pool_report() -> Dict:
+    return {name: pool_stats(engine) for name, engine in _engines}
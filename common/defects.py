@@ -0,0 +1,9 @@
+"""Правила дефектов, общие для defects_service и projects_service (он читает таблицу defects напрямую)."""
+from datetime import date
+
+CLOSED_STATUS = "Закрыта"
+
+
+def overdue_condition(defects, today: date):
+    """Просрочен: срок задан, уже прошёл, а дефект не закрыт. defects - таблица или её table()-описание."""
+    return (defects.c.due != "") & (defects.c.due < today.isoformat()) & (defects.c.status != CLOSED_STATUS)
@@ -0,0 +1,50 @@
+import re
+import zlib
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm.exc import StaleDataError
+
+_ETAG_RE = re.compile(r'^(?:W/)?"([a-z_]+)-(\w+)-v(\d+)(?:-[0-9a-f]+)?"$')
+
+
+def make_etag(kind: str, entity_id, version: int, variant: str = "") -> str:
+    """Сильный ETag версии объекта; variant различает представления (например, набор fields=)."""
+    tag = f"{kind}-{entity_id}-v{version}"
+    if variant:
+        tag += f"-{zlib.crc32(variant.encode()):08x}"
+    return f'"{tag}"'
+
+
+def _tags(header: str):
+    return [t.strip() for t in header.split(",") if t.strip()]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any(t == "*" or (t[2:] if t.startswith("W/") else t) == bare for t in _tags(if_none_match))
+
+
+def check_if_match(if_match: Optional[str], kind: str, entity_id, version: int) -> None:
+    """If-Match сверяется с версией объекта, независимо от представления, из которого взят ETag."""
+    if not if_match:
+        return
+    for tag in _tags(if_match):
+        if tag == "*":
+            return
+        match = _ETAG_RE.match(tag)
+        if tag.startswith("W/") or not match:
+            continue
+        if match.group(1) == kind and match.group(2) == str(entity_id) and int(match.group(3)) == version:
+            return
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Объект был изменён")
+
+
+async def stale_data_handler(request: Request, exc: StaleDataError) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": "Объект был изменён параллельным запросом"},
+    )
@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from typing import Callable, Iterator, Literal
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Query, Session
+
+EXPORT_BATCH = 1000
+
+ExportFormat = Literal["ndjson", "csv"]
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _encode(rows: list, columns: list, fmt: str) -> bytes:
+    if fmt == "ndjson":
+        lines = (json.dumps(dict(zip(columns, map(_plain, row))), ensure_ascii=False) for row in rows)
+        return ("\n".join(lines) + "\n").encode()
+    buf = io.StringIO()
+    csv.writer(buf).writerows([_plain(v) for v in row] for row in rows)
+    return buf.getvalue().encode()
+
+
+def iter_export(session_factory: Callable[[], Session], build_query: Callable[[Session], Query], fmt: str) -> Iterator[bytes]:
+    """Читает строки серверным курсором пачками по EXPORT_BATCH и сразу отдаёт их клиенту.
+
+    Сессия своя: зависимость get_db закрывается раньше, чем StreamingResponse дочитает генератор.
+    """
+    db = session_factory()
+    try:
+        query = build_query(db).yield_per(EXPORT_BATCH)
+        columns = [c["name"] for c in query.column_descriptions]
+        if fmt == "csv":
+            yield _encode([columns], columns, fmt)
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) >= EXPORT_BATCH:
+                yield _encode(batch, columns, fmt)
+                batch = []
+        if batch:
+            yield _encode(batch, columns, fmt)
+    finally:
+        db.close()
+
+
+def export_response(rows: Iterator[bytes], fmt: str, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        rows,
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
@@ -0,0 +1,46 @@
+"""Быстрый путь ответа для чтения: ORM-строки сразу в dict и в orjson, без повторной валидации pydantic.
+
+Годится только для доверенных строк из своей БД. Эндпоинт подключается явно - возвращает
+json_response(...); response_model остаётся для схемы OpenAPI, но ответ через него не проходит.
+"""
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+class RowSerializer:
+    """Поля объекта по заранее известному списку; вложенные списки - своими сериализаторами."""
+
+    def __init__(self, fields: Sequence[str], nested: Optional[Mapping[str, "RowSerializer"]] = None):
+        self.nested = dict(nested or {})
+        self.fields = tuple(fields)
+        self._plan = self._make_plan(self.fields)
+
+    @classmethod
+    def from_schema(cls, schema: type[BaseModel], **nested: "RowSerializer") -> "RowSerializer":
+        return cls(list(schema.model_fields), nested)
+
+    def _make_plan(self, fields: Sequence[str]) -> Tuple[Tuple[str, Optional["RowSerializer"]], ...]:
+        return tuple((name, self.nested.get(name)) for name in fields)
+
+    def __call__(self, obj: Any, fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        return self._apply(self._plan if fields is None else self._make_plan(fields), obj)
+
+    def many(self, objs, fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        plan = self._plan if fields is None else self._make_plan(fields)
+        return [self._apply(plan, obj) for obj in objs]
+
+    @staticmethod
+    def _apply(plan, obj) -> Dict[str, Any]:
+        out = {}
+        for name, child in plan:
+            value = getattr(obj, name)
+            if child is not None and value is not None:
+                value = [child(v) for v in value]
+            out[name] = value
+        return out
+
+
+def json_response(content: Any, status_code: int = 200, headers: Optional[Mapping[str, str]] = None) -> ORJSONResponse:
+    return ORJSONResponse(content, status_code=status_code, headers=dict(headers) if headers else None)
@@ -0,0 +1,30 @@
+"""Служебные ручки (/metrics, /db/pool): пулы, маршруты и нагрузка не для посторонних глаз.
+
+Доступ открыт с loopback (curl изнутри контейнера) или с заголовком Authorization: Bearer <INTERNAL_TOKEN>;
+Prometheus передаёт его через authorization в scrape_config. Если INTERNAL_TOKEN не задан,
+остаётся только loopback. По адресу клиента частные сети не пропускаются: за проброшенным портом
+Docker все запросы снаружи приходят с адреса шлюза bridge-сети.
+"""
+import hmac
+import ipaddress
+import os
+
+from fastapi import HTTPException, Request, status
+
+INTERNAL_TOKEN = os.getenv("INTERNAL_TOKEN", "")
+
+
+def is_internal(request: Request) -> bool:
+    if INTERNAL_TOKEN:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), INTERNAL_TOKEN.encode()):
+            return True
+    try:
+        return request.client is not None and ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+def require_internal(request: Request) -> None:
+    if not is_internal(request):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Служебная ручка недоступна")
@@ -0,0 +1,206 @@
+"""Метрики Prometheus и журнал медленных запросов для всех сервисов.
+
+Подключение в main.py:
+
+    app.add_middleware(MetricsMiddleware, service="defects")
+    app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+Переменные окружения:
+
+    SLOW_REQUEST_MS            запросы дольше порога пишутся в журнал slow_requests, 0 - выключено
+    PROMETHEUS_MULTIPROC_DIR   общий каталог метрик для нескольких воркеров uvicorn
+
+Запросы к БД считаются по событиям движков SQLAlchemy и относятся к HTTP-запросу через
+contextvars, поэтому работают и для sync-эндпоинтов в пуле потоков, и для AsyncSession.
+"""
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import Engine, event
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from common.db import pool_report
+from common.internal import is_internal
+
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_MS", "500")) / 1000
+UNMATCHED_ROUTE = "unmatched"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки запроса",
+    ["service", "method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Запросы в обработке",
+    ["service"], multiprocess_mode="livesum",
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Размер тела ответа",
+    ["service", "method", "route"], buckets=SIZE_BUCKETS,
+)
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Запросов к БД на один HTTP-запрос",
+    ["service", "method", "route"], buckets=QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_seconds", "Время в БД на один HTTP-запрос",
+    ["service", "method", "route"], buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES = Counter("db_queries", "Запросы к БД, включая фоновые задачи")
+STREAMS_OPEN = Gauge(
+    "http_streams_open", "Открытые SSE-потоки",
+    ["service", "route"], multiprocess_mode="livesum",
+)
+
+slow_log = logging.getLogger("slow_requests")
+
+
+@dataclass
+class RequestStats:
+    db_queries: int = 0
+    db_seconds: float = 0.0
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    DB_QUERIES.inc()
+    stats = _current.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+@event.listens_for(Engine, "handle_error")
+def _query_failed(context):
+    conn = context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+class PoolCollector:
+    """Состояние пулов соединений этого процесса на момент опроса, из common.db.pool_report."""
+
+    def collect(self):
+        checkouts = CounterMetricFamily("db_pool_checkouts", "Выдачи соединений из пула", labels=["engine"])
+        timeouts = CounterMetricFamily("db_pool_checkout_timeouts", "Не дождались соединения", labels=["engine"])
+        wait = CounterMetricFamily("db_pool_checkout_wait_seconds", "Суммарное ожидание соединения", labels=["engine"])
+        wait_max = GaugeMetricFamily("db_pool_checkout_wait_max_seconds", "Самое долгое ожидание соединения", labels=["engine"])
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Соединения на руках", labels=["engine"])
+        size = GaugeMetricFamily("db_pool_size", "Размер пула", labels=["engine"])
+        for name, stats in pool_report().items():
+            if "checkouts" in stats:
+                checkouts.add_metric([name], stats["checkouts"])
+                timeouts.add_metric([name], stats["timeouts"])
+                wait.add_metric([name], stats["wait_avg_ms"] * stats["checkouts"] / 1000)
+                wait_max.add_metric([name], stats["wait_max_ms"] / 1000)
+            if "size" in stats:
+                checked_out.add_metric([name], stats["checked_out"])
+                size.add_metric([name], stats["size"])
+        return [checkouts, timeouts, wait, wait_max, checked_out, size]
+
+
+REGISTRY.register(PoolCollector())
+
+
+def is_event_stream(message: Message) -> bool:
+    return any(
+        name.lower() == b"content-type" and value.startswith(b"text/event-stream")
+        for name, value in message.get("headers", [])
+    )
+
+
+class MetricsMiddleware:
+    """Латентность, размер ответа и запросы к БД по шаблону маршрута, а не по сырому пути.
+
+    SSE-поток живёт минутами и часами: с начала ответа он уходит из in-flight в http_streams_open
+    и не попадает ни в латентность, ни в журнал медленных запросов.
+    """
+
+    def __init__(self, app: ASGIApp, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status_code = 500
+        size = 0
+        in_flight = IN_FLIGHT.labels(self.service)
+        stream = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, size, stream
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if is_event_stream(message):
+                    in_flight.dec()
+                    stream = STREAMS_OPEN.labels(self.service, getattr(scope.get("route"), "path", UNMATCHED_ROUTE))
+                    stream.inc()
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            if stream is not None:
+                stream.dec()
+            else:
+                in_flight.dec()
+                self.observe(scope, status_code, size, elapsed, stats)
+
+    def observe(self, scope: Scope, status_code: int, size: int, elapsed: float, stats: RequestStats) -> None:
+        route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+        method = scope["method"]
+        REQUEST_LATENCY.labels(self.service, method, route, str(status_code)).observe(elapsed)
+        RESPONSE_SIZE.labels(self.service, method, route).observe(size)
+        REQUEST_DB_QUERIES.labels(self.service, method, route).observe(stats.db_queries)
+        REQUEST_DB_TIME.labels(self.service, method, route).observe(stats.db_seconds)
+        if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+            query = scope.get("query_string", b"").decode("latin-1")
+            slow_log.warning(
+                "%s %s%s -> %s in %.0f ms, %d db queries / %.0f ms, %d bytes",
+                method, scope["path"], f"?{query}" if query else "", status_code,
+                elapsed * 1000, stats.db_queries, stats.db_seconds * 1000, size,
+            )
+
+
+def metrics_endpoint(request: Request) -> Response:
+    if not is_internal(request):
+        return Response(status_code=403)
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # счётчики всех воркеров из общего каталога; пулы - только ответившего воркера
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        registry.register(PoolCollector())
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
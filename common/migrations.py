@@ -0,0 +1,126 @@
+"""Обновление схемы существующей БД: bootstrap каждого сервиса вызывает upgrade_schema.
+
+create_all создаёт только недостающие таблицы. upgrade_schema вдобавок добавляет в уже
+существующие таблицы новые колонки моделей (ALTER TABLE ... ADD COLUMN) и недостающие индексы (CREATE INDEX IF NOT EXISTS).
+Каждый шаг сверяется с текущей схемой, поэтому повторный запуск ничего не меняет.
+
+Перенос данных из старых колонок - шаги migrate_legacy_* в bootstrap сервисов: они читают
+колонки, которых больше нет в моделях, через iter_legacy_rows и удаляют их после переноса.
+"""
+from datetime import datetime
+from typing import Iterable, Iterator, List, Mapping, Optional, Sequence
+
+from sqlalchemy import JSON, Column, DateTime, Engine, Integer, MetaData, Table, column, inspect, select, table, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+
+from common.blobs import blob_key, store_blob
+from common.storage import AttachmentStore, decode_legacy_content
+
+
+def _fill_value(column: Column):
+    """Значение для уже существующих строк: default колонки из модели, если он есть."""
+    default = column.default
+    if default is None:
+        return None
+    if default.is_callable:
+        return default.arg(None)
+    return default.arg if default.is_scalar else None
+
+
+def add_missing_columns(conn: Connection, table: Table) -> List[str]:
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    preparer = conn.dialect.identifier_preparer
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        table_name, column_name = preparer.format_table(table), preparer.format_column(column)
+        column_type = column.type.compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+        value = _fill_value(column)
+        if value is not None:
+            conn.execute(update(table).values({column.name: value}))
+            # SQLite не умеет менять NOT NULL у существующей колонки; там она остаётся nullable
+            if not column.nullable and conn.dialect.name == "postgresql":
+                conn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column_name} SET NOT NULL"))
+        added.append(column.name)
+    return added
+
+
+def create_missing_indexes(conn: Connection, table: Table) -> None:
+    # CREATE INDEX IF NOT EXISTS, а не сверка с инспектором: индексы по выражениям он не видит
+    for index in table.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def upgrade_schema(engine: Engine, metadatas: Iterable[MetaData]) -> None:
+    with engine.begin() as conn:
+        for metadata in metadatas:
+            metadata.create_all(conn)
+            for table in metadata.sorted_tables:
+                add_missing_columns(conn, table)
+                create_missing_indexes(conn, table)
+
+
+def existing_columns(conn: Connection, table_name: str, names: Sequence[str]) -> List[str]:
+    columns = {c["name"] for c in inspect(conn).get_columns(table_name)}
+    return [name for name in names if name in columns]
+
+
+def drop_columns(conn: Connection, table_name: str, names: Sequence[str]) -> None:
+    preparer = conn.dialect.identifier_preparer
+    for name in names:
+        conn.execute(text(f"ALTER TABLE {preparer.quote(table_name)} DROP COLUMN {preparer.quote(name)}"))
+
+
+def iter_legacy_rows(db: Session, table_name: str, json_columns: Sequence[str], batch: int = 500) -> Iterator[List[Mapping]]:
+    """Пачки строк (id, created_at и JSON-колонки) по возрастанию id."""
+    legacy = table(table_name, column("id", Integer), column("created_at", DateTime), *(column(name, JSON) for name in json_columns))
+    last_id = 0
+    while True:
+        rows = db.execute(select(legacy).where(legacy.c.id > last_id).order_by(legacy.c.id).limit(batch)).mappings().all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]["id"]
+
+
+def parse_legacy_ts(value, fallback: Optional[datetime]) -> Optional[datetime]:
+    """Время из старых JSON-записей (ISO-строка); если его нет или оно битое - fallback."""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return fallback
+
+
+def legacy_history(owner_key: str, owner_id: int, entries, created_at: Optional[datetime]) -> List[dict]:
+    return [
+        {
+            owner_key: owner_id,
+            "ts": parse_legacy_ts(entry.get("ts"), created_at),
+            "action": str(entry.get("action") or "")[:50],
+            "payload": entry.get("payload") or {},
+        }
+        for entry in entries or []
+    ]
+
+
+def legacy_attachments(
+    db: Session, store: AttachmentStore, namespace: str, owner_key: str, owner_id: int, entries, created_at: Optional[datetime],
+) -> List[dict]:
+    """Вложения из JSON-колонки (содержимое в base64, data URL или текстом) становятся blob'ами."""
+    rows = []
+    for entry in entries or []:
+        digest, size = store_blob(db, store, namespace, decode_legacy_content(entry.get("content") or ""))
+        rows.append({
+            owner_key: owner_id,
+            "name": str(entry.get("name") or "file")[:255],
+            "size": size,
+            "type": (entry.get("type") or None) and str(entry["type"])[:255],
+            "storage_key": blob_key(namespace, digest),
+            "content_hash": digest,
+            "created_at": created_at,
+        })
+    return rows
@@ -0,0 +1,40 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from fastapi import HTTPException, status
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, selectinload
+
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str], default: Sequence[str]) -> List[str]:
+    """Разбирает ?fields=a,b,c; id выдаётся всегда."""
+    if not fields:
+        return list(default)
+    requested = []
+    for name in fields.split(","):
+        name = name.strip()
+        if name and name not in requested:
+            requested.append(name)
+    unknown = [name for name in requested if name not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Неизвестные поля: {', '.join(unknown)}",
+        )
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return requested
+
+
+def load_options(model: type, fields: Sequence[str], always: Sequence[str] = ()) -> list:
+    """Опции запроса: невостребованные колонки откладываются, связи грузятся одним SELECT ... IN."""
+    mapper = inspect(model)
+    columns = [getattr(model, name) for name in [*always, *fields] if name in mapper.column_attrs]
+    options = [load_only(*columns)]
+    for name in fields:
+        if name in mapper.relationships:
+            options.append(selectinload(getattr(model, name)))
+    return options
+
+
+def pick_fields(obj: Any, fields: Sequence[str]) -> Dict[str, Any]:
+    return {name: getattr(obj, name) for name in fields}
@@ -0,0 +1,285 @@
+import html
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import DDL, Index, Integer, String, Text, UniqueConstraint, event, func, insert, literal_column, select
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+
+TS_CONFIG = "russian"
+SNIPPET_RADIUS = 60
+MAX_TERM_LENGTH = 100
+REINDEX_BATCH = 1000
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchBase(DeclarativeBase):
+    pass
+
+
+class SearchDocument(SearchBase):
+    __tablename__ = "search_documents"
+    __table_args__ = (
+        UniqueConstraint("entity_type", "entity_id", name="uq_search_documents_entity"),
+        Index("ix_search_documents_parent", "entity_type", "parent_id"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    entity_type: Mapped[str] = mapped_column(String(20), nullable=False)
+    entity_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    parent_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    title: Mapped[str] = mapped_column(Text, nullable=False, default="")
+    body: Mapped[str] = mapped_column(Text, nullable=False, default="")
+    length: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class SearchPosting(SearchBase):
+    """Инвертированный индекс для SQLite и тестов; в Postgres вместо него работает GIN по tsvector."""
+
+    __tablename__ = "search_postings"
+
+    term: Mapped[str] = mapped_column(String(MAX_TERM_LENGTH), primary_key=True)
+    document_id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    tf: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+_DOCUMENT_TEXT = "coalesce(title, '') || ' ' || coalesce(body, '')"
+_DOCUMENT_TSV = literal_column(f"to_tsvector('{TS_CONFIG}'::regconfig, {_DOCUMENT_TEXT})")
+
+event.listen(
+    SearchDocument.__table__,
+    "after_create",
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_search_documents_tsv ON search_documents "
+        f"USING gin (to_tsvector('{TS_CONFIG}'::regconfig, {_DOCUMENT_TEXT}))"
+    ).execute_if(dialect="postgresql"),
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t[:MAX_TERM_LENGTH] for t in _TOKEN_RE.findall((text or "").lower())]
+
+
+def _uses_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def index_document(
+    db: Session,
+    entity_type: str,
+    entity_id: int,
+    title: str,
+    body: str,
+    parent_id: Optional[int] = None,
+) -> None:
+    """Добавляет или обновляет один документ индекса; остальной индекс не трогается."""
+    doc = (
+        db.query(SearchDocument)
+        .filter(SearchDocument.entity_type == entity_type, SearchDocument.entity_id == entity_id)
+        .first()
+    )
+    if doc is None:
+        doc = SearchDocument(entity_type=entity_type, entity_id=entity_id)
+        db.add(doc)
+    terms = tokenize(f"{title or ''} {body or ''}")
+    doc.parent_id = parent_id
+    doc.title = title or ""
+    doc.body = body or ""
+    doc.length = len(terms)
+    db.flush()
+
+    if _uses_postgres(db):
+        return
+    db.query(SearchPosting).filter(SearchPosting.document_id == doc.id).delete()
+    postings = [{"term": term, "document_id": doc.id, "tf": tf} for term, tf in Counter(terms).items()]
+    if postings:
+        db.execute(SearchPosting.__table__.insert(), postings)
+
+
+def index_new_documents(db: Session, entity_type: str, docs: Sequence[Dict]) -> None:
+    """Пакетно индексирует новые сущности: один INSERT документов и один INSERT постингов."""
+    if not docs:
+        return
+    rows = []
+    for doc in docs:
+        terms = tokenize(f"{doc.get('title') or ''} {doc.get('body') or ''}")
+        rows.append({
+            "entity_type": entity_type,
+            "entity_id": doc["entity_id"],
+            "parent_id": doc.get("parent_id"),
+            "title": doc.get("title") or "",
+            "body": doc.get("body") or "",
+            "length": len(terms),
+            "terms": terms,
+        })
+    stmt = insert(SearchDocument).returning(SearchDocument.id, sort_by_parameter_order=True)
+    doc_ids = db.scalars(stmt, [{k: v for k, v in row.items() if k != "terms"} for row in rows]).all()
+
+    if _uses_postgres(db):
+        return
+    postings = [
+        {"term": term, "document_id": doc_id, "tf": tf}
+        for doc_id, row in zip(doc_ids, rows)
+        for term, tf in Counter(row["terms"]).items()
+    ]
+    if postings:
+        db.execute(SearchPosting.__table__.insert(), postings)
+
+
+def reindex_documents(db: Session, entity_type: str, docs: Sequence[Dict]) -> None:
+    """Пакетная переиндексация изменённых сущностей: одно удаление старых документов и index_new_documents."""
+    if not docs:
+        return
+    remove_documents(db, entity_type, entity_ids=[doc["entity_id"] for doc in docs])
+    index_new_documents(db, entity_type, docs)
+
+
+def rebuild_index(db: Session, entity_type: str, docs: Iterable[Dict]) -> int:
+    """Полная переиндексация сущностей одного типа пачками по REINDEX_BATCH; транзакцией управляет вызывающий код."""
+    remove_documents(db, entity_type)
+    count = 0
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= REINDEX_BATCH:
+            index_new_documents(db, entity_type, batch)
+            count += len(batch)
+            batch = []
+    index_new_documents(db, entity_type, batch)
+    return count + len(batch)
+
+
+def has_documents(db: Session, entity_type: str) -> bool:
+    return db.query(SearchDocument.id).filter(SearchDocument.entity_type == entity_type).first() is not None
+
+
+def remove_documents(
+    db: Session,
+    entity_type: str,
+    entity_id: Optional[int] = None,
+    parent_id: Optional[int] = None,
+    entity_ids: Optional[Sequence[int]] = None,
+    parent_ids: Optional[Sequence[int]] = None,
+) -> None:
+    query = db.query(SearchDocument.id).filter(SearchDocument.entity_type == entity_type)
+    if entity_id is not None:
+        query = query.filter(SearchDocument.entity_id == entity_id)
+    if parent_id is not None:
+        query = query.filter(SearchDocument.parent_id == parent_id)
+    if entity_ids is not None:
+        query = query.filter(SearchDocument.entity_id.in_(entity_ids))
+    if parent_ids is not None:
+        query = query.filter(SearchDocument.parent_id.in_(parent_ids))
+    doc_ids = query.scalar_subquery()
+    if not _uses_postgres(db):
+        db.query(SearchPosting).filter(SearchPosting.document_id.in_(doc_ids)).delete(synchronize_session=False)
+    db.query(SearchDocument).filter(SearchDocument.id.in_(doc_ids)).delete(synchronize_session=False)
+
+
+def search(
+    db: Session,
+    q: str,
+    entity_types: Optional[Sequence[str]] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> Tuple[List[Dict], bool]:
+    """Ранжированный поиск; возвращает страницу попаданий и признак наличия следующей."""
+    if _uses_postgres(db):
+        return _search_postgres(db, q, entity_types, limit, offset)
+    return _search_postings(db, q, entity_types, limit, offset)
+
+
+def _hit(doc: SearchDocument, rank: float, snippet: str) -> Dict:
+    return {
+        "entity_type": doc.entity_type,
+        "entity_id": doc.entity_id,
+        "parent_id": doc.parent_id,
+        "title": doc.title,
+        "snippet": snippet,
+        "rank": rank,
+    }
+
+
+def _search_postgres(db, q, entity_types, limit, offset):
+    query = func.websearch_to_tsquery(literal_column(f"'{TS_CONFIG}'::regconfig"), q)
+    rank = func.ts_rank(_DOCUMENT_TSV, query)
+    escaped = literal_column(
+        f"replace(replace(replace({_DOCUMENT_TEXT}, '&', '&amp;'), '<', '&lt;'), '>', '&gt;')"
+    )
+    snippet = func.ts_headline(
+        literal_column(f"'{TS_CONFIG}'::regconfig"),
+        escaped,
+        query,
+        "StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5",
+    )
+    stmt = select(SearchDocument, rank.label("rank"), snippet.label("snippet")).where(_DOCUMENT_TSV.op("@@")(query))
+    if entity_types:
+        stmt = stmt.where(SearchDocument.entity_type.in_(entity_types))
+    stmt = stmt.order_by(rank.desc(), SearchDocument.id).offset(offset).limit(limit + 1)
+    rows = db.execute(stmt).all()
+    hits = [_hit(doc, float(r), s) for doc, r, s in rows[:limit]]
+    return hits, len(rows) > limit
+
+
+def _search_postings(db, q, entity_types, limit, offset):
+    terms = list(dict.fromkeys(tokenize(q)))
+    if not terms:
+        return [], False
+
+    postings: Dict[int, Dict[str, int]] = {}
+    df: Counter = Counter()
+    for term, document_id, tf in db.query(SearchPosting.term, SearchPosting.document_id, SearchPosting.tf).filter(
+        SearchPosting.term.in_(terms)
+    ):
+        postings.setdefault(document_id, {})[term] = tf
+        df[term] += 1
+    candidates = [doc_id for doc_id, found in postings.items() if len(found) == len(terms)]
+    if not candidates:
+        return [], False
+
+    doc_query = db.query(SearchDocument.id, SearchDocument.length).filter(SearchDocument.id.in_(candidates))
+    if entity_types:
+        doc_query = doc_query.filter(SearchDocument.entity_type.in_(entity_types))
+    lengths = dict(doc_query.all())
+    n_docs, avg_length = db.query(func.count(SearchDocument.id), func.avg(SearchDocument.length)).one()
+    avg_length = float(avg_length or 1) or 1.0
+
+    def bm25(doc_id: int) -> float:
+        score = 0.0
+        for term, tf in postings[doc_id].items():
+            idf = math.log(1 + (n_docs - df[term] + 0.5) / (df[term] + 0.5))
+            norm = tf + 1.2 * (1 - 0.75 + 0.75 * lengths[doc_id] / avg_length)
+            score += idf * tf * 2.2 / norm
+        return score
+
+    ranked = sorted(((bm25(doc_id), doc_id) for doc_id in lengths), key=lambda r: (-r[0], r[1]))
+    page = ranked[offset:offset + limit]
+    docs = {d.id: d for d in db.query(SearchDocument).filter(SearchDocument.id.in_([d for _, d in page]))}
+    hits = []
+    for score, doc_id in page:
+        doc = docs[doc_id]
+        hits.append(_hit(doc, score, highlight(f"{doc.title} {doc.body}", terms)))
+    return hits, len(ranked) > offset + limit
+
+
+def highlight(text: str, terms: Sequence[str]) -> str:
+    """Фрагмент вокруг первого совпадения; найденные слова обёрнуты в <mark>."""
+    matches = [m for m in _TOKEN_RE.finditer(text) if m.group().lower()[:MAX_TERM_LENGTH] in terms]
+    if not matches:
+        return html.escape(text[: SNIPPET_RADIUS * 2])
+    start = max(matches[0].start() - SNIPPET_RADIUS, 0)
+    end = min(matches[0].end() + SNIPPET_RADIUS, len(text))
+    parts = []
+    pos = start
+    for m in matches:
+        if m.start() < start or m.end() > end:
+            continue
+        parts.append(html.escape(text[pos:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group())}</mark>")
+        pos = m.end()
+    parts.append(html.escape(text[pos:end]))
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    return prefix + "".join(parts).strip() + suffix
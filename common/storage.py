@@ -0,0 +1,295 @@
+import asyncio
+import base64
+import binascii
+import fcntl
+import os
+import re
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, Iterator, Optional, Tuple, Type
+from urllib.parse import quote
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+
+CHUNK_SIZE = 1024 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class UploadBusy(Exception):
+    pass
+
+
+class AttachmentStore(ABC):
+    """Хранилище содержимого вложений; в строках БД остаются только метаданные.
+
+    open_upload открывает загрузку на дозапись с позиции её конца и держит исключительную
+    блокировку, пока файл не закрыт; если загрузку уже дописывает другой процесс - UploadBusy.
+    """
+
+    @abstractmethod
+    def save(self, key: str, chunks: Iterable[bytes]) -> int:
+        ...
+
+    @abstractmethod
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        ...
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def list_keys(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        """Ключи с префиксом и время последней записи (UTC)."""
+
+    @abstractmethod
+    def modified(self, key: str) -> Optional[datetime]:
+        """Время последней записи (UTC) или None, если ключа нет."""
+
+    @abstractmethod
+    def create_upload(self) -> str:
+        ...
+
+    @abstractmethod
+    def upload_offset(self, upload_id: str) -> int:
+        ...
+
+    @abstractmethod
+    def open_upload(self, upload_id: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def read_upload(self, upload_id: str) -> Iterator[bytes]:
+        ...
+
+    @abstractmethod
+    def commit_upload(self, upload_id: str, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def abort_upload(self, upload_id: str) -> None:
+        ...
+
+
+class LocalFileStore(AttachmentStore):
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.uploads_root = os.path.join(self.root, ".uploads")
+        os.makedirs(self.uploads_root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"invalid storage key: {key!r}")
+        return path
+
+    def _upload_path(self, upload_id: str) -> str:
+        uuid.UUID(upload_id)
+        return os.path.join(self.uploads_root, upload_id)
+
+    def save(self, key: str, chunks: Iterable[bytes]) -> int:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return size
+
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self._path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def modified(self, key: str) -> Optional[datetime]:
+        try:
+            return datetime.utcfromtimestamp(os.path.getmtime(self._path(key)))
+        except FileNotFoundError:
+            return None
+
+    def list_keys(self, prefix: str) -> Iterator[Tuple[str, datetime]]:
+        for directory, _, names in os.walk(self._path(prefix)):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    modified = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, "/"), datetime.utcfromtimestamp(modified)
+
+    def create_upload(self) -> str:
+        upload_id = str(uuid.uuid4())
+        open(self._upload_path(upload_id), "wb").close()
+        return upload_id
+
+    def upload_offset(self, upload_id: str) -> int:
+        return os.path.getsize(self._upload_path(upload_id))
+
+    def open_upload(self, upload_id: str) -> BinaryIO:
+        f = open(self._upload_path(upload_id), "ab")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise UploadBusy(upload_id)
+        return f
+
+    def read_upload(self, upload_id: str) -> Iterator[bytes]:
+        with open(self._upload_path(upload_id), "rb") as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+    def commit_upload(self, upload_id: str, key: str) -> int:
+        source = self._upload_path(upload_id)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(source)
+        os.replace(source, path)
+        # время записи - момент фиксации, а не последней дозаписи: по нему сборщик мусора
+        # отличает ещё не закоммиченный blob от брошенного
+        os.utime(path)
+        return size
+
+    def abort_upload(self, upload_id: str) -> None:
+        try:
+            os.remove(self._upload_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+
+BACKENDS: Dict[str, Type[AttachmentStore]] = {
+    "local": LocalFileStore,
+}
+
+_store: Optional[AttachmentStore] = None
+
+
+def get_store() -> AttachmentStore:
+    global _store
+    if _store is None:
+        backend = os.getenv("ATTACHMENTS_BACKEND", "local")
+        if backend not in BACKENDS:
+            raise RuntimeError(f"Unknown ATTACHMENTS_BACKEND: {backend}")
+        _store = BACKENDS[backend](os.getenv("ATTACHMENTS_DIR", "data/attachments"))
+    return _store
+
+
+_upload_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+async def append_to_upload(store: AttachmentStore, upload_id: str, size: int, offset: int, chunks: AsyncIterator[bytes]) -> int:
+    """Дописывает тело запроса в загрузку с позиции offset; возвращает новое смещение.
+
+    Запросы к одной загрузке в воркере идут по очереди, между воркерами их разводит блокировка
+    open_upload. Смещение сверяется уже под блокировкой, поэтому два PATCH с одним Upload-Offset
+    не запишут данные дважды. Файловые операции - в пуле потоков.
+    """
+    lock = _upload_locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        try:
+            f = await run_in_threadpool(store.open_upload, upload_id)
+        except UploadBusy:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Загрузка уже дописывается другим запросом")
+        try:
+            current = await run_in_threadpool(f.tell)
+            if offset != current:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Ожидалось смещение {current}")
+            async for chunk in chunks:
+                if current + len(chunk) > size:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail="Данных больше, чем заявлено",
+                    )
+                await run_in_threadpool(f.write, chunk)
+                current += len(chunk)
+        finally:
+            await run_in_threadpool(f.close)
+    return current
+
+
+def new_key(prefix: str) -> str:
+    return f"{prefix}/{uuid.uuid4().hex}"
+
+
+def decode_legacy_content(content: str) -> bytes:
+    """Содержимое из JSON-ручек: data URL, base64 или обычный текст."""
+    if content.startswith("data:") and ";base64," in content:
+        content = content.split(",", 1)[1]
+    try:
+        return base64.b64decode(content, validate=True)
+    except (binascii.Error, ValueError):
+        return content.encode()
+
+
+def content_response(
+    store: AttachmentStore,
+    key: str,
+    size: int,
+    media_type: Optional[str],
+    filename: str,
+    range_header: Optional[str] = None,
+) -> Response:
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+    }
+    media_type = media_type or "application/octet-stream"
+
+    match = _RANGE_RE.match(range_header.strip()) if range_header else None
+    if not match or not (match.group(1) or match.group(2)):
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(store.read(key), media_type=media_type, headers=headers)
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Некорректный диапазон",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        store.read(key, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,101 @@
+"""Схема и служебные данные defects_service; запускается при выкладке, а не при старте воркера.
+
+    python -m defects_service.bootstrap
+    python -m defects_service.bootstrap --rebuild-counters --reindex
+"""
+import argparse
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from common.blobs import BlobBase
+from common.changefeed import ChangeBase
+from common.migrations import (
+    drop_columns, existing_columns, iter_legacy_rows, legacy_attachments, legacy_history, upgrade_schema,
+)
+from common.search import SearchBase, has_documents, rebuild_index
+from common.storage import get_store
+from defects_service.model import (
+    BLOB_NAMESPACE, Base, Defect, DefectAttachment, DefectComment, DefectCounter, DefectHistory, SessionLocal,
+)
+from defects_service.stats import TOTAL, rebuild_counters
+
+
+def create_schema() -> None:
+    upgrade_schema(SessionLocal.engine, (Base.metadata, SearchBase.metadata, ChangeBase.metadata, BlobBase.metadata))
+
+
+LEGACY_COLUMNS = ("attachments", "comments", "history")
+
+
+def legacy_comment_time(comment: dict, fallback: datetime) -> datetime:
+    # id старых комментариев - время создания в миллисекундах
+    try:
+        return datetime.utcfromtimestamp(int(comment["id"]) / 1000)
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        return fallback
+
+
+def migrate_legacy_json(db: Session) -> int:
+    """Переносит JSON-колонки defects.attachments/comments/history в отдельные таблицы.
+
+    Содержимое старых вложений пишется в хранилище blob'ами. Колонки удаляются в той же
+    транзакции, поэтому повторный запуск ничего не делает.
+    """
+    columns = existing_columns(db.connection(), "defects", LEGACY_COLUMNS)
+    if not columns:
+        return 0
+    store = get_store()
+    moved = 0
+    for rows in iter_legacy_rows(db, "defects", columns):
+        attachments, comments, history = [], [], []
+        for row in rows:
+            attachments += legacy_attachments(
+                db, store, BLOB_NAMESPACE, "defect_id", row["id"], row.get("attachments"), row["created_at"],
+            )
+            comments += [
+                {"defect_id": row["id"], "text": str(c.get("text") or ""), "created_at": legacy_comment_time(c, row["created_at"])}
+                for c in row.get("comments") or []
+            ]
+            history += legacy_history("defect_id", row["id"], row.get("history"), row["created_at"])
+        for model, values in ((DefectAttachment, attachments), (DefectComment, comments), (DefectHistory, history)):
+            if values:
+                db.execute(insert(model), values)
+        moved += len(rows)
+    drop_columns(db.connection(), "defects", columns)
+    return moved
+
+
+def bootstrap(force_counters: bool = False, force_reindex: bool = False) -> None:
+    """Создаёт таблицы; счётчики и поисковый индекс пересобираются, если их нет или если попросили."""
+    create_schema()
+    with SessionLocal() as db:
+        migrated = migrate_legacy_json(db)
+        if force_counters or db.get(DefectCounter, TOTAL) is None:
+            rebuild_counters(db)
+        has_defects = db.query(Defect.id).first() is not None
+        if force_reindex or migrated or (has_defects and not has_documents(db, "defect")):
+            rebuild_index(db, "defect", (
+                {"entity_id": i, "title": title, "body": desc}
+                for i, title, desc in db.query(Defect.id, Defect.title, Defect.desc).yield_per(1000)
+            ))
+            rebuild_index(db, "comment", (
+                {"entity_id": i, "title": "", "body": text, "parent_id": defect_id}
+                for i, defect_id, text in db.query(DefectComment.id, DefectComment.defect_id, DefectComment.text).yield_per(1000)
+            ))
+        db.commit()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Создание схемы defects_service")
+    parser.add_argument("--rebuild-counters", action="store_true", help="пересчитать счётчики статистики")
+    parser.add_argument("--reindex", action="store_true", help="пересобрать поисковый индекс дефектов и комментариев")
+    args = parser.parse_args(argv)
+    bootstrap(args.rebuild_counters, args.reindex)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,73 +1,438 @@
-from datetime import datetime
-from typing import List
+import io
+from collections import Counter
+from datetime import date, datetime
+from typing import List, Literal, Optional, Tuple
 
-from fastapi import Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import Depends, File, Header, HTTPException, Query, Request, Response, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Query as OrmQuery, Session
 from fastapi import APIRouter
 
-from defects_service.model import Defect, get_db
-from defects_service.schemas import DefectOut, StatsOut, DefectCreate, DefectUpdate, StatusUpdate, CommentCreate, AttachmentsAdd
+from common.blobs import blob_key, release, store_json_file, store_stream, store_upload, upload_hash
+from common.changefeed import REPLAY_LIMIT, ChangeBroker, fetch_events, publish, publish_many, sse_response
+from common.etag import check_if_match, etag_matches, make_etag
+from common.export import ExportFormat, export_response, iter_export
+from common.fastjson import json_response
+from common.pagination import decode_cursor, encode_cursor, keyset_page
+from common.projection import load_options, parse_fields
+from common.search import index_document, reindex_documents, remove_documents, search
+from common.storage import CHUNK_SIZE, append_to_upload, content_response, get_store
+from defects_service.importer import detect_format, import_stream, insert_defects, new_defect_values
+from defects_service.model import (
+    BLOB_NAMESPACE,
+    Defect,
+    DefectAttachment,
+    DefectComment,
+    DefectHistory,
+    DefectUpload,
+    SessionLocal,
+    get_async_db,
+    get_db,
+)
+from defects_service.projects import check_projects
+from defects_service.schemas import (
+    AttachmentOut,
+    BulkCreate,
+    BulkDelete,
+    BulkItemResult,
+    BulkResult,
+    BulkStatusUpdate,
+    BulkUpdate,
+    ChangePage,
+    Comment,
+    CommentPage,
+    DEFECT_FIELDS,
+    DEFECT_SUMMARY_FIELDS,
+    DefectOut,
+    DefectPage,
+    DefectPartial,
+    HistoryPage,
+    ImportResult,
+    SearchPage,
+    StatsOut,
+    DefectCreate,
+    DefectUpdate,
+    StatusUpdate,
+    CommentCreate,
+    AttachmentsAdd,
+    UploadCreate,
+    UploadOut,
+    comment_row,
+    defect_row,
+    history_row,
+)
+from defects_service.stats import (
+    apply_deltas,
+    count_row,
+    facet_values,
+    grouped_counts,
+    stats_from_counters,
+    stats_from_groups,
+    track_change,
+)
 
 app = APIRouter()
 
+changes = ChangeBroker(SessionLocal, ["defect"])
 
-def add_history(defect: Defect, action: str, payload: dict) -> None:
-    entry = {
-        "ts": datetime.utcnow().isoformat(),
-        "action": action,
-        "payload": payload,
-    }
-    history = list(defect.history or [])
-    history.append(entry)
-    defect.history = history
+SortKey = Literal["-created_at", "created_at", "-id", "id"]
+SearchType = Literal["defect", "comment", "project"]
+DEFECT_VARIANT = ",".join(DEFECT_FIELDS)
+EXPORT_COLUMNS = [
+    Defect.id,
+    Defect.title,
+    Defect.desc,
+    Defect.status,
+    Defect.priority,
+    Defect.assignee,
+    Defect.due,
+    Defect.project_id,
+    Defect.created_at,
+    Defect.updated_at,
+]
 
+SORTS = {
+    "-created_at": (Defect.created_at, True),
+    "created_at": (Defect.created_at, False),
+    "-id": (Defect.id, True),
+    "id": (Defect.id, False),
+}
 
-@app.get("/defects", response_model=List[DefectOut])
-def list_defects(db: Session = Depends(get_db)):
-    items = db.query(Defect).order_by(Defect.id.desc()).all()
-    return items
+
+class DefectFilters:
+    """Фильтры списка дефектов; каждый опирается на индекс модели Defect."""
+
+    def __init__(
+        self,
+        status: Optional[List[str]] = Query(None),
+        priority: Optional[List[str]] = Query(None),
+        assignee: Optional[List[str]] = Query(None),
+        project_id: Optional[List[int]] = Query(None),
+        due_from: Optional[date] = None,
+        due_to: Optional[date] = None,
+    ):
+        self.status = status
+        self.priority = priority
+        self.assignee = assignee
+        self.project_id = project_id
+        self.due_from = due_from
+        self.due_to = due_to
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.status or self.priority or self.assignee or self.project_id or self.due_from or self.due_to)
+
+    def apply(self, query: OrmQuery) -> OrmQuery:
+        if self.status:
+            query = query.filter(Defect.status.in_(self.status))
+        if self.priority:
+            query = query.filter(Defect.priority.in_(self.priority))
+        if self.assignee:
+            query = query.filter(Defect.assignee.in_(self.assignee))
+        if self.project_id:
+            query = query.filter(Defect.project_id.in_(self.project_id))
+        if self.due_from or self.due_to:
+            query = query.filter(Defect.due.isnot(None), Defect.due != "")
+        if self.due_from:
+            query = query.filter(Defect.due >= self.due_from.isoformat())
+        if self.due_to:
+            query = query.filter(Defect.due <= self.due_to.isoformat())
+        return query
+
+
+def paginate(query: OrmQuery, sort: str, cursor: Optional[str], limit: int) -> Tuple[List[Defect], Optional[str]]:
+    column, descending = SORTS[sort]
+    columns = [column] if column is Defect.id else [column, Defect.id]
+
+    if cursor:
+        values = decode_cursor(cursor)
+        keys = values[1:]
+        # последний ключ всегда id: подделанное ["id", "x"] должно давать 400, а не ошибку сравнения в БД
+        if len(values) != len(columns) + 1 or values[0] != sort or type(keys[-1]) is not int:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+        if column is Defect.created_at:
+            try:
+                keys[0] = datetime.fromisoformat(keys[0])
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+        left = tuple_(*columns) if len(columns) > 1 else columns[0]
+        right = tuple_(*keys) if len(keys) > 1 else keys[0]
+        query = query.filter(left < right if descending else left > right)
+
+    query = query.order_by(*[c.desc() if descending else c.asc() for c in columns])
+    items = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        keys = [getattr(last, c.key) for c in columns]
+        keys = [k.isoformat() if isinstance(k, datetime) else k for k in keys]
+        next_cursor = encode_cursor([sort, *keys])
+    return items, next_cursor
+
+
+def add_history(db: Session, defect: Defect, action: str, payload: dict) -> None:
+    """Каждая запись истории заодно уходит подписчикам ленты изменений."""
+    db.add(DefectHistory(defect_id=defect.id, action=action, payload=payload))
+    publish(db, "defect", defect.id, action)
+
+
+def add_history_bulk(db: Session, entries: List[dict]) -> None:
+    if entries:
+        db.execute(insert(DefectHistory), entries)
+        publish_many(db, "defect", [(e["defect_id"], e["action"]) for e in entries])
+
+
+def touch(db: Session, defect: Defect) -> None:
+    """Изменение связанных строк тоже меняет версию дефекта и, значит, его ETag.
+
+    Версия растёт атомарным UPDATE без сверки со старой: параллельные изменения связанных
+    строк друг другу не мешают, а If-Match на сам дефект после них уже не совпадёт.
+    """
+    db.execute(
+        update(Defect).where(Defect.id == defect.id).values(version=Defect.version + 1, updated_at=datetime.utcnow()),
+        execution_options={"synchronize_session": False},
+    )
+
+
+@app.get("/defects", response_model=DefectPage, response_model_exclude_unset=True)
+async def list_defects(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    sort: SortKey = "-created_at",
+    fields: Optional[str] = None,
+    filters: DefectFilters = Depends(),
+    db: AsyncSession = Depends(get_async_db),
+):
+    selected = parse_fields(fields, DEFECT_FIELDS, DEFECT_SUMMARY_FIELDS)
+
+    def load(session: Session) -> dict:
+        query = filters.apply(session.query(Defect)).options(*load_options(Defect, selected, always=["created_at"]))
+        items, next_cursor = paginate(query, sort, cursor, limit)
+        return {"items": defect_row.many(items, selected), "next_cursor": next_cursor}
+
+    return json_response(await db.run_sync(load))
 
 
 @app.get("/defects/stats", response_model=StatsOut)
-def get_stats(db: Session = Depends(get_db)):
-    total = db.query(Defect).count()
-    closed = db.query(Defect).filter(Defect.status == "Закрыта").count()
-    return StatsOut(total=total, closed=closed)
+async def get_stats(filters: DefectFilters = Depends(), db: AsyncSession = Depends(get_async_db)):
+    def load(session: Session) -> StatsOut:
+        if filters.is_empty:
+            return StatsOut(**stats_from_counters(session))
+        defects = filters.apply(session.query(Defect)).subquery()
+        return StatsOut(**stats_from_groups(session.execute(grouped_counts(defects))))
+
+    return await db.run_sync(load)
+
+
+@app.get("/defects/export")
+def export_defects(format: ExportFormat = "ndjson", filters: DefectFilters = Depends()):
+    def build_query(db: Session) -> OrmQuery:
+        return filters.apply(db.query(*EXPORT_COLUMNS)).order_by(Defect.id)
 
+    return export_response(iter_export(SessionLocal, build_query, format), format, "defects")
 
-@app.get("/defects/{defect_id}", response_model=DefectOut)
-def get_defect(defect_id: int, db: Session = Depends(get_db)):
-    d = db.query(Defect).filter(Defect.id == defect_id).first()
+
+@app.get("/defects/changes", response_model=ChangePage)
+async def list_changes(
+    after: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=REPLAY_LIMIT),
+    db: AsyncSession = Depends(get_async_db),
+):
+    items = await db.run_sync(fetch_events, ["defect"], after, limit)
+    return ChangePage(items=items, last_id=items[-1]["id"] if items else after)
+
+
+@app.get("/defects/changes/stream")
+async def stream_changes(request: Request, last_event_id: Optional[str] = Header(None)):
+    return sse_response(changes, request, last_event_id)
+
+
+@app.get("/search", response_model=SearchPage)
+async def search_all(
+    q: str = Query(..., min_length=1),
+    type: Optional[List[SearchType]] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_db),
+):
+    hits, has_more = await db.run_sync(search, q, type, limit, offset)
+    return SearchPage(items=hits, next_offset=offset + limit if has_more else None)
+
+
+@app.get("/defects/{defect_id}", response_model=DefectPartial, response_model_exclude_unset=True)
+async def get_defect(
+    defect_id: int,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    selected = parse_fields(fields, DEFECT_FIELDS, DEFECT_FIELDS)
+    variant = ",".join(selected)
+    if if_none_match:
+        version = await db.scalar(select(Defect.version).where(Defect.id == defect_id))
+        etag = make_etag("defect", defect_id, version, variant)
+        if version is not None and etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    d = await db.scalar(
+        select(Defect)
+        .options(*load_options(Defect, selected, always=["version"]))
+        .where(Defect.id == defect_id)
+    )
     if not d:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
-    return d
+    return json_response(defect_row(d, selected), headers={"ETag": make_etag("defect", d.id, d.version, variant)})
 
 
 @app.post("/defects", response_model=DefectOut, status_code=status.HTTP_201_CREATED)
-def create_defect(payload: DefectCreate, db: Session = Depends(get_db)):
-    now = datetime.utcnow().isoformat()
-    defect = Defect(
-        title=payload.title.strip(),
-        desc=(payload.desc or "").strip(),
-        status="Новая",
-        priority=payload.priority or "Средний",
-        assignee=(payload.assignee or "").strip(),
-        due=payload.due or "",
-        attachments=[],
-        comments=[],
-        history=[{"ts": now, "action": "create", "payload": payload.model_dump()}],
-    )
+def create_defect(payload: DefectCreate, response: Response, db: Session = Depends(get_db)):
+    check_projects(db, [payload.project_id])
+    defect = Defect(**new_defect_values(payload))
     db.add(defect)
+    db.flush()
+    add_history(db, defect, "create", payload.model_dump())
+    track_change(db, None, facet_values(defect))
+    index_document(db, "defect", defect.id, defect.title, defect.desc)
     db.commit()
     db.refresh(defect)
+    response.headers["ETag"] = make_etag("defect", defect.id, defect.version, DEFECT_VARIANT)
     return defect
 
 
+@app.post("/defects/bulk", response_model=BulkResult, status_code=status.HTTP_201_CREATED)
+def bulk_create_defects(payload: BulkCreate, db: Session = Depends(get_db)):
+    check_projects(db, [item.project_id for item in payload.items])
+    ids = insert_defects(db, payload.items)
+    db.commit()
+    return BulkResult(results=[BulkItemResult(id=defect_id, ok=True) for defect_id in ids])
+
+
+@app.post("/defects/import", response_model=ImportResult)
+def import_defects(
+    file: UploadFile = File(...),
+    format: Optional[ExportFormat] = None,
+    db: Session = Depends(get_db),
+):
+    fmt = format or detect_format(file.filename, file.content_type)
+    stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    try:
+        return import_stream(db, stream, fmt)
+    finally:
+        stream.detach()
+
+
+def bulk_change(db: Session, ids: List[int], changes: dict, action: str) -> BulkResult:
+    """Один UPDATE ... WHERE id IN (...) для всех найденных дефектов и пакетная запись истории."""
+    ids = list(dict.fromkeys(ids))
+    columns = [
+        Defect.id, Defect.title, Defect.desc, Defect.status, Defect.priority, Defect.assignee, Defect.due, Defect.project_id,
+    ]
+    found = {row.id: row._asdict() for row in db.execute(select(*columns).where(Defect.id.in_(ids)))}
+
+    if found and changes:
+        db.execute(
+            update(Defect)
+            .where(Defect.id.in_(list(found)))
+            .values(**changes, version=Defect.version + 1, updated_at=datetime.utcnow()),
+            execution_options={"synchronize_session": False},
+        )
+        now = datetime.utcnow()
+        deltas = Counter()
+        entries, docs = [], []
+        for defect_id, before in found.items():
+            after = {**before, **changes}
+            count_row(deltas, before, -1)
+            count_row(deltas, after, 1)
+            if action == "status":
+                history = {"from": before["status"], "to": changes["status"]}
+            else:
+                history = {"before": {k: v for k, v in before.items() if k != "id"}, "after": changes}
+            entries.append({"defect_id": defect_id, "ts": now, "action": action, "payload": history})
+            if "title" in changes or "desc" in changes:
+                docs.append({"entity_id": defect_id, "title": after["title"], "body": after["desc"]})
+        add_history_bulk(db, entries)
+        reindex_documents(db, "defect", docs)
+        apply_deltas(db, deltas)
+        db.commit()
+
+    return BulkResult(results=[
+        BulkItemResult(id=defect_id, ok=True) if defect_id in found
+        else BulkItemResult(id=defect_id, ok=False, error="Дефект не найден")
+        for defect_id in ids
+    ])
+
+
+@app.post("/defects/bulk/update", response_model=BulkResult)
+def bulk_update_defects(payload: BulkUpdate, db: Session = Depends(get_db)):
+    check_projects(db, [payload.changes.project_id])
+    return bulk_change(db, payload.ids, payload.changes.model_dump(exclude_unset=True), "update")
+
+
+@app.post("/defects/bulk/status", response_model=BulkResult)
+def bulk_update_status(payload: BulkStatusUpdate, db: Session = Depends(get_db)):
+    return bulk_change(db, payload.ids, {"status": payload.status}, "status")
+
+
+@app.post("/defects/bulk/delete", response_model=BulkResult)
+def bulk_delete_defects(payload: BulkDelete, db: Session = Depends(get_db)):
+    ids = list(dict.fromkeys(payload.ids))
+    columns = [Defect.id, Defect.status, Defect.priority, Defect.assignee]
+    found = {row.id: row._asdict() for row in db.execute(select(*columns).where(Defect.id.in_(ids)))}
+
+    keys = []
+    upload_ids = []
+    if found:
+        found_ids = list(found)
+        attachments = db.execute(
+            select(DefectAttachment.storage_key, DefectAttachment.content_hash)
+            .where(DefectAttachment.defect_id.in_(found_ids))
+        ).all()
+        keys = release(db, BLOB_NAMESPACE, attachments)
+        upload_ids = db.scalars(select(DefectUpload.id).where(DefectUpload.defect_id.in_(found_ids))).all()
+        for model in (DefectAttachment, DefectUpload, DefectComment, DefectHistory):
+            db.execute(
+                delete(model).where(model.defect_id.in_(found_ids)),
+                execution_options={"synchronize_session": False},
+            )
+        remove_documents(db, "defect", entity_ids=found_ids)
+        remove_documents(db, "comment", parent_ids=found_ids)
+        db.execute(delete(Defect).where(Defect.id.in_(found_ids)), execution_options={"synchronize_session": False})
+        publish_many(db, "defect", [(defect_id, "delete") for defect_id in found_ids])
+        deltas = Counter()
+        for row in found.values():
+            count_row(deltas, row, -1)
+        apply_deltas(db, deltas)
+        db.commit()
+
+    store = get_store()
+    for key in keys:
+        store.delete(key)
+    for upload_id in upload_ids:
+        store.abort_upload(upload_id)
+    return BulkResult(results=[
+        BulkItemResult(id=defect_id, ok=True) if defect_id in found
+        else BulkItemResult(id=defect_id, ok=False, error="Дефект не найден")
+        for defect_id in ids
+    ])
+
+
 @app.patch("/defects/{defect_id}", response_model=DefectOut)
-def update_defect(defect_id: int, payload: DefectUpdate, db: Session = Depends(get_db)):
+def update_defect(
+    defect_id: int,
+    payload: DefectUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    check_if_match(if_match, "defect", defect.id, defect.version)
+    check_projects(db, [payload.project_id])
 
     before = {
         "title": defect.title,
@@ -76,43 +441,114 @@ def update_defect(defect_id: int, payload: DefectUpdate, db: Session = Depends(g
         "assignee": defect.assignee,
         "due": defect.due,
         "status": defect.status,
+        "project_id": defect.project_id,
     }
 
     data = payload.model_dump(exclude_unset=True)
     for field, value in data.items():
         setattr(defect, field, value)
 
-    add_history(defect, "update", {"before": before, "after": data})
+    add_history(db, defect, "update", {"before": before, "after": data})
+    track_change(db, before, facet_values(defect))
+    if "title" in data or "desc" in data:
+        index_document(db, "defect", defect.id, defect.title, defect.desc)
     db.commit()
     db.refresh(defect)
+    response.headers["ETag"] = make_etag("defect", defect.id, defect.version, DEFECT_VARIANT)
     return defect
 
 
 @app.patch("/defects/{defect_id}/status", response_model=DefectOut)
-def update_status(defect_id: int, payload: StatusUpdate, db: Session = Depends(get_db)):
+def update_status(
+    defect_id: int,
+    payload: StatusUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    check_if_match(if_match, "defect", defect.id, defect.version)
     before = defect.status
+    counted = facet_values(defect)
     defect.status = payload.status
-    add_history(defect, "status", {"from": before, "to": payload.status})
+    add_history(db, defect, "status", {"from": before, "to": payload.status})
+    track_change(db, counted, facet_values(defect))
     db.commit()
     db.refresh(defect)
+    response.headers["ETag"] = make_etag("defect", defect.id, defect.version, DEFECT_VARIANT)
     return defect
 
 
-@app.post("/defects/{defect_id}/comments", response_model=DefectOut)
+@app.post("/defects/{defect_id}/comments", response_model=Comment, status_code=status.HTTP_201_CREATED)
 def add_comment(defect_id: int, payload: CommentCreate, db: Session = Depends(get_db)):
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
-    comments = list(defect.comments or [])
-    comment_id = int(datetime.utcnow().timestamp() * 1000)
-    comment = {"id": comment_id, "text": payload.text}
-    comments.append(comment)
-    defect.comments = comments
-    add_history(defect, "comment", {"text": payload.text})
+    comment = DefectComment(defect_id=defect.id, text=payload.text)
+    db.add(comment)
+    db.flush()
+    index_document(db, "comment", comment.id, "", comment.text, parent_id=defect.id)
+    add_history(db, defect, "comment", {"text": payload.text})
+    touch(db, defect)
+    db.commit()
+    db.refresh(comment)
+    return comment
+
+
+@app.get("/defects/{defect_id}/comments", response_model=CommentPage)
+async def list_comments(
+    defect_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    def load(session: Session):
+        query = session.query(DefectComment).filter(DefectComment.defect_id == defect_id)
+        return keyset_page(query, DefectComment.id, cursor, limit)
+
+    items, next_cursor = await db.run_sync(load)
+    return json_response({"items": comment_row.many(items), "next_cursor": next_cursor})
+
+
+@app.get("/defects/{defect_id}/history", response_model=HistoryPage)
+async def list_history(
+    defect_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    def load(session: Session):
+        query = session.query(DefectHistory).filter(DefectHistory.defect_id == defect_id)
+        return keyset_page(query, DefectHistory.id, cursor, limit)
+
+    items, next_cursor = await db.run_sync(load)
+    return json_response({"items": history_row.many(items), "next_cursor": next_cursor})
+
+
+def new_attachment(defect_id: int, name: str, type: Optional[str], digest: str, size: int) -> DefectAttachment:
+    return DefectAttachment(
+        defect_id=defect_id,
+        name=name,
+        size=size,
+        type=type,
+        storage_key=blob_key(BLOB_NAMESPACE, digest),
+        content_hash=digest,
+    )
+
+
+def detach(db: Session, defect: Defect, attachments: List[DefectAttachment], details: dict) -> Defect:
+    """Вложения удаляются сразу, их содержимое - сборщиком мусора, когда на него не останется ссылок."""
+    for a in attachments:
+        db.delete(a)
+    keys = release(db, BLOB_NAMESPACE, attachments)
+    add_history(db, defect, "detach", details)
+    touch(db, defect)
     db.commit()
+    store = get_store()
+    for key in keys:
+        store.delete(key)
     db.refresh(defect)
     return defect
 
@@ -122,34 +558,175 @@ def add_attachments(defect_id: int, payload: AttachmentsAdd, db: Session = Depen
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
-    attachments = list(defect.attachments or [])
-    attachments.extend([f.model_dump() for f in payload.files])
-    defect.attachments = attachments
-    add_history(defect, "attach", {"count": len(payload.files)})
+    store = get_store()
+    for f in payload.files:
+        digest, size = store_json_file(db, store, BLOB_NAMESPACE, f)
+        db.add(new_attachment(defect.id, f.name, f.type, digest, size))
+    add_history(db, defect, "attach", {"count": len(payload.files)})
+    touch(db, defect)
     db.commit()
     db.refresh(defect)
     return defect
 
 
+@app.post(
+    "/defects/{defect_id}/attachments/upload",
+    response_model=List[AttachmentOut],
+    status_code=status.HTTP_201_CREATED,
+)
+def upload_attachments(defect_id: int, files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
+    defect = db.query(Defect).filter(Defect.id == defect_id).first()
+    if not defect:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    store = get_store()
+    items = []
+    for f in files:
+        digest, size = store_stream(db, store, BLOB_NAMESPACE, iter(lambda: f.file.read(CHUNK_SIZE), b""))
+        item = new_attachment(defect.id, f.filename or "file", f.content_type, digest, size)
+        db.add(item)
+        items.append(item)
+    add_history(db, defect, "attach", {"count": len(files)})
+    touch(db, defect)
+    db.commit()
+    return items
+
+
+@app.get("/defects/{defect_id}/attachments/{attachment_id}/content")
+def download_attachment(
+    defect_id: int,
+    attachment_id: int,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    db: Session = Depends(get_db),
+):
+    item = (
+        db.query(DefectAttachment)
+        .filter(DefectAttachment.id == attachment_id, DefectAttachment.defect_id == defect_id)
+        .first()
+    )
+    if not item:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Вложение не найдено")
+    return content_response(get_store(), item.storage_key, item.size, item.type, item.name, range_header)
+
+
+@app.post("/defects/{defect_id}/uploads", response_model=UploadOut, status_code=status.HTTP_201_CREATED)
+def create_upload(defect_id: int, payload: UploadCreate, db: Session = Depends(get_db)):
+    defect = db.query(Defect).filter(Defect.id == defect_id).first()
+    if not defect:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    upload = DefectUpload(
+        id=get_store().create_upload(),
+        defect_id=defect.id,
+        name=payload.name,
+        size=payload.size,
+        type=payload.type,
+    )
+    db.add(upload)
+    db.commit()
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=0)
+
+
+def get_upload(db: Session, defect_id: int, upload_id: str) -> DefectUpload:
+    upload = (
+        db.query(DefectUpload)
+        .filter(DefectUpload.id == upload_id, DefectUpload.defect_id == defect_id)
+        .first()
+    )
+    if not upload:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Загрузка не найдена")
+    return upload
+
+
+@app.get("/defects/{defect_id}/uploads/{upload_id}", response_model=UploadOut)
+def get_upload_status(defect_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, defect_id, upload_id)
+    offset = get_store().upload_offset(upload.id)
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=offset)
+
+
+@app.patch("/defects/{defect_id}/uploads/{upload_id}", response_model=UploadOut)
+async def append_upload(
+    defect_id: int,
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(...),
+    db: Session = Depends(get_db),
+):
+    upload = await run_in_threadpool(get_upload, db, defect_id, upload_id)
+    offset = await append_to_upload(get_store(), upload.id, upload.size, upload_offset, request.stream())
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=offset)
+
+
+@app.post(
+    "/defects/{defect_id}/uploads/{upload_id}/complete",
+    response_model=AttachmentOut,
+    status_code=status.HTTP_201_CREATED,
+)
+def complete_upload(defect_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, defect_id, upload_id)
+    store = get_store()
+    if store.upload_offset(upload.id) != upload.size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Загрузка не завершена")
+    defect = db.query(Defect).filter(Defect.id == defect_id).first()
+    digest, size = store_upload(db, store, BLOB_NAMESPACE, upload.id, upload_hash(store, upload.id))
+    item = new_attachment(defect_id, upload.name, upload.type, digest, size)
+    db.add(item)
+    db.delete(upload)
+    add_history(db, defect, "attach", {"count": 1})
+    touch(db, defect)
+    db.commit()
+    return item
+
+
+@app.delete("/defects/{defect_id}/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+def abort_upload(defect_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, defect_id, upload_id)
+    db.delete(upload)
+    db.commit()
+    get_store().abort_upload(upload_id)
+
+
 @app.delete("/defects/{defect_id}/attachments/{name}", response_model=DefectOut)
 def remove_attachment(defect_id: int, name: str, db: Session = Depends(get_db)):
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
-    attachments = [a for a in (defect.attachments or []) if a.get("name") != name]
-    defect.attachments = attachments
-    add_history(defect, "detach", {"name": name})
-    db.commit()
-    db.refresh(defect)
-    return defect
+    return detach(db, defect, [a for a in defect.attachments if a.name == name], {"name": name})
+
+
+@app.delete("/defects/{defect_id}/attachments", response_model=DefectOut)
+def remove_attachments_by_id(defect_id: int, id: List[int] = Query(...), db: Session = Depends(get_db)):
+    """Удаление конкретных вложений, когда у нескольких файлов одно имя."""
+    defect = db.query(Defect).filter(Defect.id == defect_id).first()
+    if not defect:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    ids = set(id)
+    attachments = [a for a in defect.attachments if a.id in ids]
+    if len(attachments) != len(ids):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Вложение не найдено")
+    return detach(db, defect, attachments, {"ids": sorted(ids)})
 
 
 @app.delete("/defects/{defect_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_defect(defect_id: int, db: Session = Depends(get_db)):
+def delete_defect(defect_id: int, if_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
     defect = db.query(Defect).filter(Defect.id == defect_id).first()
     if not defect:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Дефект не найден")
+    check_if_match(if_match, "defect", defect.id, defect.version)
+    keys = release(db, BLOB_NAMESPACE, defect.attachments)
+    upload_ids = [u for (u,) in db.query(DefectUpload.id).filter(DefectUpload.defect_id == defect_id)]
+    db.query(DefectUpload).filter(DefectUpload.defect_id == defect_id).delete()
+    db.query(DefectComment).filter(DefectComment.defect_id == defect_id).delete()
+    db.query(DefectHistory).filter(DefectHistory.defect_id == defect_id).delete()
+    track_change(db, facet_values(defect), None)
+    remove_documents(db, "defect", defect_id)
+    remove_documents(db, "comment", parent_id=defect_id)
+    publish(db, "defect", defect_id, "delete")
     db.delete(defect)
     db.commit()
+    store = get_store()
+    for key in keys:
+        store.delete(key)
+    for upload_id in upload_ids:
+        store.abort_upload(upload_id)
     return {"status": "deleted"}
 
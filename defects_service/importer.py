@@ -0,0 +1,205 @@
+"""Массовая загрузка дефектов из NDJSON/CSV.
+
+Запуск из командной строки:
+
+    python -m defects_service.importer defects.ndjson
+    python -m defects_service.importer defects.csv --format csv --batch-size 10000
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from collections import Counter
+from datetime import datetime
+from typing import IO, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from common.changefeed import publish_many
+from common.search import index_new_documents
+from defects_service.model import Defect, DefectHistory, SessionLocal
+from defects_service.projects import missing_projects
+from defects_service.schemas import DefectCreate, ImportRowError, ImportResult
+from defects_service.stats import apply_deltas, count_row
+
+IMPORT_BATCH = 5000
+MAX_REPORTED_ERRORS = 1000
+
+DEFECT_COLUMNS = [
+    "id", "title", "desc", "status", "priority", "assignee", "due", "project_id", "created_at", "updated_at", "version",
+]
+HISTORY_COLUMNS = ["defect_id", "ts", "action", "payload"]
+
+
+def new_defect_values(payload: DefectCreate) -> dict:
+    return {
+        "title": payload.title.strip(),
+        "desc": (payload.desc or "").strip(),
+        "status": "Новая",
+        "priority": payload.priority or "Средний",
+        "assignee": (payload.assignee or "").strip(),
+        "due": payload.due or "",
+        "project_id": payload.project_id,
+    }
+
+
+def _copy(db: Session, table: str, columns: List[str], rows: List[list]) -> None:
+    buf = io.StringIO()
+    csv.writer(buf).writerows([r"\N" if v is None else v for v in row] for row in rows)
+    buf.seek(0)
+    quoted = ", ".join(f'"{c}"' for c in columns)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({quoted}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+    finally:
+        cursor.close()
+
+
+def insert_defects(db: Session, payloads: List[DefectCreate]) -> List[int]:
+    """Вставляет пачку новых дефектов вместе с историей, счётчиками, поисковым индексом и лентой изменений.
+
+    В Postgres с psycopg2 строки идут через COPY (id берутся заранее из последовательности), в
+    остальных случаях - одним INSERT ... RETURNING через executemany. Транзакцией управляет
+    вызывающий код.
+    """
+    if not payloads:
+        return []
+    now = datetime.utcnow()
+    rows = [{**new_defect_values(p), "created_at": now, "updated_at": now, "version": 1} for p in payloads]
+    history = [{"ts": now, "action": "create", "payload": p.model_dump()} for p in payloads]
+
+    dialect = db.get_bind().dialect
+    # copy_expert есть только у курсора psycopg2
+    if dialect.name == "postgresql" and dialect.driver == "psycopg2":
+        ids = db.execute(
+            text("SELECT nextval(pg_get_serial_sequence('defects', 'id')) FROM generate_series(1, :n)"),
+            {"n": len(rows)},
+        ).scalars().all()
+        _copy(db, "defects", DEFECT_COLUMNS, [[i, *(r[c] for c in DEFECT_COLUMNS[1:])] for i, r in zip(ids, rows)])
+        _copy(db, "defect_history", HISTORY_COLUMNS, [
+            [i, h["ts"], h["action"], json.dumps(h["payload"], ensure_ascii=False)] for i, h in zip(ids, history)
+        ])
+    else:
+        ids = db.scalars(insert(Defect).returning(Defect.id, sort_by_parameter_order=True), rows).all()
+        db.execute(insert(DefectHistory), [{"defect_id": i, **h} for i, h in zip(ids, history)])
+
+    deltas = Counter()
+    for row in rows:
+        count_row(deltas, row, 1)
+    apply_deltas(db, deltas)
+    index_new_documents(db, "defect", [
+        {"entity_id": i, "title": r["title"], "body": r["desc"]} for i, r in zip(ids, rows)
+    ])
+    publish_many(db, "defect", [(i, "create") for i in ids])
+    return list(ids)
+
+
+def read_rows(stream: IO[str], fmt: str) -> Iterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Построчно выдаёт (номер строки, запись, ошибка разбора); файл целиком в память не читается."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"Некорректный JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line_no, None, "Ожидался JSON-объект"
+            continue
+        yield line_no, row, None
+
+
+def db_error(e: SQLAlchemyError) -> str:
+    message = str(getattr(e, "orig", None) or e).strip().splitlines()
+    return f"Ошибка БД: {message[0] if message else type(e).__name__}"
+
+
+def import_stream(db: Session, stream: IO[str], fmt: str, batch_size: int = IMPORT_BATCH) -> ImportResult:
+    result = ImportResult(imported=0, failed=0, errors=[])
+
+    def fail(line: int, error: str) -> None:
+        result.failed += 1
+        if len(result.errors) < MAX_REPORTED_ERRORS:
+            result.errors.append(ImportRowError(line=line, error=error))
+
+    batch: List[Tuple[int, DefectCreate]] = []
+
+    def flush() -> None:
+        # ссылки на проекты проверяются одним запросом на пачку; строки с чужим project_id отбрасываются
+        missing = missing_projects(db, (payload.project_id for _, payload in batch))
+        if missing:
+            for line, payload in batch:
+                if payload.project_id in missing:
+                    fail(line, f"project_id: Проект не найден: {payload.project_id}")
+            batch[:] = [(line, payload) for line, payload in batch if payload.project_id not in missing]
+        try:
+            result.imported += len(insert_defects(db, [payload for _, payload in batch]))
+            db.commit()
+        except SQLAlchemyError:
+            # пачка отвергнута целиком: повторяем построчно, чтобы найти и пропустить плохие строки
+            db.rollback()
+            for line, payload in batch:
+                try:
+                    with db.begin_nested():
+                        insert_defects(db, [payload])
+                except SQLAlchemyError as e:
+                    fail(line, db_error(e))
+                else:
+                    result.imported += 1
+            db.commit()
+        batch.clear()
+
+    for line, row, error in read_rows(stream, fmt):
+        if error:
+            fail(line, error)
+            continue
+        try:
+            batch.append((line, DefectCreate.model_validate(row)))
+        except ValidationError as e:
+            fail(line, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return result
+
+
+def detect_format(filename: Optional[str], content_type: Optional[str]) -> str:
+    if (filename or "").lower().endswith(".csv") or (content_type or "").startswith("text/csv"):
+        return "csv"
+    return "ndjson"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Импорт дефектов из NDJSON/CSV")
+    parser.add_argument("path", help="путь к файлу или '-' для stdin")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default=None)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(args.path, None)
+    stream = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8", newline="")
+    db = SessionLocal()
+    try:
+        result = import_stream(db, stream, fmt, args.batch_size)
+    finally:
+        db.close()
+        if stream is not sys.stdin:
+            stream.close()
+    print(result.model_dump_json(indent=2))
+    return 0 if result.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
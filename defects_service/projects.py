@@ -0,0 +1,25 @@
+"""Проекты со стороны defects_service: таблица projects читается напрямую, без моделей projects_service."""
+from typing import Iterable, Optional, Set
+
+from fastapi import HTTPException, status
+from sqlalchemy import Integer, column, select, table
+from sqlalchemy.orm import Session
+
+projects = table("projects", column("id", Integer))
+
+
+def missing_projects(db: Session, project_ids: Iterable[Optional[int]]) -> Set[int]:
+    """id из project_ids, которых нет в projects; один IN-запрос на всю пачку."""
+    wanted = {i for i in project_ids if i is not None}
+    if not wanted:
+        return set()
+    return wanted - set(db.scalars(select(projects.c.id).where(projects.c.id.in_(wanted))))
+
+
+def check_projects(db: Session, project_ids: Iterable[Optional[int]]) -> None:
+    missing = missing_projects(db, project_ids)
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Проект не найден: {', '.join(map(str, sorted(missing)))}",
+        )
@@ -1,32 +1,85 @@
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+from common.fastjson import RowSerializer
 
 
 class Attachment(BaseModel):
+    """Тело файла в content или SHA-256 уже загруженного содержимого в content_hash."""
+
+    name: str
+    size: int
+    type: Optional[str] = ""
+    content: Optional[str] = None
+    content_hash: Optional[str] = Field(None, pattern="^[0-9a-f]{64}$")
+
+    @model_validator(mode="after")
+    def content_or_hash(self):
+        if self.content is None and self.content_hash is None:
+            raise ValueError("Нужно content или content_hash")
+        return self
+
+
+class AttachmentOut(BaseModel):
+    id: int
     name: str
     size: int
     type: Optional[str] = ""
-    content: str
+    content_hash: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
+class UploadCreate(BaseModel):
+    name: str
+    size: int = Field(ge=0)
+    type: Optional[str] = ""
+
+
+class UploadOut(BaseModel):
+    id: str
+    name: str
+    size: int
+    type: Optional[str] = ""
+    offset: int
 
 
 class Comment(BaseModel):
     id: int
     text: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
 
 
 class HistoryEntry(BaseModel):
-    ts: str
+    id: int
+    ts: datetime
     action: str
     payload: dict
 
+    class Config:
+        from_attributes = True
+
 
 class DefectBase(BaseModel):
-    title: str
-    desc: Optional[str] = ""
-    priority: str = "Средний"
-    assignee: Optional[str] = ""
-    due: Optional[str] = ""
+    # длины - как у колонок defects: иначе Postgres отвергнет строку уже при вставке
+    title: str = Field(max_length=500)
+    desc: Optional[str] = Field("", max_length=2000)
+    priority: str = Field("Средний", max_length=50)
+    assignee: Optional[str] = Field("", max_length=255)
+    due: Optional[str] = Field("", max_length=32)
+    project_id: Optional[int] = None
+
+    @field_validator("project_id", mode="before")
+    @classmethod
+    def empty_project(cls, value):
+        # пустая ячейка в CSV-импорте
+        return None if value == "" else value
 
 
 class DefectCreate(DefectBase):
@@ -34,12 +87,21 @@ class DefectCreate(DefectBase):
 
 
 class DefectUpdate(BaseModel):
-    title: Optional[str] = None
-    desc: Optional[str] = None
-    priority: Optional[str] = None
-    assignee: Optional[str] = None
-    due: Optional[str] = None
-    status: Optional[str] = None
+    title: Optional[str] = Field(None, max_length=500)
+    desc: Optional[str] = Field(None, max_length=2000)
+    priority: Optional[str] = Field(None, max_length=50)
+    assignee: Optional[str] = Field(None, max_length=255)
+    due: Optional[str] = Field(None, max_length=32)
+    status: Optional[str] = Field(None, max_length=50)
+    project_id: Optional[int] = None
+
+    @field_validator("title", "priority", "status")
+    @classmethod
+    def not_null(cls, value):
+        # поле можно не передавать, но null в NOT NULL колонку записать нельзя
+        if value is None:
+            raise ValueError("Поле не может быть null")
+        return value
 
 
 class DefectOut(BaseModel):
@@ -50,14 +112,68 @@ class DefectOut(BaseModel):
     priority: str
     assignee: Optional[str]
     due: Optional[str]
-    attachments: List[Attachment]
-    comments: List[Comment]
-    history: List[HistoryEntry]
+    project_id: Optional[int] = None
+    attachments: List[AttachmentOut]
 
     class Config:
         from_attributes = True
 
 
+DEFECT_FIELDS = ["id", "title", "desc", "status", "priority", "assignee", "due", "project_id", "attachments"]
+DEFECT_SUMMARY_FIELDS = ["id", "title", "status", "priority", "assignee", "due"]
+
+
+class DefectPartial(BaseModel):
+    """DefectOut, в котором присутствуют только запрошенные через fields= поля."""
+
+    id: int
+    title: Optional[str] = None
+    desc: Optional[str] = None
+    status: Optional[str] = None
+    priority: Optional[str] = None
+    assignee: Optional[str] = None
+    due: Optional[str] = None
+    project_id: Optional[int] = None
+    attachments: Optional[List[AttachmentOut]] = None
+
+    class Config:
+        from_attributes = True
+
+
+attachment_row = RowSerializer.from_schema(AttachmentOut)
+defect_row = RowSerializer.from_schema(DefectOut, attachments=attachment_row)
+comment_row = RowSerializer.from_schema(Comment)
+history_row = RowSerializer.from_schema(HistoryEntry)
+
+
+class DefectPage(BaseModel):
+    items: List[DefectPartial]
+    next_cursor: Optional[str] = None
+
+
+class CommentPage(BaseModel):
+    items: List[Comment]
+    next_cursor: Optional[str] = None
+
+
+class HistoryPage(BaseModel):
+    items: List[HistoryEntry]
+    next_cursor: Optional[str] = None
+
+
+class ChangeOut(BaseModel):
+    id: int
+    type: str
+    entity_id: int
+    action: str
+    ts: datetime
+
+
+class ChangePage(BaseModel):
+    items: List[ChangeOut]
+    last_id: int
+
+
 class StatusUpdate(BaseModel):
     status: str
 
@@ -70,6 +186,66 @@ class AttachmentsAdd(BaseModel):
     files: List[Attachment]
 
 
+MAX_BULK_ITEMS = 1000
+
+
+class BulkCreate(BaseModel):
+    items: List[DefectCreate] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+
+
+class BulkUpdate(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+    changes: DefectUpdate
+
+
+class BulkStatusUpdate(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+    status: str
+
+
+class BulkDelete(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=MAX_BULK_ITEMS)
+
+
+class BulkItemResult(BaseModel):
+    id: Optional[int] = None
+    ok: bool
+    error: Optional[str] = None
+
+
+class BulkResult(BaseModel):
+    results: List[BulkItemResult]
+
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+
+
 class StatsOut(BaseModel):
     total: int
-    closed: int
\ No newline at end of file
+    closed: int
+    overdue: int = 0
+    by_status: Dict[str, int] = {}
+    by_priority: Dict[str, int] = {}
+    by_assignee: Dict[str, int] = {}
+
+
+class SearchHit(BaseModel):
+    entity_type: str
+    entity_id: int
+    parent_id: Optional[int] = None
+    title: str
+    snippet: str
+    rank: float
+
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_offset: Optional[int] = None
@@ -0,0 +1,121 @@
+from collections import Counter
+from datetime import date
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import case, func, literal, select, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from common.defects import CLOSED_STATUS, overdue_condition
+from defects_service.model import Defect, DefectCounter
+
+FACETS = ("status", "priority", "assignee")
+TOTAL = ("total", "")
+OVERDUE = ("overdue", "")
+
+
+def count_row(deltas: Counter, row: Optional[dict], sign: int) -> None:
+    if row is None:
+        return
+    deltas[TOTAL] += sign
+    for facet in FACETS:
+        deltas[(facet, row.get(facet) or "")] += sign
+
+
+def facet_values(defect: Defect) -> dict:
+    return {facet: getattr(defect, facet) for facet in FACETS}
+
+
+def apply_deltas(db: Session, deltas: Counter) -> None:
+    """Атомарно прибавляет дельты к счётчикам одним upsert-выражением."""
+    rows = [{"facet": f, "value": v, "count": d} for (f, v), d in deltas.items() if d]
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        insert = postgresql.insert
+    elif dialect == "sqlite":
+        insert = sqlite.insert
+    else:
+        raise RuntimeError(f"Counters are not supported on {dialect}")
+    stmt = insert(DefectCounter)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DefectCounter.facet, DefectCounter.value],
+        set_={"count": DefectCounter.count + stmt.excluded.count},
+    )
+    db.execute(stmt, rows)
+
+
+def track_change(db: Session, before: Optional[dict], after: Optional[dict]) -> None:
+    deltas = Counter()
+    count_row(deltas, before, -1)
+    count_row(deltas, after, 1)
+    apply_deltas(db, deltas)
+
+
+def rebuild_counters(db: Session) -> None:
+    db.query(DefectCounter).delete()
+    db.add(DefectCounter(facet=TOTAL[0], value=TOTAL[1], count=0))
+    db.flush()
+    deltas = Counter()
+    for status, priority, assignee, n, _ in db.execute(grouped_counts(Defect.__table__)):
+        count_row(deltas, {"status": status, "priority": priority, "assignee": assignee}, n)
+    apply_deltas(db, deltas)
+
+
+def grouped_counts(defects, today: Optional[date] = None):
+    today = today or date.today()
+    return (
+        select(
+            defects.c.status,
+            defects.c.priority,
+            defects.c.assignee,
+            func.count(),
+            func.sum(case((overdue_condition(defects, today), 1), else_=0)),
+        )
+        .group_by(defects.c.status, defects.c.priority, defects.c.assignee)
+    )
+
+
+def empty_stats() -> Dict[str, object]:
+    return {"total": 0, "closed": 0, "overdue": 0, "by_status": {}, "by_priority": {}, "by_assignee": {}}
+
+
+def stats_from_groups(groups: Iterable) -> Dict[str, object]:
+    """Статистика по отфильтрованной выборке: один GROUP BY, свёртка граней в Python."""
+    result = empty_stats()
+    for status, priority, assignee, n, overdue in groups:
+        result["total"] += n
+        result["overdue"] += overdue or 0
+        for facet, value in zip(FACETS, (status, priority, assignee)):
+            bucket = result[f"by_{facet}"]
+            bucket[value or ""] = bucket.get(value or "", 0) + n
+    result["closed"] = result["by_status"].get(CLOSED_STATUS, 0)
+    return result
+
+
+def stats_from_counters(db: Session) -> Dict[str, object]:
+    """Статистика без фильтров: O(числа граней) строк из defect_counters плюс индексный подсчёт просроченных.
+
+    Без строки TOTAL (счётчики не собраны) - тот же GROUP BY, что и для фильтров; GET ничего не пишет.
+    """
+    defects = Defect.__table__
+    overdue = select(literal(OVERDUE[0]), literal(OVERDUE[1]), func.count()).where(
+        overdue_condition(defects, date.today())
+    )
+    counters = select(DefectCounter.facet, DefectCounter.value, DefectCounter.count)
+    rows = db.execute(union_all(counters, overdue)).all()
+    if not any((facet, value) == TOTAL for facet, value, _ in rows):
+        # счётчики ещё не собраны (их пересобирает bootstrap) - считаем агрегатом, ничего не записывая
+        return stats_from_groups(db.execute(grouped_counts(defects)))
+
+    result = empty_stats()
+    for facet, value, n in rows:
+        if (facet, value) == TOTAL:
+            result["total"] = n
+        elif (facet, value) == OVERDUE:
+            result["overdue"] = n
+        elif facet in FACETS and n:
+            result[f"by_{facet}"][value] = n
+    result["closed"] = result["by_status"].get(CLOSED_STATUS, 0)
+    return result
@@ -1,9 +1,40 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+os.environ.setdefault("INTERNAL_TOKEN", "test-internal-token")
+
+import pytest
 from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+from sqlalchemy import JSON, Column, DateTime, Integer, MetaData, String, Table, create_engine, inspect, select, text
+from sqlalchemy.orm import Session
+
+from common import metrics
+from common.blobs import AttachmentBlob, blob_key, collect_garbage, store_blob
+from common.pagination import encode_cursor
+from common.storage import get_store
 
 from defects_service.main import app
-from defects_service.schemas import DefectCreate, DefectUpdate, StatusUpdate, CommentCreate, AttachmentsAdd
+from defects_service.model import Defect, DefectAttachment, DefectComment, DefectCounter, DefectHistory, SessionLocal
+from defects_service.schemas import (
+    DefectCreate, DefectUpdate, StatusUpdate, CommentCreate, AttachmentsAdd, Comment, DefectOut, HistoryEntry,
+)
+from defects_service.bootstrap import bootstrap
+from defects_service.stats import TOTAL
+
+bootstrap()
 
 client = TestClient(app)
+INTERNAL = {"Authorization": f"Bearer {os.environ['INTERNAL_TOKEN']}"}
 
 
 def test_create_defect():
@@ -56,10 +87,31 @@ def test_add_comment():
     defect_id = test_create_defect()
     payload = CommentCreate(text="New comment")
     response = client.post(f"http://localhost:8080/defects_service/defects/{defect_id}/comments", json=payload.model_dump())
+    assert response.status_code == 201
+    assert response.json()["text"] == payload.text
+    response = client.get(f"http://localhost:8080/defects_service/defects/{defect_id}/comments")
     assert response.status_code == 200
     data = response.json()
-    assert len(data["comments"]) > 0
-    assert data["comments"][0]["text"] == payload.text
+    assert len(data["items"]) > 0
+    assert data["items"][0]["text"] == payload.text
+
+
+def test_list_history_pages():
+    defect_id = test_create_defect()
+    for i in range(3):
+        client.post(f"http://localhost:8080/defects_service/defects/{defect_id}/comments", json={"text": f"c{i}"})
+
+    url = f"http://localhost:8080/defects_service/defects/{defect_id}/history"
+    response = client.get(url, params={"limit": 2})
+    assert response.status_code == 200
+    first = response.json()
+    assert [e["action"] for e in first["items"]] == ["create", "comment"]
+    assert first["next_cursor"]
+
+    response = client.get(url, params={"limit": 2, "cursor": first["next_cursor"]})
+    second = response.json()
+    assert [e["payload"]["text"] for e in second["items"]] == ["c1", "c2"]
+    assert second["next_cursor"] is None
 
 
 def test_add_attachments():
@@ -108,3 +160,846 @@ def test_get_stats():
     assert total is not None, "Total defects count is missing"
     assert closed is not None, "Closed defects count is missing"
     print(f"Total defects: {total}, Closed defects: {closed}")
+
+
+def test_list_defects_pagination():
+    assignee = f"Paginator-{uuid.uuid4().hex[:8]}"
+    created = []
+    for i in range(5):
+        payload = DefectCreate(title=f"Page {i}", assignee=assignee, due=f"2030-01-0{i + 1}")
+        response = client.post("http://localhost:8080/defects_service/defects", json=payload.model_dump())
+        created.append(response.json()["id"])
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"assignee": assignee, "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("http://localhost:8080/defects_service/defects", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        seen.extend(item["id"] for item in data["items"])
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+    assert seen == list(reversed(created))
+
+
+def test_list_defects_filters():
+    assignee = f"Filter-{uuid.uuid4().hex[:8]}"
+    for due in ["2031-01-01", "2031-06-01", "2031-12-01"]:
+        payload = DefectCreate(title="Filtered", assignee=assignee, priority="Низкий", due=due)
+        client.post("http://localhost:8080/defects_service/defects", json=payload.model_dump())
+
+    params = {"assignee": assignee, "priority": "Низкий", "due_from": "2031-02-01", "due_to": "2031-12-31", "sort": "id"}
+    response = client.get("http://localhost:8080/defects_service/defects", params=params)
+    assert response.status_code == 200
+    dues = [item["due"] for item in response.json()["items"]]
+    assert dues == ["2031-06-01", "2031-12-01"]
+
+
+def test_list_defects_bad_cursor():
+    response = client.get("http://localhost:8080/defects_service/defects", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+    for forged in (["id", "x"], ["id", [1]], ["id", True], ["-created_at", "2024-01-01T00:00:00", "1"], ["-created_at", 5, 1]):
+        response = client.get(
+            "http://localhost:8080/defects_service/defects",
+            params={"cursor": encode_cursor(forged), "sort": forged[0]},
+        )
+        assert response.status_code == 400
+
+
+def test_attachments_share_content_by_hash():
+    body = f"screenshot {uuid.uuid4()}".encode()
+    digest = hashlib.sha256(body).hexdigest()
+    key = blob_key("defects", digest)
+    first, second = test_create_defect(), test_create_defect()
+    for defect_id in (first, second):
+        response = client.post(
+            f"http://localhost:8080/defects_service/defects/{defect_id}/attachments/upload",
+            files={"files": ("shot.png", body, "image/png")},
+        )
+        assert response.status_code == 201
+        assert response.json()[0]["content_hash"] == digest
+
+    url = f"http://localhost:8080/defects_service/defects/{first}"
+    response = client.post(f"{url}/attachments", json={"files": [{"name": "copy.png", "size": len(body), "content_hash": digest}]})
+    assert response.status_code == 200
+    attachments = response.json()["attachments"]
+    assert [a["size"] for a in attachments] == [len(body), len(body)]
+    with SessionLocal() as db:
+        assert db.get(AttachmentBlob, ("defects", digest)).refcount == 3
+        keys = db.scalars(select(DefectAttachment.storage_key).where(DefectAttachment.content_hash == digest)).all()
+        assert set(keys) == {key}
+
+    missing = {"name": "x.png", "size": 1, "content_hash": "0" * 64}
+    assert client.post(f"{url}/attachments", json={"files": [missing]}).status_code == 404
+
+    response = client.delete(f"{url}/attachments", params={"id": [a["id"] for a in attachments]})
+    assert response.status_code == 200
+    assert response.json()["attachments"] == []
+    assert client.delete(f"http://localhost:8080/defects_service/defects/{second}").status_code == 204
+    with SessionLocal() as db:
+        assert db.get(AttachmentBlob, ("defects", digest)).refcount == 0
+    assert get_store().size(key) == len(body)
+
+    assert collect_garbage(SessionLocal, get_store(), "defects", grace=timedelta(0)) >= 1
+    with SessionLocal() as db:
+        assert db.get(AttachmentBlob, ("defects", digest)) is None
+    with pytest.raises(FileNotFoundError):
+        get_store().size(key)
+
+
+def test_garbage_collector_removes_blobs_of_rolled_back_transactions():
+    defect_id = test_create_defect()
+    kept = b"live attachment " + uuid.uuid4().bytes
+    client.post(
+        f"http://localhost:8080/defects_service/defects/{defect_id}/attachments/upload",
+        files={"files": ("kept.bin", kept, "application/octet-stream")},
+    )
+    with SessionLocal() as db:
+        digest, _ = store_blob(db, get_store(), "defects", b"rolled back " + uuid.uuid4().bytes)
+        db.rollback()
+    orphan = blob_key("defects", digest)
+    assert get_store().size(orphan) > 0
+
+    collect_garbage(SessionLocal, get_store(), "defects", grace=timedelta(0))
+    with pytest.raises(FileNotFoundError):
+        get_store().size(orphan)
+    assert get_store().size(blob_key("defects", hashlib.sha256(kept).hexdigest())) == len(kept)
+
+
+def test_orphan_sweep_spares_blob_uploaded_during_sweep(monkeypatch):
+    import threading
+    import time
+
+    store = get_store()
+    data = b"uploaded during sweep " + uuid.uuid4().bytes
+    key = blob_key("defects", hashlib.sha256(data).hexdigest())
+    # брошенный файл с тем же содержимым от давно откатившейся транзакции
+    store.save(key, [data])
+    old = time.time() - 3600
+    os.utime(store._path(key), (old, old))
+
+    saved, committed = threading.Event(), threading.Event()
+
+    def upload():
+        with SessionLocal() as db:
+            store_blob(db, store, "defects", data)
+            saved.set()
+            time.sleep(0.3)
+            db.commit()
+        committed.set()
+
+    list_keys = store.list_keys
+
+    def listing_then_upload(prefix):
+        listed = list(list_keys(prefix))
+        # загрузка того же хэша между чтением списка файлов и удалением
+        threading.Thread(target=upload).start()
+        saved.wait(5)
+        return iter(listed)
+
+    monkeypatch.setattr(store, "list_keys", listing_then_upload)
+    collect_garbage(SessionLocal, store, "defects", grace=timedelta(minutes=1))
+    assert committed.wait(5)
+    with SessionLocal() as db:
+        assert db.get(AttachmentBlob, ("defects", hashlib.sha256(data).hexdigest())).refcount == 1
+    assert store.size(key) == len(data)
+
+def test_upload_and_download_attachment_range():
+    defect_id = test_create_defect()
+    body = b"0123456789" * 1000
+    response = client.post(
+        f"http://localhost:8080/defects_service/defects/{defect_id}/attachments/upload",
+        files={"files": ("data.bin", body, "application/octet-stream")},
+    )
+    assert response.status_code == 201
+    attachment = response.json()[0]
+    assert attachment["size"] == len(body)
+    assert "content" not in attachment
+
+    url = f"http://localhost:8080/defects_service/defects/{defect_id}/attachments/{attachment['id']}/content"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == body
+
+    response = client.get(url, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 10-19/{len(body)}"
+    assert response.content == body[10:20]
+
+    response = client.get(url, headers={"Range": f"bytes={len(body)}-"})
+    assert response.status_code == 416
+
+
+def test_resumable_upload():
+    defect_id = test_create_defect()
+    body = b"resumable-" * 100
+    base = f"http://localhost:8080/defects_service/defects/{defect_id}/uploads"
+    response = client.post(base, json={"name": "big.log", "size": len(body), "type": "text/plain"})
+    assert response.status_code == 201
+    upload_id = response.json()["id"]
+
+    response = client.patch(f"{base}/{upload_id}", content=body[:300], headers={"Upload-Offset": "0"})
+    assert response.status_code == 200
+    assert response.json()["offset"] == 300
+
+    response = client.patch(f"{base}/{upload_id}", content=body[300:], headers={"Upload-Offset": "0"})
+    assert response.status_code == 409
+
+    response = client.get(f"{base}/{upload_id}")
+    assert response.json()["offset"] == 300
+    response = client.patch(f"{base}/{upload_id}", content=body[300:], headers={"Upload-Offset": "300"})
+    assert response.json()["offset"] == len(body)
+
+    response = client.post(f"{base}/{upload_id}/complete")
+    assert response.status_code == 201
+    attachment = response.json()
+    assert attachment["name"] == "big.log"
+
+    response = client.get(
+        f"http://localhost:8080/defects_service/defects/{defect_id}/attachments/{attachment['id']}/content"
+    )
+    assert response.content == body
+
+
+def test_concurrent_appends_to_one_upload_are_serialized():
+    from fastapi import HTTPException
+
+    from common.storage import append_to_upload
+
+    store = get_store()
+    upload_id = store.create_upload()
+
+    async def body(data):
+        for i in range(0, len(data), 4):
+            await asyncio.sleep(0.01)
+            yield data[i:i + 4]
+
+    async def scenario():
+        return await asyncio.gather(
+            append_to_upload(store, upload_id, 16, 0, body(b"aaaaaaaa")),
+            append_to_upload(store, upload_id, 16, 0, body(b"bbbbbbbb")),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(scenario())
+    assert results[0] == 8
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 409
+    assert b"".join(store.read_upload(upload_id)) == b"aaaaaaaa"
+
+    # загрузку держит другой процесс
+    with store.open_upload(upload_id):
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(append_to_upload(store, upload_id, 16, 8, body(b"cccc")))
+    assert e.value.status_code == 409
+    store.abort_upload(upload_id)
+
+def test_sparse_fieldsets():
+    defect_id = test_create_defect()
+    response = client.get("http://localhost:8080/defects_service/defects", params={"limit": 1})
+    item = response.json()["items"][0]
+    assert set(item) == {"id", "title", "status", "priority", "assignee", "due"}
+
+    response = client.get(f"http://localhost:8080/defects_service/defects/{defect_id}", params={"fields": "title,desc"})
+    assert response.status_code == 200
+    assert response.json() == {"id": defect_id, "title": "New Defect", "desc": "Description of defect"}
+
+    response = client.get(f"http://localhost:8080/defects_service/defects/{defect_id}", params={"fields": "secret"})
+    assert response.status_code == 400
+
+
+def test_get_stats_facets():
+    before = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    assignee = f"Stats-{uuid.uuid4().hex[:8]}"
+    ids = []
+    for due in ["2000-01-01", "2999-01-01"]:
+        payload = DefectCreate(title="Stats", assignee=assignee, priority="Высокий", due=due)
+        ids.append(client.post("http://localhost:8080/defects_service/defects", json=payload.model_dump()).json()["id"])
+    client.patch(f"http://localhost:8080/defects_service/defects/{ids[1]}/status", json={"status": "Закрыта"})
+
+    data = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    assert data["total"] == before["total"] + 2
+    assert data["closed"] == before["closed"] + 1
+    assert data["by_assignee"][assignee] == 2
+
+    data = client.get("http://localhost:8080/defects_service/defects/stats", params={"assignee": assignee}).json()
+    assert data["total"] == 2
+    assert data["closed"] == 1
+    assert data["overdue"] == 1
+    assert data["by_status"] == {"Новая": 1, "Закрыта": 1}
+    assert data["by_priority"] == {"Высокий": 2}
+
+    client.delete(f"http://localhost:8080/defects_service/defects/{ids[0]}")
+    data = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    assert data["total"] == before["total"] + 1
+    assert data["by_assignee"][assignee] == 1
+
+
+def test_stats_without_counters_is_read_only():
+    expected = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    with SessionLocal() as db:
+        saved = db.get(DefectCounter, TOTAL)
+        total = saved.count
+        db.delete(saved)
+        db.commit()
+    try:
+        data = client.get("http://localhost:8080/defects_service/defects/stats").json()
+        assert data == expected
+        with SessionLocal() as db:
+            assert db.get(DefectCounter, TOTAL) is None
+    finally:
+        with SessionLocal() as db:
+            db.add(DefectCounter(facet=TOTAL[0], value=TOTAL[1], count=total))
+            db.commit()
+
+
+def test_search():
+    marker = f"zebra{uuid.uuid4().hex[:6]}"
+    payload = DefectCreate(title=f"Crash in {marker} module", desc="Application fails on start")
+    defect_id = client.post("http://localhost:8080/defects_service/defects", json=payload.model_dump()).json()["id"]
+    client.post(f"http://localhost:8080/defects_service/defects/{defect_id}/comments", json={"text": f"Seen {marker} again"})
+
+    response = client.get("http://localhost:8080/defects_service/search", params={"q": marker})
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert {(i["entity_type"], i["parent_id"] or i["entity_id"]) for i in items} == {
+        ("defect", defect_id),
+        ("comment", defect_id),
+    }
+    assert f"<mark>{marker}</mark>" in items[0]["snippet"]
+
+    response = client.get("http://localhost:8080/defects_service/search", params={"q": marker, "type": "comment"})
+    assert [i["entity_type"] for i in response.json()["items"]] == ["comment"]
+
+    client.patch(f"http://localhost:8080/defects_service/defects/{defect_id}", json={"title": "Renamed"})
+    client.delete(f"http://localhost:8080/defects_service/defects/{defect_id}")
+    response = client.get("http://localhost:8080/defects_service/search", params={"q": marker})
+    assert response.json()["items"] == []
+
+
+def test_bulk_operations():
+    assignee = f"Bulk-{uuid.uuid4().hex[:8]}"
+    items = [DefectCreate(title=f"Bulk {i}", assignee=assignee).model_dump() for i in range(5)]
+    response = client.post("http://localhost:8080/defects_service/defects/bulk", json={"items": items})
+    assert response.status_code == 201
+    ids = [r["id"] for r in response.json()["results"]]
+    assert len(ids) == 5
+
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/bulk/status",
+        json={"ids": ids[:3] + [10 ** 9], "status": "Закрыта"},
+    )
+    results = response.json()["results"]
+    assert [r["ok"] for r in results] == [True, True, True, False]
+
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/bulk/update",
+        json={"ids": ids, "changes": {"priority": "Низкий"}},
+    )
+    assert all(r["ok"] for r in response.json()["results"])
+
+    stats = client.get("http://localhost:8080/defects_service/defects/stats", params={"assignee": assignee}).json()
+    assert stats["by_status"] == {"Закрыта": 3, "Новая": 2}
+    assert stats["by_priority"] == {"Низкий": 5}
+    full = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    assert full["by_assignee"][assignee] == 5
+
+    history = client.get(f"http://localhost:8080/defects_service/defects/{ids[0]}/history").json()["items"]
+    assert [e["action"] for e in history] == ["create", "status", "update"]
+
+    response = client.post("http://localhost:8080/defects_service/defects/bulk/delete", json={"ids": ids})
+    assert all(r["ok"] for r in response.json()["results"])
+    assert client.get(f"http://localhost:8080/defects_service/defects/{ids[0]}").status_code == 404
+    full = client.get("http://localhost:8080/defects_service/defects/stats").json()
+    assert assignee not in full["by_assignee"]
+
+
+def test_bulk_update_reindexes_and_rejects_nulls():
+    old, new = f"walrus{uuid.uuid4().hex[:6]}", f"narwhal{uuid.uuid4().hex[:6]}"
+    items = [DefectCreate(title=f"Bulk {old} {i}").model_dump() for i in range(3)]
+    ids = [r["id"] for r in client.post("http://localhost:8080/defects_service/defects/bulk", json={"items": items}).json()["results"]]
+
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/bulk/update",
+        json={"ids": ids, "changes": {"title": f"Renamed {new}"}},
+    )
+    assert all(r["ok"] for r in response.json()["results"])
+    assert client.get("http://localhost:8080/defects_service/search", params={"q": old}).json()["items"] == []
+    found = client.get("http://localhost:8080/defects_service/search", params={"q": new}).json()["items"]
+    assert sorted(i["entity_id"] for i in found) == sorted(ids)
+
+    for field in ("title", "status", "priority"):
+        response = client.post(
+            "http://localhost:8080/defects_service/defects/bulk/update",
+            json={"ids": ids, "changes": {field: None}},
+        )
+        assert response.status_code == 422
+    response = client.patch(f"http://localhost:8080/defects_service/defects/{ids[0]}", json={"title": None})
+    assert response.status_code == 422
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/bulk/update",
+        json={"ids": ids, "changes": {"assignee": None}},
+    )
+    assert all(r["ok"] for r in response.json()["results"])
+
+
+def test_etag_conditional_requests():
+    defect_id = test_create_defect()
+    url = f"http://localhost:8080/defects_service/defects/{defect_id}"
+    response = client.get(url)
+    etag = response.headers["etag"]
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert client.get(url, params={"fields": "title"}, headers={"If-None-Match": etag}).status_code == 200
+
+    response = client.patch(url, json={"title": "First"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    new_etag = response.headers["etag"]
+    assert new_etag != etag
+
+    response = client.patch(url, json={"title": "Second"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert client.get(url).json()["title"] == "First"
+
+    client.post(f"{url}/comments", json={"text": "bumps version"})
+    assert client.get(url, headers={"If-None-Match": new_etag}).status_code == 200
+
+
+def test_export_defects():
+    assignee = f"Export-{uuid.uuid4().hex[:8]}"
+    for i in range(3):
+        payload = DefectCreate(title=f"Export, \"{i}\"", assignee=assignee)
+        client.post("http://localhost:8080/defects_service/defects", json=payload.model_dump())
+
+    response = client.get("http://localhost:8080/defects_service/defects/export", params={"assignee": assignee})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["title"] for r in rows] == ['Export, "0"', 'Export, "1"', 'Export, "2"']
+
+    response = client.get(
+        "http://localhost:8080/defects_service/defects/export",
+        params={"assignee": assignee, "format": "csv"},
+    )
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 3
+    assert rows[1]["title"] == 'Export, "1"'
+
+
+def test_import_retries_failed_batch_row_by_row():
+    from sqlalchemy import func
+
+    from common.search import SearchDocument
+    from defects_service.importer import import_stream
+
+    with SessionLocal() as db:
+        # устаревший документ поиска на id, который получит третья строка пачки
+        stale_id = (db.scalar(select(func.max(Defect.id))) or 0) + 3
+        db.add(SearchDocument(entity_type="defect", entity_id=stale_id, title="", body="", length=0))
+        db.commit()
+    assignee = f"Retry-{uuid.uuid4().hex[:8]}"
+    lines = [json.dumps({"title": f"Row {i}", "assignee": assignee}) for i in range(1, 4)]
+    lines.insert(1, json.dumps({"title": "x" * 501}))
+    try:
+        with SessionLocal() as db:
+            result = import_stream(db, io.StringIO("\n".join(lines)), "ndjson", batch_size=10)
+    finally:
+        with SessionLocal() as db:
+            db.query(SearchDocument).filter_by(entity_type="defect", entity_id=stale_id, title="").delete()
+            db.commit()
+
+    assert (result.imported, result.failed) == (2, 2)
+    assert [e.line for e in result.errors] == [2, 4]
+    assert "500" in result.errors[0].error
+    assert result.errors[1].error.startswith("Ошибка БД")
+    with SessionLocal() as db:
+        titles = db.scalars(select(Defect.title).where(Defect.assignee == assignee).order_by(Defect.id)).all()
+    assert titles == ["Row 1", "Row 2"]
+
+
+def test_import_defects():
+    assignee = f"Import-{uuid.uuid4().hex[:8]}"
+    lines = [
+        json.dumps({"title": "Imported 1", "assignee": assignee}),
+        "{not json",
+        json.dumps({"desc": "no title", "assignee": assignee}),
+        json.dumps({"title": "Imported 2", "assignee": assignee, "priority": "Высокий"}),
+    ]
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/import",
+        files={"file": ("defects.ndjson", "\n".join(lines).encode(), "application/x-ndjson")},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["imported"] == 2
+    assert data["failed"] == 2
+    assert [e["line"] for e in data["errors"]] == [2, 3]
+
+    body = f"title,desc,assignee\nCSV import,\"a, b\",{assignee}\n"
+    response = client.post(
+        "http://localhost:8080/defects_service/defects/import",
+        files={"file": ("defects.csv", body.encode(), "text/csv")},
+    )
+    assert response.json()["imported"] == 1
+
+    response = client.get("http://localhost:8080/defects_service/defects/stats", params={"assignee": assignee})
+    assert response.json()["total"] == 3
+
+    response = client.get(
+        "http://localhost:8080/defects_service/defects",
+        params={"assignee": assignee, "fields": "title,desc"},
+    )
+    items = response.json()["items"]
+    assert {i["title"] for i in items} == {"Imported 1", "Imported 2", "CSV import"}
+    csv_id = next(i["id"] for i in items if i["title"] == "CSV import")
+    history = client.get(f"http://localhost:8080/defects_service/defects/{csv_id}/history").json()
+    assert history["items"][0]["action"] == "create"
+
+
+def test_change_feed():
+    after = 0
+    while True:
+        page = client.get("http://localhost:8080/defects_service/defects/changes", params={"after": after, "limit": 1000})
+        if not page.json()["items"]:
+            break
+        after = page.json()["last_id"]
+
+    defect_id = test_create_defect()
+    client.patch(f"http://localhost:8080/defects_service/defects/{defect_id}/status", json={"status": "В работе"})
+    client.delete(f"http://localhost:8080/defects_service/defects/{defect_id}")
+
+    response = client.get("http://localhost:8080/defects_service/defects/changes", params={"after": after})
+    assert response.status_code == 200
+    data = response.json()
+    assert [(e["entity_id"], e["action"]) for e in data["items"]] == [
+        (defect_id, "create"), (defect_id, "status"), (defect_id, "delete"),
+    ]
+    assert data["last_id"] == data["items"][-1]["id"]
+
+
+def test_change_broker_fan_out():
+    from common.changefeed import ChangeBroker, publish
+    from defects_service.model import SessionLocal
+
+    broker = ChangeBroker(SessionLocal, ["defect"], poll_interval=0.05)
+
+    async def scenario():
+        queues = [await broker.subscribe() for _ in range(3)]
+        with SessionLocal() as db:
+            publish(db, "defect", 424242, "update")
+            db.commit()
+        events = [await asyncio.wait_for(q.get(), 5) for q in queues]
+        for q in queues:
+            broker.unsubscribe(q)
+        return events
+
+    events = asyncio.run(scenario())
+    assert {(e["entity_id"], e["action"]) for e in events} == {(424242, "update")}
+    assert len({e["id"] for e in events}) == 1
+
+
+def test_change_broker_delivers_late_commits():
+    from common.changefeed import ChangeBroker, ChangeEvent
+    from defects_service.model import SessionLocal
+
+    broker = ChangeBroker(SessionLocal, ["defect"], poll_interval=0.05, rescan_interval=0.1)
+
+    def insert_event(event_id, entity_id):
+        with SessionLocal() as db:
+            db.add(ChangeEvent(id=event_id, entity_type="defect", entity_id=entity_id, action="update"))
+            db.commit()
+
+    async def scenario():
+        queue = await broker.subscribe()
+        # событие с большим id закоммитилось раньше, чем с меньшим
+        insert_event(broker.last_id + 2, 2)
+        first = await asyncio.wait_for(queue.get(), 5)
+        insert_event(broker.last_id + 1, 1)
+        second = await asyncio.wait_for(queue.get(), 5)
+        await asyncio.sleep(0.2)
+        broker.unsubscribe(queue)
+        return first, second, queue.empty()
+
+    first, second, drained = asyncio.run(scenario())
+    assert (first["entity_id"], second["entity_id"]) == (2, 1)
+    assert second["id"] < first["id"]
+    assert drained
+
+
+def test_change_broker_rescans_commit_window_periodically(monkeypatch):
+    from common import changefeed
+    from common.changefeed import ChangeBroker, ChangeEvent
+    from defects_service.model import SessionLocal
+
+    broker = ChangeBroker(SessionLocal, ["defect"], rescan_interval=60)
+    broker.last_id = broker._max_id()
+    base = broker.last_id
+
+    def insert_event(event_id, entity_id):
+        with SessionLocal() as db:
+            db.add(ChangeEvent(id=event_id, entity_type="defect", entity_id=entity_id, action="update"))
+            db.commit()
+
+    reads = []
+    fetch_events = changefeed.fetch_events
+    monkeypatch.setattr(changefeed, "fetch_events", lambda db, types, after: reads.append(after) or fetch_events(db, types, after))
+
+    insert_event(base + 2, 2)
+    assert [e["entity_id"] for e in broker._fetch()] == [2]
+    # первое пересканирование окна - сразу, дальше каждое пробуждение читает только хвост журнала
+    assert broker._fetch() == []
+    insert_event(base + 1, 1)
+    assert broker._fetch() == []
+    assert reads == [base, base, base + 2]
+
+    broker.rescan_interval = 0
+    assert [e["entity_id"] for e in broker._fetch()] == [1]
+    assert broker._fetch() == []
+
+
+def test_prune_events_drops_only_expired():
+    from common.changefeed import RETENTION, ChangeEvent, prune_events
+    from defects_service.model import SessionLocal
+
+    with SessionLocal() as db:
+        old = ChangeEvent(ts=datetime.utcnow() - RETENTION - timedelta(minutes=1), entity_type="defect", entity_id=1, action="update")
+        fresh = ChangeEvent(entity_type="defect", entity_id=2, action="update")
+        db.add_all([old, fresh])
+        db.commit()
+        old_id, fresh_id = old.id, fresh.id
+    assert prune_events(SessionLocal) >= 1
+    with SessionLocal() as db:
+        assert db.get(ChangeEvent, old_id) is None
+        assert db.get(ChangeEvent, fresh_id) is not None
+
+
+def test_change_broker_recovers_after_failure():
+    from common.changefeed import RESET, ChangeBroker, publish
+    from defects_service.model import SessionLocal
+
+    broker = ChangeBroker(SessionLocal, ["defect"], poll_interval=0.05)
+    fetch, failures = broker._fetch, [1]
+
+    def flaky_fetch():
+        if failures:
+            failures.pop()
+            raise RuntimeError("connection lost")
+        return fetch()
+
+    broker._fetch = flaky_fetch
+
+    async def scenario():
+        queue = await broker.subscribe()
+        reset = await asyncio.wait_for(queue.get(), 5)
+        with SessionLocal() as db:
+            publish(db, "defect", 434343, "update")
+            db.commit()
+        event = await asyncio.wait_for(queue.get(), 5)
+        broker.unsubscribe(queue)
+        return reset, event
+
+    reset, event = asyncio.run(scenario())
+    assert reset == RESET
+    assert event["entity_id"] == 434343
+
+
+def test_fast_path_matches_schema():
+    defect_id = test_create_defect()
+    url = f"http://localhost:8080/defects_service/defects/{defect_id}"
+    files = [{"name": f"f{i}.txt", "size": 1, "content": "x"} for i in range(3)]
+    client.post(f"{url}/attachments", json={"files": files})
+    client.post(f"{url}/comments", json={"text": "Комментарий"})
+
+    with SessionLocal() as db:
+        defect = db.get(Defect, defect_id)
+        expected = DefectOut.model_validate(defect).model_dump(mode="json")
+        comments = [Comment.model_validate(c).model_dump(mode="json") for c in db.query(DefectComment).filter_by(defect_id=defect_id)]
+        history = [HistoryEntry.model_validate(h).model_dump(mode="json") for h in db.query(DefectHistory).filter_by(defect_id=defect_id)]
+
+    response = client.get(url)
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["etag"]
+    assert response.json() == expected
+    assert client.get(f"{url}/comments").json()["items"] == comments
+    assert client.get(f"{url}/history").json()["items"] == history
+
+
+def scrape(name, **labels):
+    text = client.get("http://localhost:8080/metrics", headers=INTERNAL).text
+    return sum(
+        sample.value
+        for family in text_string_to_metric_families(text)
+        for sample in family.samples
+        if sample.name == name and all(sample.labels.get(k) == v for k, v in labels.items())
+    )
+
+
+def test_metrics_count_db_queries_per_route():
+    route = {"service": "defects", "route": "/defects_service/defects"}
+    before = scrape("http_request_db_queries_sum", method="GET", **route)
+    requests_before = scrape("http_request_duration_seconds_count", method="GET", status="200", **route)
+    client.get("http://localhost:8080/defects_service/defects")
+    test_create_defect()
+    assert scrape("http_request_db_queries_sum", method="GET", **route) > before
+    assert scrape("http_request_duration_seconds_count", method="GET", status="200", **route) == requests_before + 1
+    assert scrape("http_request_db_queries_sum", method="POST", **route) > 0
+    assert scrape("http_response_size_bytes_count", method="GET", **route) > 0
+    assert scrape("db_pool_checkouts_total", engine="defects") > 0
+
+
+def test_slow_request_log(monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_SECONDS", 1e-9)
+    with caplog.at_level(logging.WARNING, logger="slow_requests"):
+        client.get("http://localhost:8080/defects_service/defects", params={"limit": 1})
+    assert any("/defects_service/defects?limit=1 -> 200" in r.getMessage() for r in caplog.records)
+
+
+def test_event_streams_kept_out_of_latency_and_in_flight(monkeypatch, caplog):
+    from types import SimpleNamespace
+
+    from prometheus_client import REGISTRY
+
+    monkeypatch.setattr(metrics, "SLOW_REQUEST_SECONDS", 1e-9)
+    route = "/test/changes/stream"
+    observed = {}
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, {"service": "sse-test", **labels}) or 0
+
+    async def stream_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+        observed["open"] = sample("http_streams_open", route=route)
+        observed["in_flight"] = sample("http_requests_in_flight")
+        await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": False})
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "method": "GET", "path": route, "query_string": b"", "route": SimpleNamespace(path=route)}
+    with caplog.at_level(logging.WARNING, logger="slow_requests"):
+        asyncio.run(metrics.MetricsMiddleware(stream_app, service="sse-test")(scope, receive, send))
+
+    assert observed == {"open": 1, "in_flight": 0}
+    assert sample("http_streams_open", route=route) == 0
+    assert sample("http_requests_in_flight") == 0
+    assert sample("http_request_duration_seconds_count", method="GET", route=route, status="200") == 0
+    assert not [r for r in caplog.records if route in r.getMessage()]
+
+def baseline_database(tmp_path):
+    """БД в том виде, в каком её создавал самый первый defects_service."""
+    url = f"sqlite:///{tmp_path / 'baseline.db'}"
+    metadata = MetaData()
+    Table(
+        "defects", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("title", String(500), nullable=False),
+        Column("desc", String(2000), nullable=True),
+        Column("status", String(50), nullable=False),
+        Column("priority", String(50), nullable=False),
+        Column("assignee", String(255), nullable=True),
+        Column("due", String(32), nullable=True),
+        Column("attachments", JSON, nullable=False),
+        Column("comments", JSON, nullable=False),
+        Column("history", JSON, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+    )
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    return url, engine
+
+
+def run_bootstrap(url, tmp_path):
+    env = dict(os.environ, DATABASE_URL=url, ATTACHMENTS_DIR=str(tmp_path / "attachments"))
+    result = subprocess.run([sys.executable, "-m", "defects_service.bootstrap"], capture_output=True, text=True, env=env)
+    assert result.returncode == 0, result.stderr
+
+
+def test_bootstrap_upgrades_baseline_schema(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO defects (id, title, \"desc\", status, priority, assignee, due, attachments, comments, history, created_at) "
+            "VALUES (1, 'Старый дефект', '', 'Новая', 'Средний', '', '', '[]', '[]', '[]', '2024-01-01 00:00:00')"
+        ))
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    columns = {c["name"] for c in inspect(engine).get_columns("defects")}
+    assert {"project_id", "version", "updated_at"} <= columns
+    indexes = {i["name"] for i in inspect(engine).get_indexes("defects")}
+    assert {"ix_defects_project_id_id", "ix_defects_project_id_status", "ix_defects_status"} <= indexes
+    with Session(engine) as db:
+        defect = db.get(Defect, 1)
+        assert (defect.title, defect.version, defect.project_id) == ("Старый дефект", 1, None)
+        assert defect.updated_at is not None
+
+
+def test_bootstrap_migrates_legacy_comments_and_history(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    comments = [{"id": 1704103200000, "text": "Воспроизводится"}, {"id": 1704106800000, "text": "Исправлено"}]
+    history = [{"ts": "2024-01-01T10:00:00", "action": "created", "payload": {"title": "Старый дефект"}}]
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO defects (id, title, \"desc\", status, priority, assignee, due, attachments, comments, history, created_at) "
+                "VALUES (1, 'Старый дефект', '', 'Новая', 'Средний', '', '', '[]', :comments, :history, '2024-01-01 00:00:00')"
+            ),
+            {"comments": json.dumps(comments), "history": json.dumps(history)},
+        )
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    assert not {"comments", "history"} & {c["name"] for c in inspect(engine).get_columns("defects")}
+    with Session(engine) as db:
+        migrated = db.scalars(select(DefectComment).where(DefectComment.defect_id == 1).order_by(DefectComment.id)).all()
+        assert [(c.text, c.created_at.isoformat()) for c in migrated] == [
+            ("Воспроизводится", "2024-01-01T10:00:00"), ("Исправлено", "2024-01-01T11:00:00"),
+        ]
+        entries = db.scalars(select(DefectHistory).where(DefectHistory.defect_id == 1)).all()
+        assert [(h.action, h.payload, h.ts.isoformat()) for h in entries] == [
+            ("created", {"title": "Старый дефект"}, "2024-01-01T10:00:00"),
+        ]
+
+
+def test_bootstrap_migrates_legacy_attachments(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    attachments = [
+        {"name": "log.txt", "size": 5, "type": "text/plain", "content": "aGVsbG8="},
+        {"name": "copy.txt", "size": 5, "type": "text/plain", "content": "data:text/plain;base64,aGVsbG8="},
+        {"name": "note.txt", "size": 14, "type": "", "content": "заметка"},
+    ]
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO defects (id, title, \"desc\", status, priority, assignee, due, attachments, comments, history, created_at) "
+                "VALUES (1, 'Старый дефект', '', 'Новая', 'Средний', '', '', :attachments, '[]', '[]', '2024-01-01 00:00:00')"
+            ),
+            {"attachments": json.dumps(attachments)},
+        )
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    assert "attachments" not in {c["name"] for c in inspect(engine).get_columns("defects")}
+    with Session(engine) as db:
+        migrated = db.scalars(select(DefectAttachment).where(DefectAttachment.defect_id == 1).order_by(DefectAttachment.id)).all()
+        assert [(a.name, a.size, a.type) for a in migrated] == [
+            ("log.txt", 5, "text/plain"), ("copy.txt", 5, "text/plain"), ("note.txt", 14, None),
+        ]
+        hello = hashlib.sha256(b"hello").hexdigest()
+        assert [a.content_hash for a in migrated[:2]] == [hello, hello]
+        assert db.get(AttachmentBlob, ("defects", hello)).refcount == 2
+        assert (tmp_path / "attachments" / blob_key("defects", hello)).read_bytes() == b"hello"
+        # без старых NOT NULL колонок новые дефекты снова вставляются
+        db.add(Defect(title="Новый дефект", status="Новая", priority="Средний"))
+        db.commit()
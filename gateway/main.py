@@ -0,0 +1,105 @@
+"""Все четыре сервиса в одном процессе: те же префиксы, один пул соединений, один стек middleware.
+
+    uvicorn gateway.main:app --host 0.0.0.0 --port 8000 --workers 4
+
+Для небольших установок вместо четырёх контейнеров за nginx; клиенты разницы не видят.
+"""
+import asyncio
+from typing import Dict
+
+from fastapi import Depends, FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.orm.exc import StaleDataError
+
+from common.blobs import GC_INTERVAL, run_garbage_collector
+from common.changefeed import PRUNE_INTERVAL, ChangeBroker, run_event_pruner, watch_changes
+from common.db import pool_report, share_engines
+from common.internal import require_internal
+from common.metrics import MetricsMiddleware, metrics_endpoint
+from common.etag import stale_data_handler
+from auth_service import model as auth_model
+from auth_service.endpoints import app as auth_router, on_user_change
+from defects_service import model as defects_model
+from defects_service.endpoints import app as defects_router
+from defects_service.model import BLOB_NAMESPACE as DEFECTS_BLOBS
+from projects_service import model as projects_model
+from projects_service.endpoints import app as projects_router
+from projects_service.model import BLOB_NAMESPACE as PROJECTS_BLOBS
+from settings_service import model as settings_model
+from settings_service.endpoints import STAGES_CHANGE, app as settings_router, on_stages_change
+
+app = FastAPI(title="Defects Center", version="1.0.0")
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+    allow_credentials=True,
+)
+app.add_middleware(MetricsMiddleware, service="gateway")
+
+app.add_exception_handler(StaleDataError, stale_data_handler)
+
+app.include_router(auth_router, prefix="/auth_service", tags=("auth_service",))
+app.include_router(defects_router, prefix="/defects_service", tags=("Defects_service",))
+app.include_router(projects_router, prefix="/projects_service", tags=("Projects_service",))
+app.include_router(settings_router, prefix="/settings_service", tags=("Settings_service",))
+
+CACHE_HANDLERS = {
+    "user": on_user_change,
+    STAGES_CHANGE: on_stages_change,
+}
+
+
+def on_change(event: Dict) -> None:
+    if event["type"] == "reset":
+        for handle in CACHE_HANDLERS.values():
+            handle(event)
+    else:
+        CACHE_HANDLERS[event["type"]](event)
+
+
+SERVICE_MODELS = (auth_model, defects_model, projects_model, settings_model)
+
+
+@app.on_event("startup")
+async def share_database_engines():
+    """Один движок на процесс вместо четырёх; сам импорт модулей сервисов ничего не меняет."""
+    share_engines([factory for m in SERVICE_MODELS for factory in (m.SessionLocal, m.AsyncSessionLocal)])
+
+
+@app.on_event("startup")
+async def start_cache_invalidation():
+    """Кэши пользователей и этапов сбрасываются по одной подписке на ленту изменений."""
+    broker = ChangeBroker(auth_model.SessionLocal, list(CACHE_HANDLERS))
+    app.state.cache_changes = asyncio.create_task(watch_changes(broker, on_change))
+
+
+@app.on_event("startup")
+async def start_blob_gc():
+    if GC_INTERVAL:
+        app.state.blob_gc = [
+            asyncio.create_task(run_garbage_collector(defects_model.SessionLocal, DEFECTS_BLOBS)),
+            asyncio.create_task(run_garbage_collector(projects_model.SessionLocal, PROJECTS_BLOBS)),
+        ]
+
+
+@app.on_event("startup")
+async def start_event_pruner():
+    """Журнал изменений чистится фоном по расписанию, а не в цикле брокера ленты."""
+    if PRUNE_INTERVAL:
+        app.state.event_pruner = asyncio.create_task(run_event_pruner(defects_model.SessionLocal))
+
+
+@app.get("/")
+def health():
+    return {"status": "ok", "service": "gateway"}
+
+
+@app.get("/db/pool", dependencies=[Depends(require_internal)])
+def db_pool():
+    return pool_report()
+
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+os.environ.setdefault("KEY", "test-secret-key")
+os.environ.setdefault("INTERNAL_TOKEN", "test-internal-token")
+
+from fastapi.testclient import TestClient
+
+from settings_service.bootstrap import bootstrap
+from gateway.main import app
+
+bootstrap()
+
+client = TestClient(app)
+
+
+def test_all_services_mounted():
+    assert client.get("http://localhost:8080/").json()["service"] == "gateway"
+    assert client.get("http://localhost:8080/settings_service/settings/stages").status_code == 200
+    for path in [
+        "/auth_service/auth/login",
+        "/defects_service/defects",
+        "/projects_service/projects",
+        "/settings_service/settings/stages",
+    ]:
+        assert any(route.path == path for route in app.routes), path
+
+
+def test_services_share_one_pool():
+    script = textwrap.dedent("""
+        import json
+        import os
+        from fastapi.testclient import TestClient
+        from auth_service.bootstrap import bootstrap as auth
+        from defects_service.bootstrap import bootstrap as defects
+        from projects_service.bootstrap import bootstrap as projects
+        from settings_service.bootstrap import bootstrap as settings
+        from gateway.main import app
+
+        with TestClient(app) as client:
+            for bootstrap in (auth, settings, defects, projects):
+                bootstrap()
+            for path in ["/defects_service/defects", "/projects_service/projects", "/settings_service/settings/stages"]:
+                assert client.get("http://localhost:8080" + path).status_code == 200, path
+            response = client.post(
+                "http://localhost:8080/auth_service/auth/register",
+                json={"username": "gateway@example.com", "password": "secret", "name": "Gateway", "role": "qa"},
+            )
+            assert response.status_code in (201, 400), response.text
+            print(json.dumps(sorted(client.get("http://localhost:8080/db/pool", headers={"Authorization": "Bearer " + os.environ["INTERNAL_TOKEN"]}).json())))
+    """)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=os.environ)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == '["shared", "shared.async"]'
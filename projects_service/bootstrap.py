@@ -0,0 +1,111 @@
+"""Схема и служебные данные projects_service; запускается при выкладке, а не при старте воркера.
+
+    python -m projects_service.bootstrap [--reindex]
+"""
+import argparse
+from typing import Dict, List, Optional
+
+from sqlalchemy import Integer, String, column, insert, inspect, select, table
+from sqlalchemy.orm import Session
+
+from common.blobs import BlobBase
+from common.changefeed import ChangeBase
+from common.migrations import (
+    drop_columns, existing_columns, iter_legacy_rows, legacy_attachments, legacy_history, upgrade_schema,
+)
+from common.search import SearchBase, has_documents, rebuild_index
+from common.storage import get_store
+from projects_service.model import (
+    BLOB_NAMESPACE, Base, Project, ProjectAttachment, ProjectHistory, ProjectStage, SessionLocal,
+)
+
+# таблица settings_service, читается напрямую - как defects в projects_service.defects
+stage_options = table("stage_options", column("id", Integer), column("name", String))
+
+
+def create_schema() -> None:
+    upgrade_schema(SessionLocal.engine, (Base.metadata, SearchBase.metadata, ChangeBase.metadata, BlobBase.metadata))
+
+
+def stage_option_ids(db: Session) -> Dict[str, int]:
+    """Варианты этапов settings_service (name -> id); таблицы может не быть, если settings ещё не разворачивали."""
+    if not inspect(db.connection()).has_table("stage_options"):
+        return {}
+    return dict(db.execute(select(stage_options.c.name, stage_options.c.id)).all())
+
+
+def migrate_legacy_stages(db: Session) -> int:
+    """Переносит JSON-колонку projects.stages в project_stages и удаляет её; повторный запуск ничего не делает.
+
+    stage_option_id заполняется по совпадению названия этапа с вариантом из stage_options.
+    """
+    columns = existing_columns(db.connection(), "projects", ["stages"])
+    if not columns:
+        return 0
+    options = stage_option_ids(db)
+    moved = 0
+    for rows in iter_legacy_rows(db, "projects", columns):
+        values = []
+        for row in rows:
+            stages = row["stages"] if isinstance(row["stages"], list) else []
+            titles = dict.fromkeys(s["title"] for s in stages if isinstance(s, dict) and s.get("title"))
+            values += [
+                {"project_id": row["id"], "title": title, "position": float(n), "stage_option_id": options.get(title)}
+                for n, title in enumerate(titles, start=1)
+            ]
+        if values:
+            db.execute(insert(ProjectStage), values)
+        moved += len(rows)
+    drop_columns(db.connection(), "projects", columns)
+    return moved
+
+
+LEGACY_COLUMNS = ("attachments", "history")
+
+
+def migrate_legacy_json(db: Session) -> int:
+    """Переносит JSON-колонки projects.attachments/history в отдельные таблицы и удаляет их; повторный запуск ничего не делает."""
+    columns = existing_columns(db.connection(), "projects", LEGACY_COLUMNS)
+    if not columns:
+        return 0
+    store = get_store()
+    moved = 0
+    for rows in iter_legacy_rows(db, "projects", columns):
+        attachments, history = [], []
+        for row in rows:
+            attachments += legacy_attachments(
+                db, store, BLOB_NAMESPACE, "project_id", row["id"], row.get("attachments"), row["created_at"],
+            )
+            history += legacy_history("project_id", row["id"], row.get("history"), row["created_at"])
+        for model, values in ((ProjectAttachment, attachments), (ProjectHistory, history)):
+            if values:
+                db.execute(insert(model), values)
+        moved += len(rows)
+    drop_columns(db.connection(), "projects", columns)
+    return moved
+
+
+def bootstrap(force_reindex: bool = False) -> None:
+    create_schema()
+    with SessionLocal() as db:
+        migrate_legacy_stages(db)
+        migrate_legacy_json(db)
+        has_projects = db.query(Project.id).first() is not None
+        if force_reindex or (has_projects and not has_documents(db, "project")):
+            rebuild_index(db, "project", (
+                {"entity_id": i, "title": name, "body": description}
+                for i, name, description in db.query(Project.id, Project.name, Project.description).yield_per(1000)
+            ))
+        db.commit()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Создание схемы projects_service")
+    parser.add_argument("--reindex", action="store_true", help="пересобрать поисковый индекс проектов")
+    args = parser.parse_args(argv)
+    bootstrap(args.reindex)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,63 @@
+"""Дефекты проектов со стороны projects_service: таблица defects читается напрямую, без моделей defects_service."""
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import DateTime, Integer, String, case, column, func, select, table, update
+from sqlalchemy.orm import Session
+
+from common.changefeed import publish_many
+from common.defects import CLOSED_STATUS, overdue_condition
+
+defects = table(
+    "defects",
+    column("id", Integer),
+    column("project_id", Integer),
+    column("title", String),
+    column("status", String),
+    column("priority", String),
+    column("assignee", String),
+    column("due", String),
+    column("created_at", DateTime),
+    column("updated_at", DateTime),
+    column("version", Integer),
+)
+
+NO_DEFECTS = {"total": 0, "open": 0, "closed": 0, "overdue": 0}
+
+DEFECT_COLUMNS = [
+    defects.c.id,
+    defects.c.title,
+    defects.c.status,
+    defects.c.priority,
+    defects.c.assignee,
+    defects.c.due,
+    defects.c.created_at,
+]
+
+
+def defect_counts(db: Session, today: Optional[date] = None) -> Dict[int, dict]:
+    """Открытые, закрытые и просроченные дефекты всех проектов одним GROUP BY по (project_id, status)."""
+    today = today or date.today()
+    closed = func.sum(case((defects.c.status == CLOSED_STATUS, 1), else_=0))
+    overdue = func.sum(case((overdue_condition(defects, today), 1), else_=0))
+    rows = db.execute(
+        select(defects.c.project_id, func.count(), closed, overdue)
+        .where(defects.c.project_id.isnot(None))
+        .group_by(defects.c.project_id)
+    )
+    return {
+        project_id: {"total": total, "open": total - (closed or 0), "closed": closed or 0, "overdue": overdue or 0}
+        for project_id, total, closed, overdue in rows
+    }
+
+
+def detach_defects(db: Session, project_id: int) -> List[int]:
+    """Отвязывает дефекты удаляемого проекта (project_id = NULL) и публикует их изменение в ленту дефектов."""
+    ids = db.scalars(
+        update(defects)
+        .where(defects.c.project_id == project_id)
+        .values(project_id=None, version=defects.c.version + 1, updated_at=datetime.utcnow())
+        .returning(defects.c.id)
+    ).all()
+    publish_many(db, "defect", [(defect_id, "update") for defect_id in ids])
+    return ids
@@ -1,80 +1,305 @@
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from fastapi import Depends, HTTPException, status, APIRouter
+from fastapi import Depends, File, Header, HTTPException, Query, Request, Response, UploadFile, status, APIRouter
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from projects_service.model import Project, get_db
-from projects_service.schemas import ProjectOut, ProjectCreate, ProjectUpdate, StageAdd, AttachmentsAdd
+from common.blobs import blob_key, release, store_json_file, store_stream, store_upload, upload_hash
+from common.changefeed import REPLAY_LIMIT, ChangeBroker, fetch_events, publish, sse_response
+from common.etag import check_if_match, etag_matches, make_etag
+from common.export import ExportFormat, export_response, iter_export
+from common.fastjson import json_response
+from common.pagination import keyset_page
+from common.projection import load_options, parse_fields
+from common.search import index_document, remove_documents
+from common.storage import CHUNK_SIZE, append_to_upload, content_response, get_store
+from projects_service.defects import DEFECT_COLUMNS, NO_DEFECTS, defect_counts, defects, detach_defects
+from projects_service.model import (
+    BLOB_NAMESPACE,
+    Project,
+    ProjectAttachment,
+    ProjectHistory,
+    ProjectStage,
+    ProjectUpload,
+    SessionLocal,
+    get_async_db,
+    get_db,
+)
+from projects_service.schemas import (
+    AttachmentOut,
+    ChangePage,
+    PROJECT_FIELDS,
+    PROJECT_SUMMARY_FIELDS,
+    HistoryPage,
+    ProjectDefectPage,
+    ProjectOut,
+    ProjectPage,
+    ProjectPartial,
+    ProjectCreate,
+    ProjectUpdate,
+    StageAdd,
+    StageMove,
+    StageOrder,
+    AttachmentsAdd,
+    UploadCreate,
+    UploadOut,
+    history_row,
+    project_defect_row,
+    project_row,
+)
 
 app = APIRouter()
 
+changes = ChangeBroker(SessionLocal, ["project"])
 
-def add_history(project: Project, action: str, payload: dict) -> None:
-    entry = {
-        "ts": datetime.utcnow().isoformat(),
-        "action": action,
-        "payload": payload,
-    }
-    history = list(project.history or [])
-    history.append(entry)
-    project.history = history
+PROJECT_VARIANT = ",".join(PROJECT_FIELDS)
+EXPORT_COLUMNS = [Project.id, Project.name, Project.description, Project.created_at, Project.updated_at]
+STAGE_STEP = 1.0
+MIN_STAGE_GAP = 1e-9
 
 
-@app.get("/projects", response_model=List[ProjectOut])
-def list_projects(db: Session = Depends(get_db)):
-    items = db.query(Project).order_by(Project.id.desc()).all()
-    return items
+def add_history(db: Session, project: Project, action: str, payload: dict) -> None:
+    """Каждая запись истории заодно уходит подписчикам ленты изменений."""
+    db.add(ProjectHistory(project_id=project.id, action=action, payload=payload))
+    publish(db, "project", project.id, action)
+
+
+def touch(db: Session, project: Project) -> None:
+    """Изменение связанных строк тоже меняет версию проекта и, значит, его ETag.
+
+    Версия растёт атомарным UPDATE без сверки со старой: параллельные изменения связанных
+    строк друг другу не мешают, а If-Match на сам проект после них уже не совпадёт.
+    """
+    db.execute(
+        update(Project).where(Project.id == project.id).values(version=Project.version + 1, updated_at=datetime.utcnow()),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def find_stage(db: Session, project_id: int, stage_id: int) -> Optional[ProjectStage]:
+    return db.query(ProjectStage).filter(ProjectStage.id == stage_id, ProjectStage.project_id == project_id).first()
+
+
+def renumber_stages(db: Session, project_id: int) -> None:
+    """Позиции 1, 2, 3...; нужно, только когда между соседями не осталось места."""
+    stages = db.query(ProjectStage).filter(ProjectStage.project_id == project_id).order_by(ProjectStage.position)
+    for n, stage in enumerate(stages, start=1):
+        stage.position = n * STAGE_STEP
+    db.flush()
+
+
+def position_after(db: Session, project_id: int, after: Optional[ProjectStage], moving_id: Optional[int] = None) -> float:
+    """Позиция между after (None - начало списка) и следующим за ним этапом, по индексу (project_id, position)."""
+    query = db.query(func.min(ProjectStage.position)).filter(ProjectStage.project_id == project_id)
+    if moving_id is not None:
+        query = query.filter(ProjectStage.id != moving_id)
+    if after is not None:
+        query = query.filter(ProjectStage.position > after.position)
+    next_position = query.scalar()
+    if next_position is None:
+        return (after.position if after is not None else 0) + STAGE_STEP
+    if after is None:
+        return next_position - STAGE_STEP
+    if next_position - after.position < MIN_STAGE_GAP:
+        renumber_stages(db, project_id)
+        return position_after(db, project_id, after, moving_id)
+    return (after.position + next_position) / 2
+
+
+@app.get("/projects", response_model=List[ProjectPartial], response_model_exclude_unset=True)
+async def list_projects(
+    fields: Optional[str] = None,
+    include_counts: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """include_counts=true добавляет счётчики дефектов каждого проекта; это ещё один запрос, а не N."""
+    selected = parse_fields(fields, PROJECT_FIELDS, PROJECT_SUMMARY_FIELDS)
+    items = await db.scalars(select(Project).options(*load_options(Project, selected)).order_by(Project.id.desc()))
+    projects = project_row.many(items, selected)
+    if include_counts:
+        counts = await db.run_sync(defect_counts)
+        for project in projects:
+            project["defects"] = counts.get(project["id"], NO_DEFECTS)
+    return json_response(projects)
+
+
+@app.get("/projects/export")
+def export_projects(format: ExportFormat = "ndjson"):
+    def build_query(db: Session):
+        return db.query(*EXPORT_COLUMNS).order_by(Project.id)
+
+    return export_response(iter_export(SessionLocal, build_query, format), format, "projects")
+
+
+@app.get("/projects/changes", response_model=ChangePage)
+async def list_changes(
+    after: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=REPLAY_LIMIT),
+    db: AsyncSession = Depends(get_async_db),
+):
+    items = await db.run_sync(fetch_events, ["project"], after, limit)
+    return ChangePage(items=items, last_id=items[-1]["id"] if items else after)
+
+
+@app.get("/projects/changes/stream")
+async def stream_changes(request: Request, last_event_id: Optional[str] = Header(None)):
+    return sse_response(changes, request, last_event_id)
+
+
+@app.get("/projects/by-stage", response_model=ProjectPage, response_model_exclude_unset=True)
+async def list_projects_in_stage(
+    title: Optional[str] = None,
+    stage_option_id: Optional[int] = None,
+    fields: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Проекты, у которых есть этап с таким названием или вариантом этапа из настроек."""
+    if title is None and stage_option_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Укажите title или stage_option_id")
+    selected = parse_fields(fields, PROJECT_FIELDS, PROJECT_SUMMARY_FIELDS)
+    in_stage = select(ProjectStage.project_id)
+    if title is not None:
+        in_stage = in_stage.where(ProjectStage.title == title)
+    if stage_option_id is not None:
+        in_stage = in_stage.where(ProjectStage.stage_option_id == stage_option_id)
+
+    def load(session: Session):
+        query = session.query(Project).options(*load_options(Project, selected)).filter(Project.id.in_(in_stage))
+        return keyset_page(query, Project.id, cursor, limit)
+
+    items, next_cursor = await db.run_sync(load)
+    return json_response({"items": project_row.many(items, selected), "next_cursor": next_cursor})
+
 
+@app.get("/projects/{project_id}", response_model=ProjectPartial, response_model_exclude_unset=True)
+async def get_project(
+    project_id: int,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    selected = parse_fields(fields, PROJECT_FIELDS, PROJECT_FIELDS)
+    variant = ",".join(selected)
+    if if_none_match:
+        version = await db.scalar(select(Project.version).where(Project.id == project_id))
+        etag = make_etag("project", project_id, version, variant)
+        if version is not None and etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
-@app.get("/projects/{project_id}", response_model=ProjectOut)
-def get_project(project_id: int, db: Session = Depends(get_db)):
-    p = db.query(Project).filter(Project.id == project_id).first()
+    p = await db.scalar(
+        select(Project)
+        .options(*load_options(Project, selected, always=["version"]))
+        .where(Project.id == project_id)
+    )
     if not p:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
-    return p
+    return json_response(project_row(p, selected), headers={"ETag": make_etag("project", p.id, p.version, variant)})
+
+
+@app.get("/projects/{project_id}/history", response_model=HistoryPage)
+async def list_history(
+    project_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    def load(session: Session):
+        query = session.query(ProjectHistory).filter(ProjectHistory.project_id == project_id)
+        return keyset_page(query, ProjectHistory.id, cursor, limit)
+
+    items, next_cursor = await db.run_sync(load)
+    return json_response({"items": history_row.many(items), "next_cursor": next_cursor})
+
+
+@app.get("/projects/{project_id}/defects", response_model=ProjectDefectPage)
+async def list_project_defects(
+    project_id: int,
+    status_filter: Optional[List[str]] = Query(None, alias="status"),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    if await db.scalar(select(Project.id).where(Project.id == project_id)) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+
+    def load(session: Session):
+        query = session.query(*DEFECT_COLUMNS).filter(defects.c.project_id == project_id)
+        if status_filter:
+            query = query.filter(defects.c.status.in_(status_filter))
+        return keyset_page(query, defects.c.id, cursor, limit)
+
+    items, next_cursor = await db.run_sync(load)
+    return json_response({"items": project_defect_row.many(items), "next_cursor": next_cursor})
 
 
 @app.post("/projects", response_model=ProjectOut, status_code=status.HTTP_201_CREATED)
-def create_project(payload: ProjectCreate, db: Session = Depends(get_db)):
-    now = datetime.utcnow().isoformat()
+def create_project(payload: ProjectCreate, response: Response, db: Session = Depends(get_db)):
     project = Project(
         name=payload.name.strip(),
         description=(payload.description or "").strip(),
-        stages=[],
-        attachments=[],
-        history=[{"ts": now, "action": "create", "payload": payload.model_dump()}],
     )
     db.add(project)
+    db.flush()
+    add_history(db, project, "create", payload.model_dump())
+    index_document(db, "project", project.id, project.name, project.description)
     db.commit()
     db.refresh(project)
+    response.headers["ETag"] = make_etag("project", project.id, project.version, PROJECT_VARIANT)
     return project
 
 
 @app.patch("/projects/{project_id}", response_model=ProjectOut)
-def update_project(project_id: int, payload: ProjectUpdate, db: Session = Depends(get_db)):
+def update_project(
+    project_id: int,
+    payload: ProjectUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    check_if_match(if_match, "project", project.id, project.version)
 
     before = {"name": project.name, "description": project.description}
     data = payload.model_dump(exclude_unset=True)
     for field, value in data.items():
         setattr(project, field, value)
 
-    add_history(project, "update", {"before": before, "after": data})
+    add_history(db, project, "update", {"before": before, "after": data})
+    index_document(db, "project", project.id, project.name, project.description)
     db.commit()
     db.refresh(project)
+    response.headers["ETag"] = make_etag("project", project.id, project.version, PROJECT_VARIANT)
     return project
 
 
 @app.delete("/projects/{project_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_project(project_id: int, db: Session = Depends(get_db)):
+def delete_project(project_id: int, if_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    check_if_match(if_match, "project", project.id, project.version)
+    keys = release(db, BLOB_NAMESPACE, project.attachments)
+    upload_ids = [u for (u,) in db.query(ProjectUpload.id).filter(ProjectUpload.project_id == project_id)]
+    db.query(ProjectUpload).filter(ProjectUpload.project_id == project_id).delete()
+    db.query(ProjectHistory).filter(ProjectHistory.project_id == project_id).delete()
+    remove_documents(db, "project", project_id)
+    detach_defects(db, project_id)
+    publish(db, "project", project_id, "delete")
     db.delete(project)
     db.commit()
+    store = get_store()
+    for key in keys:
+        store.delete(key)
+    for upload_id in upload_ids:
+        store.abort_upload(upload_id)
     return {"status": "deleted"}
 
 
@@ -83,14 +308,27 @@ def add_stage(project_id: int, payload: StageAdd, db: Session = Depends(get_db))
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
-    stages = list(project.stages or [])
-    if any(s.get("title") == payload.title for s in stages):
+    exists = (
+        db.query(ProjectStage.id)
+        .filter(ProjectStage.project_id == project_id, ProjectStage.title == payload.title)
+        .first()
+    )
+    if exists:
         return project
-    stage_id = int(datetime.utcnow().timestamp() * 1000)
-    stages.append({"id": stage_id, "title": payload.title})
-    project.stages = stages
-    add_history(project, "stage_add", {"title": payload.title})
-    db.commit()
+    last = db.query(func.max(ProjectStage.position)).filter(ProjectStage.project_id == project_id).scalar()
+    db.add(ProjectStage(
+        project_id=project_id,
+        title=payload.title,
+        position=(last or 0) + STAGE_STEP,
+        stage_option_id=payload.stage_option_id,
+    ))
+    add_history(db, project, "stage_add", {"title": payload.title})
+    touch(db, project)
+    try:
+        db.commit()
+    except IntegrityError:
+        # тот же этап только что добавил параллельный запрос
+        db.rollback()
     db.refresh(project)
     return project
 
@@ -100,43 +338,232 @@ def remove_stage(project_id: int, stage_id: int, db: Session = Depends(get_db)):
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
-    stages = list(project.stages or [])
-    removed = None
-    new_stages = []
-    for s in stages:
-        if int(s.get("id")) == stage_id:
-            removed = s
-            continue
-        new_stages.append(s)
-    project.stages = new_stages
-    add_history(project, "stage_remove", {"title": removed.get("title") if removed else stage_id})
+    stage = find_stage(db, project_id, stage_id)
+    if stage:
+        db.delete(stage)
+        touch(db, project)
+    add_history(db, project, "stage_remove", {"title": stage.title if stage else stage_id})
     db.commit()
     db.refresh(project)
     return project
 
 
+@app.post("/projects/{project_id}/stages/{stage_id}/move", response_model=ProjectOut)
+def move_stage(project_id: int, stage_id: int, payload: StageMove, db: Session = Depends(get_db)):
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    stage = find_stage(db, project_id, stage_id)
+    if not stage:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Этап не найден")
+    after = None
+    if payload.after_id is not None:
+        if payload.after_id == stage_id:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Этап нельзя поставить после самого себя")
+        after = find_stage(db, project_id, payload.after_id)
+        if not after:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Этап не найден")
+    stage.position = position_after(db, project_id, after, moving_id=stage.id)
+    add_history(db, project, "stage_move", {"title": stage.title, "after_id": payload.after_id})
+    touch(db, project)
+    db.commit()
+    db.refresh(project)
+    return project
+
+
+@app.put("/projects/{project_id}/stages/order", response_model=ProjectOut)
+def reorder_stages(project_id: int, payload: StageOrder, db: Session = Depends(get_db)):
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    current = {i for (i,) in db.query(ProjectStage.id).filter(ProjectStage.project_id == project_id)}
+    if len(payload.ids) != len(current) or set(payload.ids) != current:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Список не совпадает с этапами проекта")
+    if payload.ids:
+        db.execute(update(ProjectStage), [
+            {"id": stage_id, "position": n * STAGE_STEP} for n, stage_id in enumerate(payload.ids, start=1)
+        ])
+    add_history(db, project, "stage_reorder", {"ids": payload.ids})
+    touch(db, project)
+    db.commit()
+    db.refresh(project)
+    return project
+
+
+def new_attachment(project_id: int, name: str, type: Optional[str], digest: str, size: int) -> ProjectAttachment:
+    return ProjectAttachment(
+        project_id=project_id,
+        name=name,
+        size=size,
+        type=type,
+        storage_key=blob_key(BLOB_NAMESPACE, digest),
+        content_hash=digest,
+    )
+
+
+def detach(db: Session, project: Project, attachments: List[ProjectAttachment], details: dict) -> Project:
+    """Вложения удаляются сразу, их содержимое - сборщиком мусора, когда на него не останется ссылок."""
+    for a in attachments:
+        db.delete(a)
+    keys = release(db, BLOB_NAMESPACE, attachments)
+    add_history(db, project, "detach", details)
+    touch(db, project)
+    db.commit()
+    store = get_store()
+    for key in keys:
+        store.delete(key)
+    db.refresh(project)
+    return project
+
+
 @app.post("/projects/{project_id}/attachments", response_model=ProjectOut)
 def add_attachments(project_id: int, payload: AttachmentsAdd, db: Session = Depends(get_db)):
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
-    attachments = list(project.attachments or [])
-    attachments.extend([f.model_dump() for f in payload.files])
-    project.attachments = attachments
-    add_history(project, "attach", {"count": len(payload.files)})
+    store = get_store()
+    for f in payload.files:
+        digest, size = store_json_file(db, store, BLOB_NAMESPACE, f)
+        db.add(new_attachment(project.id, f.name, f.type, digest, size))
+    add_history(db, project, "attach", {"count": len(payload.files)})
+    touch(db, project)
     db.commit()
     db.refresh(project)
     return project
 
 
+@app.post(
+    "/projects/{project_id}/attachments/upload",
+    response_model=List[AttachmentOut],
+    status_code=status.HTTP_201_CREATED,
+)
+def upload_attachments(project_id: int, files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    store = get_store()
+    items = []
+    for f in files:
+        digest, size = store_stream(db, store, BLOB_NAMESPACE, iter(lambda: f.file.read(CHUNK_SIZE), b""))
+        item = new_attachment(project.id, f.filename or "file", f.content_type, digest, size)
+        db.add(item)
+        items.append(item)
+    add_history(db, project, "attach", {"count": len(files)})
+    touch(db, project)
+    db.commit()
+    return items
+
+
+@app.get("/projects/{project_id}/attachments/{attachment_id}/content")
+def download_attachment(
+    project_id: int,
+    attachment_id: int,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    db: Session = Depends(get_db),
+):
+    item = (
+        db.query(ProjectAttachment)
+        .filter(ProjectAttachment.id == attachment_id, ProjectAttachment.project_id == project_id)
+        .first()
+    )
+    if not item:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Вложение не найдено")
+    return content_response(get_store(), item.storage_key, item.size, item.type, item.name, range_header)
+
+
+@app.post("/projects/{project_id}/uploads", response_model=UploadOut, status_code=status.HTTP_201_CREATED)
+def create_upload(project_id: int, payload: UploadCreate, db: Session = Depends(get_db)):
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    upload = ProjectUpload(
+        id=get_store().create_upload(),
+        project_id=project.id,
+        name=payload.name,
+        size=payload.size,
+        type=payload.type,
+    )
+    db.add(upload)
+    db.commit()
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=0)
+
+
+def get_upload(db: Session, project_id: int, upload_id: str) -> ProjectUpload:
+    upload = (
+        db.query(ProjectUpload)
+        .filter(ProjectUpload.id == upload_id, ProjectUpload.project_id == project_id)
+        .first()
+    )
+    if not upload:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Загрузка не найдена")
+    return upload
+
+
+@app.get("/projects/{project_id}/uploads/{upload_id}", response_model=UploadOut)
+def get_upload_status(project_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, project_id, upload_id)
+    offset = get_store().upload_offset(upload.id)
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=offset)
+
+
+@app.patch("/projects/{project_id}/uploads/{upload_id}", response_model=UploadOut)
+async def append_upload(
+    project_id: int,
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(...),
+    db: Session = Depends(get_db),
+):
+    upload = await run_in_threadpool(get_upload, db, project_id, upload_id)
+    offset = await append_to_upload(get_store(), upload.id, upload.size, upload_offset, request.stream())
+    return UploadOut(id=upload.id, name=upload.name, size=upload.size, type=upload.type, offset=offset)
+
+
+@app.post(
+    "/projects/{project_id}/uploads/{upload_id}/complete",
+    response_model=AttachmentOut,
+    status_code=status.HTTP_201_CREATED,
+)
+def complete_upload(project_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, project_id, upload_id)
+    store = get_store()
+    if store.upload_offset(upload.id) != upload.size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Загрузка не завершена")
+    project = db.query(Project).filter(Project.id == project_id).first()
+    digest, size = store_upload(db, store, BLOB_NAMESPACE, upload.id, upload_hash(store, upload.id))
+    item = new_attachment(project_id, upload.name, upload.type, digest, size)
+    db.add(item)
+    db.delete(upload)
+    add_history(db, project, "attach", {"count": 1})
+    touch(db, project)
+    db.commit()
+    return item
+
+
+@app.delete("/projects/{project_id}/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+def abort_upload(project_id: int, upload_id: str, db: Session = Depends(get_db)):
+    upload = get_upload(db, project_id, upload_id)
+    db.delete(upload)
+    db.commit()
+    get_store().abort_upload(upload_id)
+
+
 @app.delete("/projects/{project_id}/attachments/{name}", response_model=ProjectOut)
 def remove_attachment(project_id: int, name: str, db: Session = Depends(get_db)):
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
-    attachments = [a for a in (project.attachments or []) if a.get("name") != name]
-    project.attachments = attachments
-    add_history(project, "detach", {"name": name})
-    db.commit()
-    db.refresh(project)
-    return project
+    return detach(db, project, [a for a in project.attachments if a.name == name], {"name": name})
+
+
+@app.delete("/projects/{project_id}/attachments", response_model=ProjectOut)
+def remove_attachments_by_id(project_id: int, id: List[int] = Query(...), db: Session = Depends(get_db)):
+    """Удаление конкретных вложений, когда у нескольких файлов одно имя."""
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Проект не найден")
+    ids = set(id)
+    attachments = [a for a in project.attachments if a.id in ids]
+    if len(attachments) != len(ids):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Вложение не найдено")
+    return detach(db, project, attachments, {"ids": sorted(ids)})
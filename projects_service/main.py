@@ -1,7 +1,17 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 
+from fastapi import Depends, FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.orm.exc import StaleDataError
+
+from common.blobs import GC_INTERVAL, run_garbage_collector
+from common.changefeed import PRUNE_INTERVAL, run_event_pruner
+from common.db import pool_report
+from common.internal import require_internal
+from common.metrics import MetricsMiddleware, metrics_endpoint
+from common.etag import stale_data_handler
 from projects_service.endpoints import app as router
+from projects_service.model import BLOB_NAMESPACE, SessionLocal
 
 
 app = FastAPI(title="Projects Service", version="1.0.0")
@@ -17,11 +27,36 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, service="projects")
+
 
+app.add_exception_handler(StaleDataError, stale_data_handler)
 
 app.include_router(router, prefix="/projects_service", tags=("rojects_service",))
 
 
+@app.on_event("startup")
+async def start_blob_gc():
+    """Содержимое вложений без ссылок удаляется фоном, а не в запросе, снявшем последнюю ссылку."""
+    if GC_INTERVAL:
+        app.state.blob_gc = asyncio.create_task(run_garbage_collector(SessionLocal, BLOB_NAMESPACE))
+
+
+@app.on_event("startup")
+async def start_event_pruner():
+    """Журнал изменений чистится фоном по расписанию, а не в цикле брокера ленты."""
+    if PRUNE_INTERVAL:
+        app.state.event_pruner = asyncio.create_task(run_event_pruner(SessionLocal))
+
+
 @app.get("/")
 def health():
-    return {"status": "ok", "service": "projects"}
\ No newline at end of file
+    return {"status": "ok", "service": "projects"}
+
+
+@app.get("/db/pool", dependencies=[Depends(require_internal)])
+def db_pool():
+    return pool_report()
+
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
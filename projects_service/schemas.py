@@ -1,24 +1,69 @@
+from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
+
+from common.fastjson import RowSerializer
 
 
 class Stage(BaseModel):
     id: int
     title: str
+    stage_option_id: Optional[int] = None
+
+    class Config:
+        from_attributes = True
 
 
 class Attachment(BaseModel):
+    """Тело файла в content или SHA-256 уже загруженного содержимого в content_hash."""
+
+    name: str
+    size: int
+    type: Optional[str] = ""
+    content: Optional[str] = None
+    content_hash: Optional[str] = Field(None, pattern="^[0-9a-f]{64}$")
+
+    @model_validator(mode="after")
+    def content_or_hash(self):
+        if self.content is None and self.content_hash is None:
+            raise ValueError("Нужно content или content_hash")
+        return self
+
+
+class AttachmentOut(BaseModel):
+    id: int
+    name: str
+    size: int
+    type: Optional[str] = ""
+    content_hash: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
+class UploadCreate(BaseModel):
+    name: str
+    size: int = Field(ge=0)
+    type: Optional[str] = ""
+
+
+class UploadOut(BaseModel):
+    id: str
     name: str
     size: int
     type: Optional[str] = ""
-    content: str
+    offset: int
 
 
 class HistoryEntry(BaseModel):
-    ts: str
+    id: int
+    ts: datetime
     action: str
     payload: dict
 
+    class Config:
+        from_attributes = True
+
 
 class ProjectBase(BaseModel):
     name: str
@@ -39,15 +84,98 @@ class ProjectOut(BaseModel):
     name: str
     description: Optional[str]
     stages: List[Stage]
-    attachments: List[Attachment]
-    history: List[HistoryEntry]
+    attachments: List[AttachmentOut]
 
     class Config:
         from_attributes = True
 
 
+class DefectCounts(BaseModel):
+    total: int
+    open: int
+    closed: int
+    overdue: int
+
+
+class ProjectDefect(BaseModel):
+    id: int
+    title: str
+    status: str
+    priority: str
+    assignee: Optional[str] = None
+    due: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ProjectDefectPage(BaseModel):
+    items: List[ProjectDefect]
+    next_cursor: Optional[str] = None
+
+
+PROJECT_FIELDS = ["id", "name", "description", "stages", "attachments"]
+PROJECT_SUMMARY_FIELDS = ["id", "name"]
+
+
+class ProjectPartial(BaseModel):
+    """ProjectOut, в котором присутствуют только запрошенные через fields= поля."""
+
+    id: int
+    name: Optional[str] = None
+    description: Optional[str] = None
+    stages: Optional[List[Stage]] = None
+    attachments: Optional[List[AttachmentOut]] = None
+    defects: Optional[DefectCounts] = None
+
+    class Config:
+        from_attributes = True
+
+
+stage_row = RowSerializer.from_schema(Stage)
+attachment_row = RowSerializer.from_schema(AttachmentOut)
+project_row = RowSerializer.from_schema(ProjectOut, stages=stage_row, attachments=attachment_row)
+history_row = RowSerializer.from_schema(HistoryEntry)
+project_defect_row = RowSerializer.from_schema(ProjectDefect)
+
+
+class HistoryPage(BaseModel):
+    items: List[HistoryEntry]
+    next_cursor: Optional[str] = None
+
+
+class ChangeOut(BaseModel):
+    id: int
+    type: str
+    entity_id: int
+    action: str
+    ts: datetime
+
+
+class ChangePage(BaseModel):
+    items: List[ChangeOut]
+    last_id: int
+
+
 class StageAdd(BaseModel):
     title: str
+    stage_option_id: Optional[int] = None
+
+
+class StageMove(BaseModel):
+    """Куда переставить этап: после этапа after_id, без него - в начало."""
+
+    after_id: Optional[int] = None
+
+
+class StageOrder(BaseModel):
+    ids: List[int]
+
+
+class ProjectPage(BaseModel):
+    items: List[ProjectPartial]
+    next_cursor: Optional[str] = None
 
 
 class AttachmentsAdd(BaseModel):
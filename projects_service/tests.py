@@ -1,9 +1,27 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import uuid
+
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import JSON, Column, DateTime, Integer, MetaData, String, Table, create_engine, inspect, select, text
+from sqlalchemy.orm import Session
+from common.blobs import AttachmentBlob
 from projects_service.main import app
 from projects_service.schemas import ProjectCreate, ProjectUpdate, StageAdd, AttachmentsAdd
+from defects_service.bootstrap import bootstrap as bootstrap_defects
+from defects_service.main import app as defects_app
+from projects_service.bootstrap import bootstrap
+from projects_service.model import Project, ProjectAttachment, ProjectHistory, SessionLocal
+
+bootstrap()
+bootstrap_defects()
 
 client = TestClient(app)
+defects_client = TestClient(defects_app)
 
 def test_create_project():
     payload = ProjectCreate(
@@ -55,6 +73,26 @@ def test_add_stage():
     assert data["stages"][0]["title"] == payload.title
 
 
+def test_concurrent_stage_changes_do_not_conflict():
+    from projects_service.endpoints import touch
+
+    project_id = test_create_project()
+    url = f"http://localhost:8080/projects_service/projects/{project_id}"
+    etag = client.get(url).headers["etag"]
+    with SessionLocal() as first, SessionLocal() as second:
+        # оба запроса прочитали проект до того, как любой из них закоммитил
+        a, b = first.get(Project, project_id), second.get(Project, project_id)
+        version = a.version
+        touch(first, a)
+        first.commit()
+        touch(second, b)
+        second.commit()
+    with SessionLocal() as db:
+        assert db.get(Project, project_id).version == version + 2
+    assert client.get(url).headers["etag"] != etag
+    response = client.patch(url, json={"name": "Renamed"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+
 def test_remove_stage():
     project_id = test_create_project()
     payload = StageAdd(title="Stage 1")
@@ -67,6 +105,115 @@ def test_remove_stage():
     assert len(data["stages"]) == 0
 
 
+def add_stages(project_id, titles):
+    for title in titles:
+        response = client.post(f"http://localhost:8080/projects_service/projects/{project_id}/stages", json={"title": title})
+    return {s["title"]: s["id"] for s in response.json()["stages"]}
+
+
+def test_move_and_reorder_stages():
+    project_id = test_create_project()
+    ids = add_stages(project_id, ["A", "B", "C"])
+    url = f"http://localhost:8080/projects_service/projects/{project_id}/stages"
+
+    response = client.post(f"{url}/{ids['C']}/move", json={"after_id": ids["A"]})
+    assert [s["title"] for s in response.json()["stages"]] == ["A", "C", "B"]
+    response = client.post(f"{url}/{ids['B']}/move", json={})
+    assert [s["title"] for s in response.json()["stages"]] == ["B", "A", "C"]
+    for _ in range(60):
+        response = client.post(f"{url}/{ids['C']}/move", json={"after_id": ids["B"]})
+        response = client.post(f"{url}/{ids['A']}/move", json={"after_id": ids["B"]})
+    assert [s["title"] for s in response.json()["stages"]] == ["B", "A", "C"]
+
+    response = client.put(f"{url}/order", json={"ids": [ids["C"], ids["B"], ids["A"]]})
+    assert [s["title"] for s in response.json()["stages"]] == ["C", "B", "A"]
+    response = client.put(f"{url}/order", json={"ids": [ids["C"], ids["B"]]})
+    assert response.status_code == 400
+
+    response = client.post(url, json={"title": "A"})
+    assert len(response.json()["stages"]) == 3
+
+
+def test_projects_in_stage():
+    in_stage = [test_create_project() for _ in range(3)]
+    other = test_create_project()
+    for project_id in in_stage:
+        client.post(
+            f"http://localhost:8080/projects_service/projects/{project_id}/stages",
+            json={"title": "Приёмка", "stage_option_id": 7001},
+        )
+    client.post(f"http://localhost:8080/projects_service/projects/{other}/stages", json={"title": "Другой"})
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"title": "Приёмка", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        data = client.get("http://localhost:8080/projects_service/projects/by-stage", params=params).json()
+        seen += [p["id"] for p in data["items"]]
+        cursor = data.get("next_cursor")
+        if not cursor:
+            break
+    assert set(in_stage) <= set(seen) and other not in seen
+
+    data = client.get("http://localhost:8080/projects_service/projects/by-stage", params={"stage_option_id": 7001}).json()
+    assert set(in_stage) <= {p["id"] for p in data["items"]}
+    assert client.get("http://localhost:8080/projects_service/projects/by-stage").status_code == 400
+
+
+def test_project_defects_and_counts():
+    project_id = test_create_project()
+    empty_id = test_create_project()
+    created = []
+    for title, due in [("Открытый", ""), ("Просроченный", "2000-01-01"), ("Закрытый", "2000-01-01")]:
+        response = defects_client.post(
+            "http://localhost:8080/defects_service/defects",
+            json={"title": title, "due": due, "project_id": project_id},
+        )
+        created.append(response.json()["id"])
+    defects_client.patch(f"http://localhost:8080/defects_service/defects/{created[2]}/status", json={"status": "Закрыта"})
+
+    url = f"http://localhost:8080/projects_service/projects/{project_id}/defects"
+    page = client.get(url, params={"limit": 2}).json()
+    assert [d["id"] for d in page["items"]] == created[:2]
+    page = client.get(url, params={"limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [d["id"] for d in page["items"]] == created[2:] and page["next_cursor"] is None
+    page = client.get(url, params={"status": "Закрыта"}).json()
+    assert [d["id"] for d in page["items"]] == [created[2]]
+    assert client.get("http://localhost:8080/projects_service/projects/999999/defects").status_code == 404
+
+    projects = {p["id"]: p for p in client.get("http://localhost:8080/projects_service/projects", params={"include_counts": True}).json()}
+    assert projects[project_id]["defects"] == {"total": 3, "open": 2, "closed": 1, "overdue": 1}
+    assert projects[empty_id]["defects"] == {"total": 0, "open": 0, "closed": 0, "overdue": 0}
+    assert "defects" not in client.get("http://localhost:8080/projects_service/projects").json()[0]
+
+
+def test_defects_reference_existing_projects():
+    project_id = test_create_project()
+    url = "http://localhost:8080/defects_service/defects"
+    assert defects_client.post(url, json={"title": "Чужой", "project_id": 999999}).status_code == 400
+    items = [{"title": "Свой", "project_id": project_id}, {"title": "Чужой", "project_id": 999999}]
+    response = defects_client.post(f"{url}/bulk", json={"items": items})
+    assert response.status_code == 400
+    assert "999999" in response.json()["detail"]
+
+    response = defects_client.post(url, json={"title": "Свой", "project_id": project_id})
+    defect, etag = response.json(), response.headers["etag"]
+    assert defects_client.patch(f"{url}/{defect['id']}", json={"project_id": 999999}).status_code == 400
+    response = defects_client.post(f"{url}/bulk/update", json={"ids": [defect["id"]], "changes": {"project_id": 999999}})
+    assert response.status_code == 400
+
+    rows = "\n".join(json.dumps(row) for row in items)
+    result = defects_client.post(f"{url}/import", files={"file": ("defects.ndjson", rows, "application/x-ndjson")}).json()
+    assert (result["imported"], result["failed"], result["errors"][0]["line"]) == (1, 1, 2)
+
+    client.delete(f"http://localhost:8080/projects_service/projects/{project_id}")
+    response = defects_client.get(f"{url}/{defect['id']}")
+    assert response.json()["project_id"] is None
+    assert response.headers["etag"] != etag
+
+
 def test_add_attachments():
     project_id = test_create_project()
     files = [{"name": "attachment1.txt", "size": 1234, "content": "file content"}]
@@ -90,3 +237,189 @@ def test_remove_attachment():
     data = response.json()
     assert len(data["attachments"]) == 0
 
+
+
+def test_identical_attachments_are_stored_once():
+    project_id = test_create_project()
+    content = f"spec {uuid.uuid4()}"
+    files = [{"name": "a.txt", "size": 1, "content": content}, {"name": "b.txt", "size": 1, "content": content}]
+    url = f"http://localhost:8080/projects_service/projects/{project_id}/attachments"
+    attachments = client.post(url, json={"files": files}).json()["attachments"]
+    assert attachments[0]["content_hash"] == attachments[1]["content_hash"]
+    with SessionLocal() as db:
+        blob = db.get(AttachmentBlob, ("projects", attachments[0]["content_hash"]))
+        assert blob.refcount == 2
+        assert blob.size == len(content)
+
+    response = client.delete(url, params={"id": [attachments[0]["id"]]})
+    assert [a["name"] for a in response.json()["attachments"]] == ["b.txt"]
+    assert client.delete(url, params={"id": [attachments[0]["id"]]}).status_code == 404
+    with SessionLocal() as db:
+        assert db.get(AttachmentBlob, ("projects", attachments[0]["content_hash"])).refcount == 1
+
+
+def test_upload_and_download_attachment():
+    project_id = test_create_project()
+    body = b"project spec" * 100
+    response = client.post(
+        f"http://localhost:8080/projects_service/projects/{project_id}/attachments/upload",
+        files={"files": ("spec.txt", body, "text/plain")},
+    )
+    assert response.status_code == 201
+    attachment = response.json()[0]
+
+    url = f"http://localhost:8080/projects_service/projects/{project_id}/attachments/{attachment['id']}/content"
+    response = client.get(url, headers={"Range": "bytes=-4"})
+    assert response.status_code == 206
+    assert response.content == body[-4:]
+
+    response = client.get(f"http://localhost:8080/projects_service/projects/{project_id}")
+    assert response.json()["attachments"][0]["size"] == len(body)
+
+
+def test_project_history():
+    project_id = test_create_project()
+    client.patch(f"http://localhost:8080/projects_service/projects/{project_id}", json={"name": "Renamed"})
+    response = client.get(f"http://localhost:8080/projects_service/projects/{project_id}/history")
+    assert response.status_code == 200
+    data = response.json()
+    assert [e["action"] for e in data["items"]] == ["create", "update"]
+    assert "history" not in client.get(f"http://localhost:8080/projects_service/projects/{project_id}").json()
+
+
+def test_sparse_fieldsets():
+    project_id = test_create_project()
+    response = client.get("http://localhost:8080/projects_service/projects")
+    assert set(response.json()[0]) == {"id", "name"}
+    response = client.get(f"http://localhost:8080/projects_service/projects/{project_id}", params={"fields": "name,attachments"})
+    assert response.json() == {"id": project_id, "name": "New Project", "attachments": []}
+
+
+def test_etag_conditional_requests():
+    project_id = test_create_project()
+    url = f"http://localhost:8080/projects_service/projects/{project_id}"
+    etag = client.get(url).headers["etag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.patch(url, json={"name": "A"}, headers={"If-Match": etag}).status_code == 200
+    assert client.patch(url, json={"name": "B"}, headers={"If-Match": etag}).status_code == 412
+    assert client.delete(url, headers={"If-Match": etag}).status_code == 412
+
+
+def test_export_projects():
+    project_id = test_create_project()
+    response = client.get("http://localhost:8080/projects_service/projects/export", params={"format": "ndjson"})
+    assert response.status_code == 200
+    ids = [json.loads(line)["id"] for line in response.text.splitlines()]
+    assert project_id in ids
+
+
+def test_project_change_feed():
+    after = client.get("http://localhost:8080/projects_service/projects/changes", params={"limit": 1000}).json()["last_id"]
+    created = client.post("http://localhost:8080/projects_service/projects", json={"name": "Feed", "description": ""}).json()
+    client.patch(f"http://localhost:8080/projects_service/projects/{created['id']}", json={"name": "Feed 2"})
+
+    data = client.get("http://localhost:8080/projects_service/projects/changes", params={"after": after}).json()
+    assert [(e["entity_id"], e["action"]) for e in data["items"]] == [(created["id"], "create"), (created["id"], "update")]
+
+
+def baseline_database(tmp_path):
+    """БД в том виде, в каком её создавал самый первый projects_service."""
+    url = f"sqlite:///{tmp_path / 'baseline.db'}"
+    metadata = MetaData()
+    Table(
+        "projects", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String(500), nullable=False),
+        Column("description", String(2000), nullable=True),
+        Column("stages", JSON, nullable=False),
+        Column("attachments", JSON, nullable=False),
+        Column("history", JSON, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+    )
+    engine = create_engine(url)
+    metadata.create_all(engine)
+    return url, engine
+
+
+def run_bootstrap(url, tmp_path):
+    env = dict(os.environ, DATABASE_URL=url, ATTACHMENTS_DIR=str(tmp_path / "attachments"))
+    result = subprocess.run([sys.executable, "-m", "projects_service.bootstrap"], capture_output=True, text=True, env=env)
+    assert result.returncode == 0, result.stderr
+
+
+def test_bootstrap_upgrades_baseline_schema(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    stages = [{"id": 1, "title": "Анализ"}, {"id": 2, "title": "Своя стадия"}, {"id": 3, "title": "Анализ"}]
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE stage_options (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE)"))
+        conn.execute(text("INSERT INTO stage_options (id, name) VALUES (42, 'Анализ')"))
+        conn.execute(
+            text(
+                "INSERT INTO projects (id, name, description, stages, attachments, history, created_at) "
+                "VALUES (1, 'Старый проект', '', :stages, '[]', '[]', '2024-01-01 00:00:00')"
+            ),
+            {"stages": json.dumps(stages)},
+        )
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    columns = {c["name"] for c in inspect(engine).get_columns("projects")}
+    assert {"version", "updated_at"} <= columns
+    assert "stages" not in columns
+    with Session(engine) as db:
+        project = db.get(Project, 1)
+        assert (project.name, project.version) == ("Старый проект", 1)
+        assert [(s.title, s.stage_option_id) for s in project.stages] == [("Анализ", 42), ("Своя стадия", None)]
+
+
+def test_bootstrap_migrates_legacy_history(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    history = [
+        {"ts": "2024-01-01T10:00:00", "action": "created", "payload": {"name": "Старый проект"}},
+        {"ts": "битое время", "action": "updated", "payload": None},
+    ]
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO projects (id, name, description, stages, attachments, history, created_at) "
+                "VALUES (1, 'Старый проект', '', '[]', '[]', :history, '2024-01-01 00:00:00')"
+            ),
+            {"history": json.dumps(history)},
+        )
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    assert "history" not in {c["name"] for c in inspect(engine).get_columns("projects")}
+    with Session(engine) as db:
+        entries = db.scalars(select(ProjectHistory).where(ProjectHistory.project_id == 1).order_by(ProjectHistory.id)).all()
+        assert [(h.action, h.payload, h.ts.isoformat()) for h in entries] == [
+            ("created", {"name": "Старый проект"}, "2024-01-01T10:00:00"),
+            ("updated", {}, "2024-01-01T00:00:00"),
+        ]
+
+
+def test_bootstrap_migrates_legacy_attachments(tmp_path):
+    url, engine = baseline_database(tmp_path)
+    attachments = [{"name": "plan.txt", "size": 4, "type": "text/plain", "content": "cGxhbg=="}]
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO projects (id, name, description, stages, attachments, history, created_at) "
+                "VALUES (1, 'Старый проект', '', '[]', :attachments, '[]', '2024-01-01 00:00:00')"
+            ),
+            {"attachments": json.dumps(attachments)},
+        )
+
+    run_bootstrap(url, tmp_path)
+    run_bootstrap(url, tmp_path)
+
+    assert "attachments" not in {c["name"] for c in inspect(engine).get_columns("projects")}
+    with Session(engine) as db:
+        attachment = db.scalars(select(ProjectAttachment).where(ProjectAttachment.project_id == 1)).one()
+        assert (attachment.name, attachment.size, attachment.content_hash) == ("plan.txt", 4, hashlib.sha256(b"plan").hexdigest())
+        assert db.get(AttachmentBlob, ("projects", attachment.content_hash)).refcount == 1
+        assert (tmp_path / "attachments" / attachment.storage_key).read_bytes() == b"plan"
+        db.add(Project(name="Новый проект"))
+        db.commit()
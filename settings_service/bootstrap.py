@@ -0,0 +1,40 @@
+"""Схема и значения по умолчанию settings_service; запускается при выкладке, а не при старте воркера.
+
+    python -m settings_service.bootstrap
+"""
+from typing import List, Optional
+
+from common.changefeed import ChangeBase
+from common.migrations import upgrade_schema
+from settings_service.endpoints import DEFAULTS, STAGES_VERSION
+from settings_service.model import Base, SessionLocal, SettingsVersion, StageOption
+
+
+def create_schema() -> None:
+    upgrade_schema(SessionLocal.engine, (Base.metadata, ChangeBase.metadata))
+
+
+def seed_defaults() -> None:
+    with SessionLocal() as db:
+        version = db.get(SettingsVersion, STAGES_VERSION)
+        if version is None:
+            version = SettingsVersion(name=STAGES_VERSION, version=1)
+            db.add(version)
+        if db.query(StageOption.id).first() is None:
+            db.add_all([StageOption(name=name) for name in DEFAULTS])
+            version.version += 1
+        db.commit()
+
+
+def bootstrap() -> None:
+    create_schema()
+    seed_defaults()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    bootstrap()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,68 +1,182 @@
-from fastapi import Depends, HTTPException, status, APIRouter
-from sqlalchemy.orm import Session
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
 
-from settings_service.model import StageOption, get_db
+from fastapi import Depends, Header, HTTPException, Response, status, APIRouter
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from common.changefeed import ChangeBroker, publish, watch_changes
+from common.etag import check_if_match, etag_matches, make_etag
+from settings_service.model import SettingsVersion, StageOption, get_async_db
 from settings_service.schemas import StageOptionsList, StageOptionOut, StageOptionCreate
 
 app = APIRouter()
 
 DEFAULTS = ["Анализ", "В разработке", "Выполнено"]
+STAGES_VERSION = "stages"
+STAGES_CHANGE = "stage_options"
+# как долго кэш верит себе без сверки версии с БД, если лента изменений молчит
+CACHE_TTL = float(os.getenv("STAGES_CACHE_TTL", "30"))
+
+
+async def stages_version(db: AsyncSession) -> int:
+    version = await db.scalar(select(SettingsVersion.version).where(SettingsVersion.name == STAGES_VERSION))
+    if version is None:
+        db.add(SettingsVersion(name=STAGES_VERSION, version=1))
+        await db.commit()
+        version = 1
+    return version
+
+
+async def bump_stages_version(db: AsyncSession, expected: int) -> int:
+    """Версия растёт только если её никто не поменял с момента чтения; иначе 409."""
+    result = await db.execute(
+        update(SettingsVersion)
+        .where(SettingsVersion.name == STAGES_VERSION, SettingsVersion.version == expected)
+        .values(version=SettingsVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Список этапов был изменён")
+    return expected + 1
+
+
+def stages_etag(version: int) -> str:
+    return make_etag("stages", "all", version)
+
+
+async def all_stage_options(db: AsyncSession):
+    return (await db.scalars(select(StageOption).order_by(StageOption.id))).all()
+
+
+async def find_stage_option(db: AsyncSession, name: str):
+    return await db.scalar(select(StageOption).where(StageOption.name == name))
+
+
+class StageOptionsCache:
+    """Список этапов и его версия в памяти воркера.
+
+    Сбрасывается сразу после изменения в этом воркере и по ленте изменений - в остальных.
+    Если событие ленты потерялось, кэш раз в ttl секунд сверяет свою версию с БД.
+    Загрузка, с которой совпал сброс, в кэш не попадает.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL):
+        self.ttl = ttl
+        self.version: Optional[int] = None
+        self.items: Optional[List[StageOptionOut]] = None
+        self.loads = 0
+        self.checked_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self, db: AsyncSession) -> Tuple[int, List[StageOptionOut]]:
+        if self.items is not None and time.monotonic() - self.checked_at > self.ttl:
+            await self._check(db)
+        if self.items is None:
+            async with self._lock:
+                if self.items is None:
+                    generation = self._generation
+                    version = await stages_version(db)
+                    items = [StageOptionOut.model_validate(item) for item in await all_stage_options(db)]
+                    self.loads += 1
+                    if generation != self._generation:
+                        return version, items
+                    self.version, self.items, self.checked_at = version, items, time.monotonic()
+        return self.version, self.items
+
+    async def _check(self, db: AsyncSession) -> None:
+        generation = self._generation
+        version = await stages_version(db)
+        if generation != self._generation:
+            return
+        if version != self.version:
+            self.invalidate()
+        else:
+            self.checked_at = time.monotonic()
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self.version = self.items = None
+
+
+stage_options = StageOptionsCache()
+
+
+async def stages_changed(db: AsyncSession, version: int) -> None:
+    await db.run_sync(publish, STAGES_CHANGE, version, "update")
+    await db.commit()
+    stage_options.invalidate()
 
 
-def ensure_defaults(db: Session) -> None:
-    count = db.query(StageOption).count()
-    if count == 0:
-        for name in DEFAULTS:
-            db.add(StageOption(name=name))
-        db.commit()
+def on_stages_change(event: Dict) -> None:
+    stage_options.invalidate()
 
 
-def ensure_defaults(db: Session) -> None:
-    count = db.query(StageOption).count()
-    if count == 0:
-        for name in DEFAULTS:
-            db.add(StageOption(name=name))
-        db.commit()
+async def watch_stage_changes(broker: ChangeBroker) -> None:
+    await watch_changes(broker, on_stages_change)
 
 
 @app.get("/settings/stages", response_model=StageOptionsList)
-def list_stage_options(db: Session = Depends(get_db)):
-    ensure_defaults(db)
-    items = db.query(StageOption).order_by(StageOption.id).all()
+async def list_stage_options(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    version, items = await stage_options.get(db)
+    if etag_matches(if_none_match, stages_etag(version)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": stages_etag(version)})
+    response.headers["ETag"] = stages_etag(version)
     return StageOptionsList(items=items)
 
 
 @app.post("/settings/stages", response_model=StageOptionOut, status_code=status.HTTP_201_CREATED)
-def add_stage_option(payload: StageOptionCreate, db: Session = Depends(get_db)):
+async def add_stage_option(
+    payload: StageOptionCreate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
     name = payload.name.strip()
     if not name:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Имя этапа не может быть пустым")
-    existing = db.query(StageOption).filter(StageOption.name == name).first()
+    version = await stages_version(db)
+    check_if_match(if_match, "stages", "all", version)
+    existing = await find_stage_option(db, name)
     if existing:
+        response.headers["ETag"] = stages_etag(version)
         return existing
     item = StageOption(name=name)
     db.add(item)
-    db.commit()
-    db.refresh(item)
+    version = await bump_stages_version(db, version)
+    await stages_changed(db, version)
+    response.headers["ETag"] = stages_etag(version)
     return item
 
 
 @app.delete("/settings/stages/{name}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_stage_option(name: str, db: Session = Depends(get_db)):
-    item = db.query(StageOption).filter(StageOption.name == name).first()
+async def delete_stage_option(name: str, if_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    item = await find_stage_option(db, name)
     if not item:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Этап не найден")
-    db.delete(item)
-    db.commit()
+    version = await stages_version(db)
+    check_if_match(if_match, "stages", "all", version)
+    await db.delete(item)
+    version = await bump_stages_version(db, version)
+    await stages_changed(db, version)
     return {"status": "deleted"}
 
 
 @app.post("/settings/stages/reset", response_model=StageOptionsList)
-def reset_stage_options(db: Session = Depends(get_db)):
-    db.query(StageOption).delete()
-    db.commit()
+async def reset_stage_options(response: Response, if_match: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    version = await stages_version(db)
+    check_if_match(if_match, "stages", "all", version)
+    await db.execute(delete(StageOption))
     for name in DEFAULTS:
         db.add(StageOption(name=name))
-    db.commit()
-    items = db.query(StageOption).order_by(StageOption.id).all()
+    version = await bump_stages_version(db, version)
+    await stages_changed(db, version)
+    items = await all_stage_options(db)
+    response.headers["ETag"] = stages_etag(version)
     return StageOptionsList(items=items)
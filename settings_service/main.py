@@ -1,7 +1,14 @@
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from settings_service.endpoints import app as router
+from common.changefeed import PRUNE_INTERVAL, ChangeBroker, run_event_pruner
+from common.db import pool_report
+from common.internal import require_internal
+from common.metrics import MetricsMiddleware, metrics_endpoint
+from settings_service.endpoints import STAGES_CHANGE, app as router, watch_stage_changes
+from settings_service.model import SessionLocal
 
 
 app = FastAPI(title="Settings Service", version="1.0.0")
@@ -17,10 +24,32 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, service="settings")
 
 app.include_router(router, prefix="/settings_service", tags=("Settings_service",))
 
 
+@app.on_event("startup")
+async def start_stages_invalidation():
+    """Изменения этапов из других воркеров сбрасывают кэш списка в этом воркере."""
+    app.state.stage_changes = asyncio.create_task(watch_stage_changes(ChangeBroker(SessionLocal, [STAGES_CHANGE])))
+
+
+@app.on_event("startup")
+async def start_event_pruner():
+    """Журнал изменений чистится фоном по расписанию, а не в цикле брокера ленты."""
+    if PRUNE_INTERVAL:
+        app.state.event_pruner = asyncio.create_task(run_event_pruner(SessionLocal))
+
+
 @app.get("/")
 def health():
-    return {"status": "ok", "service": "settings"}
\ No newline at end of file
+    return {"status": "ok", "service": "settings"}
+
+
+@app.get("/db/pool", dependencies=[Depends(require_internal)])
+def db_pool():
+    return pool_report()
+
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
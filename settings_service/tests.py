@@ -1,8 +1,24 @@
+import asyncio
+import os
+
+os.environ.setdefault("INTERNAL_TOKEN", "test-internal-token")
+
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, exc, update
+
+from common.changefeed import ChangeBroker, publish
+from common.db import InstrumentedQueuePool, pool_stats
+from settings_service.endpoints import STAGES_CHANGE, STAGES_VERSION, stage_options, watch_stage_changes
 from settings_service.main import app
+from settings_service.model import AsyncSessionLocal, SessionLocal, SettingsVersion, StageOption
 from settings_service.schemas import StageOptionCreate
+from settings_service.bootstrap import bootstrap
+
+bootstrap()
 
 client = TestClient(app)
+INTERNAL = {"Authorization": f"Bearer {os.environ['INTERNAL_TOKEN']}"}
 
 
 def test_add_stage_option():
@@ -54,3 +70,139 @@ def test_add_duplicate_stage_option():
     assert response.status_code == 201
     data = response.json()
     assert data["name"] == payload.name
+
+
+def test_stage_options_etag():
+    response = client.get("http://localhost:8080/settings_service/settings/stages")
+    etag = response.headers["etag"]
+    response = client.get("http://localhost:8080/settings_service/settings/stages", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    payload = StageOptionCreate(name="Этап с ETag")
+    response = client.post(
+        "http://localhost:8080/settings_service/settings/stages",
+        json=payload.model_dump(),
+        headers={"If-Match": etag},
+    )
+    assert response.status_code == 201
+    response = client.delete(
+        f"http://localhost:8080/settings_service/settings/stages/{payload.name}",
+        headers={"If-Match": etag},
+    )
+    assert response.status_code == 412
+    response = client.get("http://localhost:8080/settings_service/settings/stages", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_stage_options_served_from_memory():
+    client.get("http://localhost:8080/settings_service/settings/stages")
+    statements = []
+    engine = AsyncSessionLocal.engine.sync_engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        for _ in range(3):
+            assert client.get("http://localhost:8080/settings_service/settings/stages").status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert statements == []
+
+    payload = StageOptionCreate(name="Этап из кэша")
+    client.post("http://localhost:8080/settings_service/settings/stages", json=payload.model_dump())
+    names = [item["name"] for item in client.get("http://localhost:8080/settings_service/settings/stages").json()["items"]]
+    assert payload.name in names
+
+
+def test_stage_options_invalidated_from_other_workers():
+    async def scenario():
+        task = asyncio.create_task(watch_stage_changes(ChangeBroker(SessionLocal, [STAGES_CHANGE], poll_interval=0.05)))
+        await asyncio.sleep(0.2)
+        async with AsyncSessionLocal() as db:
+            await stage_options.get(db)
+        assert stage_options.items is not None
+        with SessionLocal() as db:
+            db.add(StageOption(name="Этап другого воркера"))
+            db.execute(update(SettingsVersion).where(SettingsVersion.name == STAGES_VERSION).values(version=SettingsVersion.version + 1))
+            publish(db, STAGES_CHANGE, 0, "update")
+            db.commit()
+        for _ in range(50):
+            if stage_options.items is None:
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert stage_options.items is None
+    names = [item["name"] for item in client.get("http://localhost:8080/settings_service/settings/stages").json()["items"]]
+    assert "Этап другого воркера" in names
+
+
+def test_db_pool_stats():
+    client.get("http://localhost:8080/settings_service/settings/stages")
+    assert client.get("http://localhost:8080/db/pool").status_code == 403
+    assert client.get("http://localhost:8080/db/pool", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.get("http://localhost:8080/metrics").status_code == 403
+    response = client.get("http://localhost:8080/db/pool", headers=INTERNAL)
+    assert response.status_code == 200
+    stats = response.json()["settings"]
+    assert stats["pool"] == "InstrumentedQueuePool"
+    assert stats["checkouts"] >= 1 and stats["timeouts"] == 0
+    assert response.json()["settings.async"]["pool"] == "NullPool"
+
+
+def test_pool_wait_stats_count_timeouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+    held = engine.connect()
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    held.close()
+    stats = pool_stats(engine)
+    assert stats["checkouts"] == 2 and stats["timeouts"] == 1
+    assert stats["wait_max_ms"] >= 50
+
+
+def test_stage_options_cache_rechecks_version_after_ttl():
+    async def load():
+        async with AsyncSessionLocal() as db:
+            return await stage_options.get(db)
+
+    asyncio.run(load())
+    # изменение без события в ленте: кэш узнаёт о нём только по версии в БД
+    with SessionLocal() as db:
+        db.add(StageOption(name="Этап без события"))
+        db.execute(update(SettingsVersion).where(SettingsVersion.name == STAGES_VERSION).values(version=SettingsVersion.version + 1))
+        db.commit()
+    assert "Этап без события" not in [item.name for item in asyncio.run(load())[1]]
+
+    ttl, stage_options.ttl = stage_options.ttl, 0
+    try:
+        version, items = asyncio.run(load())
+    finally:
+        stage_options.ttl = ttl
+    assert "Этап без события" in [item.name for item in items]
+
+
+def test_watch_changes_resubscribes_when_broker_stops():
+    from common.changefeed import RESET, watch_changes
+
+    broker = ChangeBroker(SessionLocal, [STAGES_CHANGE], poll_interval=0.05)
+    seen = []
+
+    async def scenario():
+        task = asyncio.create_task(watch_changes(broker, seen.append, retry_interval=0.05))
+        await asyncio.sleep(0.2)
+        broker._task.cancel()
+        for _ in range(50):
+            if seen.count(RESET) >= 2 and broker.running:
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert seen.count(RESET) >= 2